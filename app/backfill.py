@@ -0,0 +1,178 @@
+"""Date-range backfill of the report checks
+
+Every day of the range gets its own report configuration (see build_report_settings)
+and is reconciled in a process pool, limited to a number of concurrent days. The
+per-day results are written to one consolidated summary file.
+
+Usage:
+    python -m app.backfill 2020-05-01 2020-05-31 --workers 4 --summary backfill.csv
+"""
+
+import argparse
+import json
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from config.settings import PARALLEL
+from .main import REPORT_PAIRS, build_report_settings
+from .parallel import init_worker
+from .sink import BreakSink
+from .utils import (create_dates, fetch_reports, in_memory, reconcile_reports, reconciliation_engine, report_breaks,
+                    SERVER_SIDE_ENGINES)
+
+SUMMARY_COLUMNS = ["day", "margin", "left", "right", "matched", "breaks", "error"]
+
+def day_range(start, end):
+    """lists the days between start and end, both inclusive
+
+    Args:
+        start (string): first day as YYYY-MM-DD
+        end (string): last day as YYYY-MM-DD
+
+    Returns:
+        list: datetime per day
+    """
+    
+    first = datetime.strptime(start, "%Y-%m-%d")
+    last = datetime.strptime(end, "%Y-%m-%d")
+    
+    return [first + timedelta(days=offset) for offset in range((last - first).days + 1)]
+
+def count_items(df):
+    # counted and server-side results carry the number of rows per key or margin class
+    for column in ("matched", "multiplicity"):
+        if column in df.columns:
+            return int(df[column].sum())
+    return len(df)
+
+def reconcile_day(day, overrides=None, pairs=None, sink=None):
+    """reconciles all margin classes and report pairs of one run day, the breaks go
+       to the sink
+
+    Args:
+        day (datetime): run day
+        overrides (dict, optional): report configuration entries to override, e.g. engine
+            or margin_classes
+        pairs (list, optional): report pairs to check, only their reports are fetched.
+            Defaults to REPORT_PAIRS
+        sink (BreakSink, optional): collects the breaks. Defaults to a sink of its own
+            which is closed with the day
+
+    Returns:
+        list: one summary dict per margin class and report pair
+    """
+    
+    pairs = pairs or REPORT_PAIRS
+    report_config = build_report_settings(create_dates(day))
+    report_config.update(overrides or {})
+    names = {name for pair in pairs for name in pair}
+    report_config['reports'] = [report for report in report_config['reports'] if report['name'] in names]
+    label = day.strftime("%Y-%m-%d")
+    
+    own_sink = sink is None
+    sink = BreakSink() if own_sink else sink
+    
+    try:
+        engine = reconciliation_engine(report_config)
+        reports = fetch_reports(report_config, "handles" if engine in SERVER_SIDE_ENGINES else None)
+        if reports is None:
+            sink.record_error(f"Error fetching reports of {label}")
+            return [dict(day=label, margin=None, left=None, right=None, matched=None, breaks=None,
+                         error="Error fetching reports")]
+        
+        rows = []
+        for margin, items in reports.items():
+            for left, right in pairs:
+                row = dict(day=label, margin=margin, left=left, right=right, matched=None, breaks=None, error=None)
+                
+                result = reconcile_reports(items[left], items[right], report_config['cols_to_check'],
+                                           engine, report_config.get('matching'))
+                if result is None:
+                    row["error"] = "Error processing reports"
+                    sink.record_error(f"Error checking {items[left].name} and {items[right].name} of {label}")
+                else:
+                    row["matched"] = count_items(result[0])
+                    row["breaks"] = count_items(result[1])
+                    report_breaks(items[left].name, items[right].name, result[1], sink, margin)
+                
+                rows.append(row)
+        
+        return rows
+    finally:
+        if own_sink:
+            sink.close()
+
+def write_summary(summary, path):
+    """writes the consolidated summary as CSV, or as JSON if path ends with .json
+    
+    """
+    
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(summary.to_dict(orient="records"), f, indent=2, default=str)
+    else:
+        summary.to_csv(path, index=False)
+
+def backfill(start, end, workers=None, summary_path=None, overrides=None):
+    """reconciles every day of a date range in a process pool
+
+    Args:
+        start (string): first run day as YYYY-MM-DD
+        end (string): last run day as YYYY-MM-DD
+        workers (int, optional): number of days reconciled concurrently. Defaults to PARALLEL['workers']
+        summary_path (string, optional): consolidated summary file
+        overrides (dict, optional): report configuration entries to override
+
+    Returns:
+        DataFrame: one row per day, margin class and report pair, None if the
+                   database cannot be shared with the worker processes
+    """
+    
+    if in_memory():
+        print("Error at backfill: an in-memory SQLite database is not shared with worker processes, set STORAGE_PATH")
+        return None
+    
+    workers = workers or PARALLEL['workers']
+    days = day_range(start, end)
+    started = time.perf_counter()
+    
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = [(day, executor.submit(reconcile_day, day, overrides)) for day in days]
+        
+        for day, future in futures:
+            try:
+                rows.extend(future.result())
+            except Exception as e:
+                rows.append(dict(day=day.strftime("%Y-%m-%d"), margin=None, left=None, right=None,
+                                 matched=None, breaks=None, error=str(e)))
+    
+    summary = pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+    
+    if summary_path:
+        write_summary(summary, summary_path)
+    
+    failed = summary["error"].notna().sum()
+    print(f"Backfilled {len(days)} day(s) in {time.perf_counter() - started:.1f}s: "
+          f"{int(summary['breaks'].fillna(0).sum())} breaks, {failed} failed check(s)")
+    
+    return summary
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile a range of run days")
+    parser.add_argument("start", help="first run day, YYYY-MM-DD")
+    parser.add_argument("end", help="last run day, YYYY-MM-DD")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--summary", default="backfill_summary.csv")
+    parser.add_argument("--engine", choices=["pandas", "sql", "streaming"], default=None)
+    parser.add_argument("--matching", choices=["merge", "counted", "tolerance"], default=None)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    overrides = {key: value for key, value in [("engine", args.engine), ("matching", args.matching)] if value}
+    backfill(args.start, args.end, args.workers, args.summary, overrides)
@@ -0,0 +1,243 @@
+"""On-disk columnar cache for fetched report frames
+
+Frames are stored per (table, date, time_of_day, margin_type) as Parquet files (or
+pickles if pyarrow is not installed). An entry is only served while the fingerprint
+of its slice, row count plus max(id), is unchanged, so reloads invalidate it. The
+cache is bounded by CACHE['max_mb'] and evicts the least recently used entries.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+from config.settings import CACHE
+from .db_utils import text_with_lists
+
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+def slice_fingerprints(connection, table, margins, date, time_of_day=None):
+    """cheap fingerprint of every margin class of a report slice
+
+    Returns:
+        dict: margin class as key, [row count, max(id)] as value
+    """
+    
+    query = (f"SELECT margin_type, COUNT(*), MAX(id) "
+             f"FROM {table} "
+             f"WHERE margin_type = ANY(:margins) "
+             f"AND date = :date")
+    params = {"margins": list(margins), "date": date}
+    
+    if time_of_day is not None:
+        query += " AND time_of_day = :time_of_day"
+        params["time_of_day"] = time_of_day
+    
+    query = text_with_lists(query + " GROUP BY margin_type", ["margins"], connection.dialect.name)
+    rows = connection.execute(query, params).fetchall()
+    
+    fingerprints = {margin: [0, None] for margin in margins}
+    for margin, count, max_id in rows:
+        fingerprints[margin] = [int(count), None if max_id is None else int(max_id)]
+    
+    return fingerprints
+
+class ReportCache:
+    """LRU cache of report frames on disk
+
+    Every entry has its own metadata file next to its frame, so processes sharing the
+    directory (e.g. the backfill pool) never rewrite a common index. Files are written
+    under a name unique to the process and thread and renamed into place, and any
+    cache I/O error counts as a miss instead of failing the fetch.
+
+    Args:
+        directory (string, optional): cache directory. Defaults to CACHE['directory']
+        max_mb (int, optional): size cap of all cached files. Defaults to CACHE['max_mb']
+        file_format (string, optional): "parquet" or "pickle". Defaults to CACHE['format'],
+            falls back to "pickle" without pyarrow
+    """
+    
+    def __init__(self, directory=None, max_mb=None, file_format=None):
+        self.directory = directory or CACHE['directory']
+        self.max_bytes = (max_mb or CACHE['max_mb']) * 1024 * 1024
+        self.file_format = file_format or CACHE['format']
+        if self.file_format == "parquet" and not PARQUET_AVAILABLE:
+            self.file_format = "pickle"
+        
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        
+        os.makedirs(self.directory, exist_ok=True)
+    
+    @staticmethod
+    def entry_id(key):
+        return hashlib.sha1(json.dumps([str(part) for part in key]).encode()).hexdigest()
+    
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+    
+    def _replace(self, name, write):
+        """writes a file through a temporary name unique to this process and thread
+        
+        """
+        
+        temporary = self._path(f"{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            write(temporary)
+            os.replace(temporary, self._path(name))
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+    
+    def _load_entry(self, entry_id):
+        try:
+            with open(self._path(f"{entry_id}.json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _save_entry(self, entry_id, entry):
+        def write(path):
+            with open(path, "w") as f:
+                json.dump(entry, f)
+        
+        self._replace(f"{entry_id}.json", write)
+    
+    def _entries(self):
+        entries = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                entry = self._load_entry(name[:-5])
+                if entry is not None:
+                    entries[name[:-5]] = entry
+        return entries
+    
+    def _remove(self, entry_id, entry=None):
+        entry = entry or self._load_entry(entry_id)
+        names = [f"{entry_id}.json"] + ([entry["file"]] if entry else [])
+        for name in names:
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                pass
+    
+    def get(self, key, fingerprint):
+        """returns the cached frame of key if its fingerprint is unchanged
+
+        Args:
+            key (tuple): (table, date, time_of_day, margin_type)
+            fingerprint (list): [row count, max(id)] of the slice
+
+        Returns:
+            DataFrame: cached frame, None on a miss
+        """
+        
+        entry_id = self.entry_id(key)
+        
+        with self._lock:
+            entry = self._load_entry(entry_id)
+            
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if entry["fingerprint"] != list(fingerprint):
+                self.stats["stale"] += 1
+                self.stats["misses"] += 1
+                self._remove(entry_id, entry)
+                return None
+            
+            try:
+                path = self._path(entry["file"])
+                if entry["file"].endswith(".parquet"):
+                    df = pd.read_parquet(path)
+                else:
+                    df = pd.read_pickle(path)
+                
+                entry["last_access"] = time.time()
+                self._save_entry(entry_id, entry)
+            except (OSError, ValueError) as e:
+                print(f"Error reading cached report: {e}")
+                self.stats["misses"] += 1
+                self._remove(entry_id, entry)
+                return None
+            
+            self.stats["hits"] += 1
+        
+        return df
+    
+    def put(self, key, fingerprint, df):
+        """stores a frame and evicts least recently used entries above the size cap
+        
+        """
+        
+        entry_id = self.entry_id(key)
+        extension = "parquet" if self.file_format == "parquet" else "pkl"
+        file_name = f"{entry_id}.{extension}"
+        
+        with self._lock:
+            try:
+                if extension == "parquet":
+                    self._replace(file_name, lambda path: df.to_parquet(path, index=False))
+                else:
+                    self._replace(file_name, df.to_pickle)
+                
+                self._save_entry(entry_id, {
+                    "key": [str(part) for part in key],
+                    "fingerprint": list(fingerprint),
+                    "file": file_name,
+                    "bytes": os.path.getsize(self._path(file_name)),
+                    "last_access": time.time(),
+                })
+                self._evict()
+            except Exception as e:
+                print(f"Error writing cached report: {e}")
+    
+    def _evict(self):
+        entries = self._entries()
+        total = sum(entry["bytes"] for entry in entries.values())
+        
+        for entry_id, entry in sorted(entries.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            total -= entry["bytes"]
+            self._remove(entry_id, entry)
+            self.stats["evictions"] += 1
+    
+    def size(self):
+        with self._lock:
+            try:
+                return sum(entry["bytes"] for entry in self._entries().values())
+            except OSError:
+                return 0
+
+_report_cache = None
+_report_cache_lock = threading.Lock()
+
+def report_cache():
+    """returns the process-wide report cache, None if CACHE['enabled'] is off
+    
+    """
+    
+    global _report_cache
+    
+    if not CACHE['enabled']:
+        return None
+    
+    with _report_cache_lock:
+        if _report_cache is None:
+            _report_cache = ReportCache()
+    
+    return _report_cache
+
+def cache_stats():
+    cache = report_cache()
+    if cache is None:
+        return None
+    return dict(cache.stats, bytes=cache.size())
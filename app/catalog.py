@@ -0,0 +1,134 @@
+"""Symbolic snapshot lookup through the snapshot catalog
+
+Reports may name their snapshot instead of a fixed time of day: "first" and "last"
+resolve to the earliest and latest loaded ci050 snapshot of the date and "latest:N"
+expands a report into its N most recent snapshots, newest first. The lookup reads
+the primary key of snapshot_catalog, which is maintained on load (see
+record_snapshots), instead of scanning the report tables.
+
+Until the catalog has been filled for a table (see refresh_catalog), a report with a
+"fallback_time_of_day" uses that fixed time instead of failing, so deployments which
+predate the catalog keep running.
+"""
+
+from config.settings import DATABASE
+from .db_utils import backend_sql, create_connection
+
+SNAPSHOT_SYMBOLS = ["first", "last", "latest"]
+
+def parse_snapshot(time_of_day):
+    """splits a symbolic time of day into its symbol and number of snapshots
+    
+    Returns:
+        tuple: symbol and count, None if time_of_day is a plain time
+    """
+    
+    if not isinstance(time_of_day, str):
+        return None
+    
+    symbol, _, count = time_of_day.partition(":")
+    if symbol not in SNAPSHOT_SYMBOLS:
+        return None
+    if symbol != "latest":
+        return symbol, 1
+    
+    return symbol, int(count) if count else 1
+
+def lookup_snapshots(table, date, symbol, count=1, database=DATABASE):
+    """reads the times of day of the first or latest snapshots of a date
+    
+    Args:
+        table (string): report table name
+        date (string): date of the report
+        symbol (string): "first", "last" or "latest"
+        count (int, optional): number of snapshots. Defaults to 1
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+    
+    Returns:
+        list: time_of_day strings, ordered from the requested end
+    """
+    
+    order = "ASC" if symbol == "first" else "DESC"
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    try:
+        cur.execute(backend_sql(
+            "SELECT time_of_day FROM snapshot_catalog "
+            "WHERE snapshot_table = %s AND date = %s AND row_count > 0 "
+            f"ORDER BY time_of_day {order} LIMIT %s", database),
+            (table, date, count))
+        return [row[0] for row in cur.fetchall()]
+    finally:
+        cur.close()
+        connection.close()
+
+def catalog_lists(table, database=DATABASE):
+    """True if the snapshot catalog holds any snapshot of the table
+    
+    """
+    
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    try:
+        cur.execute(backend_sql("SELECT 1 FROM snapshot_catalog WHERE snapshot_table = %s LIMIT 1", database), (table,))
+        return cur.fetchone() is not None
+    finally:
+        cur.close()
+        connection.close()
+
+def resolve_reports(report_config, database=DATABASE):
+    """replaces symbolic times of day in a report configuration by the loaded snapshots
+    
+    Reports with a plain time of day are kept as they are. A "latest:N" report is
+    expanded into N reports named <name>_1 (newest) to <name>_N.
+    
+    Args:
+        report_config (dict): report configuration setup
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+    
+    Raises:
+        Exception: if the catalog cannot be read, or holds no snapshot for a symbolic
+            report, unless it is empty for its table and the report has a fallback_time_of_day
+    
+    Returns:
+        dict: copy of the configuration with resolved reports, the configuration
+              itself if nothing is symbolic
+    """
+    
+    if not any(parse_snapshot(report.get('time_of_day')) for report in report_config['reports']):
+        return report_config
+    
+    reports = []
+    for report in report_config['reports']:
+        snapshot = parse_snapshot(report.get('time_of_day'))
+        if snapshot is None:
+            reports.append(report)
+            continue
+        
+        symbol, count = snapshot
+        fallback = report.get('fallback_time_of_day')
+        try:
+            times = lookup_snapshots(report['table'], report['date'], symbol, count, database)
+            # only an empty catalog falls back, a database error must not pick a fixed time
+            unfilled = not times and fallback is not None and not catalog_lists(report['table'], database)
+        except Exception as e:
+            raise Exception(f"Error resolving '{report['name']}' from snapshot_catalog: {e}")
+        if unfilled:
+            print(f"snapshot_catalog lists no {report['table']} snapshots, "
+                  f"'{report['name']}' falls back to {fallback}")
+            reports.append({**report, "time_of_day": fallback, "snapshot": report['time_of_day']})
+            continue
+        if not times:
+            raise Exception(f"No {report['table']} snapshot of {report['date']} in snapshot_catalog "
+                            f"for '{report['name']}' ({report['time_of_day']})")
+        
+        if symbol != "latest":
+            reports.append({**report, "time_of_day": times[0], "snapshot": symbol})
+            continue
+        for position, time_of_day in enumerate(times, start=1):
+            reports.append({**report, "name": f"{report['name']}_{position}",
+                            "time_of_day": time_of_day, "snapshot": report['time_of_day']})
+    
+    return {**report_config, "reports": reports}
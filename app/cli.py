@@ -0,0 +1,215 @@
+"""Command line entry point for the schema, loads, checks, reconciliation and benchmarks
+
+Every subcommand imports the modules it needs when it runs, so a short job does not
+pay for pandas, numpy and SQLAlchemy unless it uses them, and importing this module
+does not touch the database settings. `run` executes the stages in dependency order
+(init-schema, load, check-integrity, reconcile) and stops at the first one that fails.
+Startup, import and run times are printed per stage.
+
+Usage:
+    python -m app.cli run
+    python -m app.cli load ci050 feeds/ci050.ndjson.gz --commit-size 5000
+    python -m app.cli reconcile --date 2020-05-12 --engine sql
+    python -m app.cli bench --backend sqlite --snapshots 4
+"""
+
+import argparse
+import importlib
+import time
+
+from datetime import datetime
+
+STARTED = time.perf_counter()
+
+STAGES = ["init-schema", "load", "check-integrity", "reconcile"]
+
+_imports = {"seconds": 0.0}
+
+def lazy(name):
+    """imports a module on first use and adds the time spent to the import timer
+    
+    Returns:
+        module: the imported module
+    """
+    
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    _imports["seconds"] += time.perf_counter() - started
+    return module
+
+def init_schema(args):
+    db = lazy("app.db")
+    return db.create_tables() is not None
+
+def load(args):
+    """loads the feeds given as (table, path) pairs, the fixtures if there are none
+    
+    """
+    
+    feeds = getattr(args, "feeds", None) or ([(args.table, args.path)] if getattr(args, "table", None) else [])
+    
+    if not feeds:
+        return lazy("app.db").setup_module(args.commit_size) is not None
+    
+    loader = lazy("app.loader")
+    for table, path in feeds:
+        if table not in loader.TABLE_COLUMNS:
+            print(f"Unknown table '{table}', expected one of {', '.join(sorted(loader.TABLE_COLUMNS))}")
+            return False
+        if loader.load_feed(table, path, args.commit_size, args.method, args.feed_format) is None:
+            return False
+    
+    return True
+
+def check_integrity(args):
+    counts = lazy("app.db").check_integrity()
+    if counts is None:
+        return False
+    
+    print(", ".join(f"{table}: {count} rows" for table, count in counts.items()))
+    empty = [table for table, count in counts.items() if not count]
+    if empty and not args.allow_empty:
+        print(f"Error at database integrity check: {', '.join(empty)} empty")
+        return False
+    
+    return True
+
+def reconcile(args):
+    """reconciles a run day, fails if a report could not be fetched or a pair not checked
+    
+    """
+    
+    main = lazy("app.main")
+    
+    day = datetime.strptime(args.date, "%Y-%m-%d") if args.date else None
+    report_config = main.build_report_settings(main.create_dates(day))
+    overrides = [("engine", args.engine), ("matching", args.matching), ("workers", args.workers)]
+    report_config.update({key: value for key, value in overrides if value})
+    if args.parallel is not None:
+        report_config["parallel"] = args.parallel
+    
+    summary = main.main(report_config)
+    if summary is None:
+        return False
+    if summary["errors"]:
+        print(f"Error at reconcile: {len(summary['errors'])} report(s) could not be fetched or checked")
+        return False
+    
+    return True
+
+def bench(args):
+    report = lazy("benchmarks.run").main(args.bench_args)
+    return report is not None
+
+COMMANDS = {
+    "init-schema": init_schema,
+    "load": load,
+    "check-integrity": check_integrity,
+    "reconcile": reconcile,
+    "bench": bench,
+}
+
+def run_stage(name, args):
+    """runs one stage and prints its import and run time
+    
+    Returns:
+        bool: True if the stage succeeded
+    """
+    
+    imported = _imports["seconds"]
+    started = time.perf_counter()
+    
+    try:
+        ok = COMMANDS[name](args)
+    except Exception as e:
+        print(f"Error at {name}: {e}")
+        ok = False
+    
+    elapsed = time.perf_counter() - started
+    imports = _imports["seconds"] - imported
+    print(f"[{name}] {'ok' if ok else 'failed'} in {elapsed:.2f}s "
+          f"(imports {imports:.2f}s, run {elapsed - imports:.2f}s)")
+    
+    return ok
+
+def run(args):
+    """runs the stages in order, a stage only starts once the previous one succeeded
+    
+    Returns:
+        bool: True if every stage succeeded
+    """
+    
+    stages = [name for name in STAGES if name not in (args.skip or [])]
+    
+    for position, name in enumerate(stages):
+        if not run_stage(name, args):
+            skipped = stages[position + 1:]
+            if skipped:
+                print(f"Skipped {', '.join(skipped)}")
+            return False
+    
+    return True
+
+def add_load_options(parser):
+    parser.add_argument("--commit-size", type=int, default=None)
+    parser.add_argument("--method", choices=["copy", "insert"], default=None)
+    parser.add_argument("--format", dest="feed_format", choices=["ndjson", "csv", "json"], default=None,
+                        help="defaults to the file extension")
+
+def add_reconcile_options(parser):
+    parser.add_argument("--date", default=None, help="run day as YYYY-MM-DD, defaults to create_dates")
+    parser.add_argument("--engine", choices=["pandas", "sql", "streaming"], default=None)
+    parser.add_argument("--matching", choices=["merge", "counted", "tolerance"], default=None)
+    parser.add_argument("--parallel", action=argparse.BooleanOptionalAction, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.cli",
+                                     description="Load, check and reconcile the cc050/ci050 reports")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    commands.add_parser("init-schema", help="create the tables, indexes and partitions")
+    
+    load_parser = commands.add_parser("load", help="stream a feed file into a table")
+    load_parser.add_argument("table", help="cc050 or ci050")
+    load_parser.add_argument("path", help="feed file, optionally gzip compressed")
+    add_load_options(load_parser)
+    
+    check_parser = commands.add_parser("check-integrity", help="check the report tables and count their rows")
+    check_parser.add_argument("--allow-empty", action="store_true")
+    
+    reconcile_parser = commands.add_parser("reconcile", help="reconcile the reports of a run day")
+    add_reconcile_options(reconcile_parser)
+    
+    commands.add_parser("bench", help="run benchmarks.run, further options are passed on to it", add_help=False)
+    
+    run_parser = commands.add_parser("run", help=f"run {', '.join(STAGES)} in order")
+    run_parser.add_argument("--feed", dest="feeds", nargs=2, action="append", metavar=("TABLE", "PATH"),
+                            help="feed to load, the fixtures are loaded if none is given")
+    run_parser.add_argument("--skip", nargs="+", choices=STAGES, default=None)
+    run_parser.add_argument("--allow-empty", action="store_true")
+    add_load_options(run_parser)
+    add_reconcile_options(run_parser)
+    
+    args, extra = parser.parse_known_args(argv)
+    if args.command == "bench":
+        args.bench_args = extra
+    elif extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    print(f"Started in {time.perf_counter() - STARTED:.3f}s")
+    
+    if args.command == "run":
+        ok = run(args)
+    else:
+        ok = run_stage(args.command, args)
+    
+    print(f"Finished in {time.perf_counter() - STARTED:.2f}s, {_imports['seconds']:.2f}s importing")
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    raise SystemExit(main())
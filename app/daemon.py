@@ -0,0 +1,229 @@
+"""Event-driven reconciliation service
+
+The loader sends a notification per (table, date, time_of_day) on NOTIFY['channel']
+in its load transaction (see notify_snapshots), so it arrives once the rows are
+committed. The service collects notifications until the channel has been quiet for
+NOTIFY['debounce_seconds'] (or NOTIFY['max_delay_seconds'] passed since the first
+one) and then reconciles only the run days, report pairs and margin classes which
+use one of the loaded snapshots.
+
+Usage:
+    python -m app.daemon --engine sql
+"""
+
+import argparse
+import json
+import select
+import time
+
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from config.settings import DATABASE, NOTIFY
+from .backfill import reconcile_day
+from .catalog import resolve_reports
+from .db import maintain_partitions
+from .db_utils import backend, database_url
+from .main import REPORT_PAIRS, build_report_settings
+from .metrics import flush_metrics, print_summary
+from .sink import BreakSink
+from .utils import create_dates
+
+def collect_event(pending, payload):
+    """adds a notification payload to the pending slices
+    
+    Returns:
+        tuple: the slice key (table, date, time_of_day), None for malformed payloads
+    """
+    
+    try:
+        event = json.loads(payload)
+        key = (event["table"], event["date"], event.get("time_of_day") or "")
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Ignoring notification {payload!r}: {e}")
+        return None
+    
+    pending.setdefault(key, set()).update(event.get("margin_types", []))
+    return key
+
+def affected_days(table, date):
+    """lists the run days whose reports may use a snapshot of table and date
+    
+    A run day compares the cc050 and the last ci050 snapshot of the previous day with
+    the first ci050 snapshot of the day itself, see build_report_settings.
+    
+    Returns:
+        list: run days as datetime
+    """
+    
+    day = datetime.strptime(date, "%Y-%m-%d")
+    following = day + timedelta(days=1)
+    
+    return [day, following] if table == "ci050" else [following]
+
+def slice_key(report):
+    return (report['table'], report['date'], report.get('time_of_day') or "")
+
+def plan_runs(pending):
+    """works out the reconciliations needed for the pending slices
+    
+    Symbolic snapshots are resolved first, so an intraday ci050 snapshot only
+    triggers a run once it is the first or last snapshot of its date.
+    
+    Args:
+        pending (dict): margin classes per (table, date, time_of_day)
+    
+    Returns:
+        list: (run day, margin classes, report pairs) per run
+    """
+    
+    days = sorted({day for table, date, _ in pending for day in affected_days(table, date)})
+    
+    plans = []
+    for day in days:
+        try:
+            report_config = resolve_reports(build_report_settings(create_dates(day)))
+        except Exception as e:
+            print(f"Skipping run day {day:%Y-%m-%d}: {e}")
+            continue
+        
+        touched = {}
+        for report in report_config['reports']:
+            if slice_key(report) in pending:
+                touched[report['name']] = pending[slice_key(report)]
+        if not touched:
+            continue
+        
+        loaded = set().union(*touched.values())
+        margins = [margin for margin in report_config['margin_classes'] if margin in loaded]
+        pairs = [pair for pair in REPORT_PAIRS if touched.keys() & set(pair)]
+        if margins and pairs:
+            plans.append((day, margins, pairs))
+    
+    return plans
+
+def run_pending(pending, overrides=None):
+    """reconciles the pending slices and prints a line per margin class and report pair.
+       The date partitions are rolled forward first, see maintain_partitions. The breaks
+       of the batch go to one BreakSink, its stage metrics are printed and flushed
+       afterwards, so they do not pile up over the lifetime of the service
+    
+    Returns:
+        list: summary dicts, see reconcile_day
+    """
+    
+    maintain_partitions()
+    
+    rows = []
+    sink = BreakSink()
+    try:
+        for day, margins, pairs in plan_runs(pending):
+            started = time.perf_counter()
+            result = reconcile_day(day, {**(overrides or {}), "margin_classes": margins}, pairs, sink)
+            
+            for row in result:
+                status = row["error"] or f"{row['matched']} matched, {row['breaks']} breaks"
+                print(f"{row['day']} {row['margin']} {row['left']} vs {row['right']}: {status}")
+            print(f"Reconciled {len(margins)} margin class(es) of {day:%Y-%m-%d} "
+                  f"in {time.perf_counter() - started:.1f}s")
+            rows.extend(result)
+    finally:
+        sink.close()
+        if rows:
+            print_summary()
+        flush_metrics()
+    
+    return rows
+
+def wait_time(first_event, last_event, now, debounce=None, max_delay=None):
+    """seconds until the pending slices are due, 0 if they are due already
+    
+    """
+    
+    debounce = NOTIFY['debounce_seconds'] if debounce is None else debounce
+    max_delay = NOTIFY['max_delay_seconds'] if max_delay is None else max_delay
+    
+    return max(0.0, min(last_event + debounce, first_event + max_delay) - now)
+
+def listen(channel=None, overrides=None, pending=None, database=DATABASE):
+    """listens on the notification channel and reconciles the loaded slices until interrupted
+    
+    Args:
+        channel (string, optional): notification channel. Defaults to NOTIFY['channel']
+        overrides (dict, optional): report configuration entries to override, e.g. engine
+        pending (dict, optional): slices collected before a reconnect, see collect_event
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+    """
+    
+    channel = channel or NOTIFY['channel']
+    pending = {} if pending is None else pending
+    
+    # LISTEN needs a dedicated autocommit connection, it must not go back to the pool
+    connection = psycopg2.connect(database_url(database))
+    connection.autocommit = True
+    
+    first_event = last_event = time.monotonic()
+    
+    try:
+        with connection.cursor() as cur:
+            cur.execute(f"LISTEN {channel}")
+        print(f"Listening on '{channel}'")
+        
+        while True:
+            timeout = wait_time(first_event, last_event, time.monotonic()) if pending else None
+            
+            if select.select([connection], [], [], timeout)[0]:
+                connection.poll()
+                while connection.notifies:
+                    was_idle = not pending
+                    if collect_event(pending, connection.notifies.pop(0).payload) is None:
+                        continue
+                    last_event = time.monotonic()
+                    if was_idle:
+                        first_event = last_event
+                continue
+            
+            if pending:
+                run_pending(pending, overrides)
+                pending.clear()
+    finally:
+        connection.close()
+
+def serve(channel=None, overrides=None, database=DATABASE):
+    """runs listen and reconnects after NOTIFY['reconnect_seconds'] if the connection is
+       lost. Slices collected so far are kept, loads committed while disconnected are
+       not seen. The embedded SQLite backend has no LISTEN/NOTIFY, so the service
+       refuses to start on it
+    
+    Returns:
+        bool: True once stopped, False if the backend cannot notify
+    """
+    
+    if backend(database) != "postgres":
+        print(f"Error at daemon: the {backend(database)} backend sends no load notifications, "
+              "run the service against Postgres or reconcile with python -m app.cli reconcile")
+        return False
+    
+    pending = {}
+    while True:
+        try:
+            listen(channel, overrides, pending, database)
+        except psycopg2.Error as e:
+            print(f"Error listening for loads: {e}")
+            time.sleep(NOTIFY['reconnect_seconds'])
+        except KeyboardInterrupt:
+            print("Stopped listening")
+            return True
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile report slices as soon as they are loaded")
+    parser.add_argument("--channel", default=None)
+    parser.add_argument("--engine", choices=["pandas", "sql", "streaming"], default=None)
+    parser.add_argument("--matching", choices=["merge", "counted", "tolerance"], default=None)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    overrides = {key: value for key, value in [("engine", args.engine), ("matching", args.matching)] if value}
+    raise SystemExit(0 if serve(args.channel, overrides) else 1)
@@ -1,15 +1,21 @@
+import argparse
+import os
 import psycopg2
 
+from datetime import date, datetime, timedelta
+
 from .db_utils import *
+from .ingest import ingest_feed
 
-from config.settings import DATABASE
+from config.settings import CATALOG, DATABASE, PARTITIONING, SCHEMA
 
-def create_tables(database=DATABASE):
-    """ creates predefined tables with schema to the Postgres Database
-    
-    """
-    
-    commands = [
+TABLE_COLUMNS = {
+    "cc050": ["date", "clearing_member", "account", "margin_type", "margin"],
+    "ci050": ["date", "time_of_day", "clearing_member", "account", "margin_type", "margin"],
+}
+
+TABLE_COMMANDS = {
+    1: [
     """
         CREATE TABLE IF NOT EXISTS cc050 (
             id SERIAL PRIMARY KEY,
@@ -31,49 +37,783 @@ def create_tables(database=DATABASE):
             margin VARCHAR(255) NOT NULL
         )
     """
-    ]
+    ],
+    2: [
+    """
+        CREATE TABLE IF NOT EXISTS cc050 (
+            id SERIAL PRIMARY KEY,
+            date DATE NOT NULL,
+            clearing_member VARCHAR(64) NOT NULL,
+            account VARCHAR(64) NOT NULL,
+            margin_type VARCHAR(16) NOT NULL,
+            margin NUMERIC NOT NULL
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS ci050 (
+            id SERIAL PRIMARY KEY,
+            date DATE NOT NULL,
+            time_of_day TIME NOT NULL,
+            clearing_member VARCHAR(64) NOT NULL,
+            account VARCHAR(64) NOT NULL,
+            margin_type VARCHAR(16) NOT NULL,
+            margin NUMERIC NOT NULL
+        )
+    """
+    ],
+}
+
+PARTITIONED_COMMANDS = [
+    """
+        CREATE TABLE IF NOT EXISTS cc050 (
+            id SERIAL,
+            date DATE NOT NULL,
+            clearing_member VARCHAR(64) NOT NULL,
+            account VARCHAR(64) NOT NULL,
+            margin_type VARCHAR(16) NOT NULL,
+            margin NUMERIC NOT NULL,
+            PRIMARY KEY (id, date)
+        ) PARTITION BY RANGE (date)
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS ci050 (
+            id SERIAL,
+            date DATE NOT NULL,
+            time_of_day TIME NOT NULL,
+            clearing_member VARCHAR(64) NOT NULL,
+            account VARCHAR(64) NOT NULL,
+            margin_type VARCHAR(16) NOT NULL,
+            margin NUMERIC NOT NULL,
+            PRIMARY KEY (id, date)
+        ) PARTITION BY RANGE (date)
+    """,
+    "CREATE TABLE IF NOT EXISTS cc050_default PARTITION OF cc050 DEFAULT",
+    "CREATE TABLE IF NOT EXISTS ci050_default PARTITION OF ci050 DEFAULT",
+]
+
+PARTITION_FORMATS = {
+    "day": "%Y%m%d",
+    "month": "%Y%m",
+}
+
+STATE_COMMANDS = [
+    """
+        CREATE TABLE IF NOT EXISTS recon_state (
+            snapshot_table VARCHAR(16) NOT NULL,
+            date VARCHAR(10) NOT NULL,
+            time_of_day VARCHAR(8) NOT NULL,
+            reference VARCHAR(64) NOT NULL,
+            matched INTEGER NOT NULL,
+            breaks INTEGER NOT NULL,
+            opened INTEGER NOT NULL,
+            resolved INTEGER NOT NULL,
+            reconciled_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (snapshot_table, date, time_of_day, reference)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS recon_state_breaks (
+            snapshot_table VARCHAR(16) NOT NULL,
+            date VARCHAR(10) NOT NULL,
+            time_of_day VARCHAR(8) NOT NULL,
+            reference VARCHAR(64) NOT NULL,
+            clearing_member VARCHAR(64) NOT NULL,
+            account VARCHAR(64) NOT NULL,
+            margin_type VARCHAR(16) NOT NULL,
+            margin DOUBLE PRECISION,
+            category VARCHAR(16) NOT NULL,
+            multiplicity INTEGER NOT NULL
+        )
+    """,
+    """
+        CREATE INDEX IF NOT EXISTS recon_state_breaks_snapshot_idx
+        ON recon_state_breaks (snapshot_table, date, reference, time_of_day)
+    """,
+]
+
+CATALOG_COMMANDS = [
+    """
+        CREATE TABLE IF NOT EXISTS snapshot_catalog (
+            snapshot_table VARCHAR(16) NOT NULL,
+            date VARCHAR(10) NOT NULL,
+            time_of_day VARCHAR(8) NOT NULL DEFAULT '',
+            row_count INTEGER NOT NULL,
+            loaded_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (snapshot_table, date, time_of_day)
+        )
+    """,
+]
+
+BREAK_COMMANDS = [
+    """
+        CREATE TABLE IF NOT EXISTS recon_breaks (
+            run_id VARCHAR(32) NOT NULL,
+            left_report VARCHAR(64) NOT NULL,
+            right_report VARCHAR(64) NOT NULL,
+            margin_class VARCHAR(16),
+            clearing_member VARCHAR(64),
+            account VARCHAR(64),
+            margin_type VARCHAR(16),
+            margin DOUBLE PRECISION,
+            difference DOUBLE PRECISION,
+            category VARCHAR(16) NOT NULL,
+            multiplicity INTEGER NOT NULL,
+            source VARCHAR(128)
+        )
+    """,
+    """
+        CREATE INDEX IF NOT EXISTS recon_breaks_run_idx
+        ON recon_breaks (run_id, category)
+    """,
+]
+
+LOG_COMMANDS = [
+    """
+        CREATE TABLE IF NOT EXISTS query_log (
+            id SERIAL PRIMARY KEY,
+            logged_at TIMESTAMP NOT NULL,
+            statement TEXT NOT NULL,
+            params TEXT,
+            duration_ms DOUBLE PRECISION NOT NULL,
+            row_count INTEGER,
+            plan TEXT
+        )
+    """,
+]
+
+INDEX_COMMANDS = [
+    "CREATE INDEX {concurrently}IF NOT EXISTS cc050_date_margin_type_idx ON cc050 (date, margin_type)",
+    "CREATE INDEX {concurrently}IF NOT EXISTS ci050_date_margin_type_idx ON ci050 (date, margin_type)",
+    "CREATE INDEX {concurrently}IF NOT EXISTS ci050_date_time_margin_type_idx ON ci050 (date, time_of_day, margin_type)",
+]
+
+SQLITE_DDL = [
+    ("SERIAL PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    ("DEFAULT now()", "DEFAULT CURRENT_TIMESTAMP"),
+]
+
+COLUMN_TYPES = {
+    "date": ("DATE", "date::date"),
+    "time_of_day": ("TIME", "time_of_day::time"),
+    "clearing_member": ("VARCHAR(64)", "clearing_member"),
+    "account": ("VARCHAR(64)", "account"),
+    "margin_type": ("VARCHAR(16)", "margin_type"),
+    "margin": ("NUMERIC", "margin::numeric"),
+}
+
+def sqlite_ddl(command):
+    for postgres, sqlite in SQLITE_DDL:
+        command = command.replace(postgres, sqlite)
+    return command
+
+def create_tables(database=DATABASE, version=None, partitioned=None):
+    """ creates predefined tables with schema to the Postgres Database, or the
+        embedded SQLite database
+    
+    Args:
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+        version (int, optional): schema version, 1 is the untyped VARCHAR layout, 2 the
+            typed and indexed layout. Defaults to SCHEMA['version']
+        partitioned (bool, optional): range partition cc050/ci050 by date, only for
+            version 2 on Postgres. Defaults to PARTITIONING['enabled']
+    """
+    
+    version = version or SCHEMA['version']
+    partitioned = PARTITIONING['enabled'] if partitioned is None else partitioned
+    partitioned = partitioned and version >= 2 and backend(database) == "postgres"
+    commands = list(PARTITIONED_COMMANDS if partitioned else TABLE_COMMANDS[version])
+    if version >= 2:
+        commands += [command.format(concurrently="") for command in INDEX_COMMANDS]
+    support_commands = STATE_COMMANDS + CATALOG_COMMANDS + BREAK_COMMANDS + LOG_COMMANDS
+    if backend(database) == "sqlite":
+        commands = [sqlite_ddl(command) for command in commands]
+        support_commands = [sqlite_ddl(command) for command in support_commands]
     
     connection = create_connection(database)
     cur = connection.cursor()
+    convert = False
         
     try:
-        for command in commands:
+        # existing plain tables cannot take partitions, partition_tables converts them
+        if partitioned:
+            convert = any(table_kind(cur, table) == "r" for table in TABLE_COLUMNS)
+        for command in (support_commands if convert else commands + support_commands):
             cur.execute(command)
             
         connection.commit()
         
-    except psycopg2.Error as e:
+    except Exception as e:
         print(f"Error creating tables: {e}")
+        connection.rollback()
+        return None
+    finally:
+        cur.close()
+        connection.close()
+    
+    if convert and not partition_tables(database):
+        return None
+    if partitioned and not convert:
+        create_partitions(database=database)
+    
+    backfill_catalog(database)
+    return True
+
+def partition_start(day, interval=None):
+    """returns the first day of the partition the given day belongs to
+
+    Args:
+        day (date): any day
+        interval (string, optional): "day" or "month". Defaults to PARTITIONING['interval']
+
+    Returns:
+        date: lower bound of the partition
+    """
+    
+    interval = interval or PARTITIONING['interval']
+    
+    return day.replace(day=1) if interval == "month" else day
+
+def partition_ranges(start, end, interval=None):
+    """lists the partitions needed to cover the days from start to end, both inclusive
+
+    Args:
+        start (date): first day
+        end (date): last day
+        interval (string, optional): "day" or "month". Defaults to PARTITIONING['interval']
+
+    Returns:
+        list: (lower, upper) tuple per partition, upper is exclusive
+    """
+    
+    interval = interval or PARTITIONING['interval']
+    lower = partition_start(start, interval)
+    
+    ranges = []
+    while lower <= end:
+        if interval == "month":
+            upper = (lower + timedelta(days=32)).replace(day=1)
+        else:
+            upper = lower + timedelta(days=1)
+        ranges.append((lower, upper))
+        lower = upper
+    
+    return ranges
+
+def partition_name(table, lower, interval=None):
+    interval = interval or PARTITIONING['interval']
+    return f"{table}_p{lower.strftime(PARTITION_FORMATS[interval])}"
+
+def parse_partition_name(table, name, interval=None):
+    """inverse of partition_name
+
+    Returns:
+        date: lower bound of the partition, None for the default partition or foreign names
+    """
+    
+    interval = interval or PARTITIONING['interval']
+    
+    try:
+        return datetime.strptime(name[len(f"{table}_p"):], PARTITION_FORMATS[interval]).date()
+    except ValueError:
+        return None
+
+def table_kind(cur, table):
+    # pg_class.relkind: "r" for plain tables, "p" for partitioned ones, None if missing
+    cur.execute("SELECT relkind FROM pg_class WHERE relname = %s", (table,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def is_partitioned(cur, table):
+    return table_kind(cur, table) == "p"
+
+def list_partitions(cur, table):
+    """lists the partitions currently attached to a partitioned table
+
+    Returns:
+        list: partition table names
+    """
+    
+    cur.execute(
+        "SELECT child.relname "
+        "FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = %s "
+        "ORDER BY child.relname",
+        (table,))
+    
+    return [row[0] for row in cur.fetchall()]
+
+def partition_commands(table, start, end, interval=None):
+    return [
+        f"CREATE TABLE IF NOT EXISTS {partition_name(table, lower, interval)} "
+        f"PARTITION OF {table} FOR VALUES FROM ('{lower}') TO ('{upper}')"
+        for lower, upper in partition_ranges(start, end, interval)]
+
+def add_partition(cur, table, lower, upper, interval=None):
+    """creates one partition. Rows of its range which went to the default partition
+       in the meantime are moved into it, Postgres refuses the partition otherwise
+
+    Returns:
+        int: number of rows moved out of the default partition
+    """
+    
+    name = partition_name(table, lower, interval)
+    default = f"{table}_default"
+    bounds = (lower, upper)
+    
+    moved = 0
+    if table_kind(cur, default) is not None:
+        cur.execute(f"SELECT count(*) FROM {default} WHERE date >= %s AND date < %s", bounds)
+        moved = cur.fetchone()[0]
+    
+    if moved:
+        cur.execute(f"CREATE TEMPORARY TABLE {name}_moving ON COMMIT DROP AS "
+                    f"SELECT * FROM {default} WHERE date >= %s AND date < %s", bounds)
+        cur.execute(f"DELETE FROM {default} WHERE date >= %s AND date < %s", bounds)
+    
+    cur.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM ('{lower}') TO ('{upper}')")
+    
+    if moved:
+        cur.execute(f"INSERT INTO {table} SELECT * FROM {name}_moving")
+        print(f"Moved {moved} rows of {table} from the default partition into {name}")
+    
+    return moved
+
+def create_partitions(start=None, premake=None, database=DATABASE):
+    """creates the partitions from start up to PARTITIONING['premake'] intervals ahead of
+       today, existing partitions are left untouched so it can run on a schedule
+
+    Args:
+        start (date, optional): first day to cover. Defaults to today
+        premake (int, optional): number of days or months to create ahead. Defaults to PARTITIONING['premake']
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        list: names of the partitions covering the range, None on error
+    """
+    
+    interval = PARTITIONING['interval']
+    premake = PARTITIONING['premake'] if premake is None else premake
+    today = date.today()
+    start = start or today
+    end = today + timedelta(days=premake * (31 if interval == "month" else 1))
+    
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    try:
+        cur.execute(f"SET lock_timeout = '{SCHEMA['lock_timeout']}'")
+        for table in TABLE_COLUMNS:
+            existing = set(list_partitions(cur, table))
+            for lower, upper in partition_ranges(start, end, interval):
+                if partition_name(table, lower, interval) not in existing:
+                    add_partition(cur, table, lower, upper, interval)
+        connection.commit()
+    except psycopg2.Error as e:
+        print(f"Error creating partitions: {e}")
+        connection.rollback()
+        return None
+    finally:
+        cur.close()
+        connection.close()
+    
+    return [partition_name(table, lower, interval)
+            for table in TABLE_COLUMNS
+            for lower, _ in partition_ranges(start, end, interval)]
+
+def maintain_partitions(database=DATABASE):
+    """rolls the partitions forward to PARTITIONING['premake'] intervals ahead of today,
+       run before every load and daemon batch so new days do not pile up in the default
+       partition. Does nothing unless partitioning is enabled and the tables are partitioned
+
+    Returns:
+        list: names of the partitions covering the range, empty if there is nothing to
+              maintain, None on error
+    """
+    
+    if not PARTITIONING['enabled'] or backend(database) != "postgres":
+        return []
+    
+    connection = create_connection(database)
+    cur = connection.cursor()
+    try:
+        partitioned = all(is_partitioned(cur, table) for table in TABLE_COLUMNS)
+    except psycopg2.Error as e:
+        print(f"Error checking partitions: {e}")
+        return None
+    finally:
+        cur.close()
+        connection.close()
+    
+    return create_partitions(database=database) if partitioned else []
+
+def expired_partitions(table, partitions, keep_days=None, today=None, interval=None):
+    """selects the partitions whose whole range is older than the retention period
+
+    Args:
+        table (string): parent table name
+        partitions (list): partition names as returned by list_partitions
+        keep_days (int, optional): days of history to keep. Defaults to PARTITIONING['retention_days']
+        today (date, optional): reference day. Defaults to today
+
+    Returns:
+        list: partition names, the default partition is never expired
+    """
+    
+    interval = interval or PARTITIONING['interval']
+    keep_days = PARTITIONING['retention_days'] if keep_days is None else keep_days
+    cutoff = (today or date.today()) - timedelta(days=keep_days)
+    
+    expired = []
+    for name in partitions:
+        lower = parse_partition_name(table, name, interval)
+        if lower is None:
+            continue
+        upper = partition_ranges(lower, lower, interval)[0][1]
+        if upper <= cutoff:
+            expired.append(name)
+    
+    return expired
+
+def apply_retention(keep_days=None, mode=None, today=None, database=DATABASE):
+    """detaches, and with mode "drop" also drops, the partitions older than the
+       retention period. Detached partitions stay as plain tables for archiving, their
+       days are removed from the snapshot catalog either way
+
+    Args:
+        keep_days (int, optional): days of history to keep. Defaults to PARTITIONING['retention_days']
+        mode (string, optional): "detach" or "drop". Defaults to PARTITIONING['retention_mode']
+        today (date, optional): reference day. Defaults to today
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        list: names of the partitions removed from the tables, None on error
+    """
+    
+    mode = mode or PARTITIONING['retention_mode']
+    
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    interval = PARTITIONING['interval']
+    
+    removed = []
+    try:
+        cur.execute(f"SET lock_timeout = '{SCHEMA['lock_timeout']}'")
+        catalog = table_kind(cur, "snapshot_catalog") is not None
+        for table in TABLE_COLUMNS:
+            if not is_partitioned(cur, table):
+                continue
+            for name in expired_partitions(table, list_partitions(cur, table), keep_days, today, interval):
+                cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+                if mode == "drop":
+                    cur.execute(f"DROP TABLE {name}")
+                if catalog:
+                    lower = parse_partition_name(table, name, interval)
+                    upper = partition_ranges(lower, lower, interval)[0][1]
+                    cur.execute(
+                        "DELETE FROM snapshot_catalog WHERE snapshot_table = %s AND date >= %s AND date < %s",
+                        (table, lower.isoformat(), upper.isoformat()))
+                removed.append(name)
+        connection.commit()
+    except psycopg2.Error as e:
+        print(f"Error applying retention: {e}")
+        connection.rollback()
+        return None
+    finally:
+        cur.close()
+        connection.close()
+    
+    print(f"{'Dropped' if mode == 'drop' else 'Detached'} {len(removed)} partitions")
+    return removed
+
+def partition_tables(database=DATABASE):
+    """converts unpartitioned cc050/ci050 tables into date partitioned ones
+
+    Each table is renamed, recreated as a partitioned table with partitions covering
+    its history, refilled (casting VARCHAR columns like migrate_tables does) and the
+    old table is dropped, all in one transaction. The rename takes an ACCESS EXCLUSIVE
+    lock, so the copy blocks readers and writers of that table until it commits.
+    Tables which are already partitioned are skipped, missing ones are created.
+
+    Returns:
+        bool: True if the migration succeeded, None otherwise
+    """
+    
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    try:
+        cur.execute(f"SET lock_timeout = '{SCHEMA['lock_timeout']}'")
+        
+        for table, command in zip(TABLE_COLUMNS, PARTITIONED_COMMANDS):
+            kind = table_kind(cur, table)
+            if kind == "p":
+                continue
+            if kind is None:
+                cur.execute(command)
+                cur.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+                continue
+            
+            columns = TABLE_COLUMNS[table]
+            legacy = f"{table}_unpartitioned"
+            cur.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+            cur.execute(f"SELECT min({COLUMN_TYPES['date'][1]}), max({COLUMN_TYPES['date'][1]}) FROM {legacy}")
+            first, last = cur.fetchone()
+            partitions = partition_commands(table, first or date.today(), last or date.today())
+            
+            cur.execute(command)
+            cur.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+            for partition in partitions:
+                cur.execute(partition)
+            
+            cur.execute(
+                f"INSERT INTO {table} (id, {', '.join(columns)}) "
+                f"SELECT id, {', '.join(COLUMN_TYPES[column][1] for column in columns)} FROM {legacy}")
+            cur.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"(SELECT coalesce(max(id), 0) + 1 FROM {table}), false)")
+            # dropping the old table frees its index names for the partitioned indexes
+            cur.execute(f"DROP TABLE {legacy}")
+            print(f"Partitioned {table}: {len(partitions)} partitions from {first} to {last}")
+        
+        for index in INDEX_COMMANDS:
+            cur.execute(index.format(concurrently=""))
+        
+        connection.commit()
+    except psycopg2.Error as e:
+        print(f"Error partitioning tables: {e}")
+        connection.rollback()
         return None
+    finally:
+        cur.close()
+        connection.close()
+    
+    return create_partitions(database=database) is not None
+
+def refresh_catalog(database=DATABASE):
+    """rebuilds the snapshot catalog from the cc050/ci050 tables, for data which
+       was loaded before the catalog existed or outside of bulk_insert_rows
+
+    Returns:
+        int: number of snapshots in the catalog, None on error
+    """
+    
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    try:
+        for command in CATALOG_COMMANDS:
+            cur.execute(sqlite_ddl(command) if backend(database) == "sqlite" else command)
+        cur.execute("DELETE FROM snapshot_catalog")
+        
+        for table, columns in TABLE_COLUMNS.items():
+            time_of_day = "CAST(time_of_day AS TEXT)" if "time_of_day" in columns else "''"
+            cur.execute(backend_sql(
+                f"INSERT INTO snapshot_catalog (snapshot_table, date, time_of_day, row_count) "
+                f"SELECT %s, CAST(date AS TEXT), {time_of_day}, count(*) FROM {table} "
+                f"GROUP BY 2, 3", database),
+                (table,))
+        
+        cur.execute("SELECT count(*) FROM snapshot_catalog")
+        snapshots = cur.fetchone()[0]
+        connection.commit()
     except Exception as e:
-        print(f"Error creating tables: {e}")
+        print(f"Error refreshing snapshot catalog: {e}")
+        connection.rollback()
         return None
     finally:
         cur.close()
         connection.close()
+    
+    print(f"Snapshot catalog holds {snapshots} snapshots")
+    return snapshots
+
+def backfill_catalog(database=DATABASE):
+    """fills an empty snapshot catalog from the report tables, so deployments with data
+       loaded before the catalog existed resolve "first"/"last" right away
+
+    Returns:
+        int: number of snapshots in the catalog, None on error
+    """
+    
+    if not CATALOG['enabled']:
+        return None
+    
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    try:
+        cur.execute("SELECT count(*) FROM snapshot_catalog")
+        snapshots = cur.fetchone()[0]
+    except Exception as e:
+        print(f"Error reading snapshot catalog: {e}")
+        return None
+    finally:
+        cur.close()
+        connection.close()
+    
+    return snapshots if snapshots else refresh_catalog(database)
+
+def columns_to_migrate(cur, table):
+    """lists the columns of a table whose current type differs from COLUMN_TYPES
+
+    Returns:
+        list: column names
+    """
+    
+    cur.execute(
+        "SELECT column_name, data_type, character_maximum_length "
+        "FROM information_schema.columns "
+        "WHERE table_name = %s",
+        (table,))
+    
+    to_convert = []
+    for column, data_type, max_length in cur.fetchall():
+        if column not in COLUMN_TYPES or data_type != "character varying":
+            continue
+        if COLUMN_TYPES[column][0] == f"VARCHAR({max_length})":
+            continue
+        to_convert.append(column)
+    
+    return to_convert
+
+def migrate_tables(database=DATABASE):
+    """converts existing VARCHAR cc050/ci050 tables in place to the typed schema
+       (version 2) and builds its indexes without blocking writers
+
+    Each table is rewritten by a single ALTER TABLE, guarded by SCHEMA['lock_timeout']
+    so a busy table fails fast instead of queueing behind long transactions. Columns
+    which are already typed are skipped, so the migration can be rerun safely.
+
+    Returns:
+        bool: True if the migration succeeded, None otherwise
+    """
+    
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    try:
+        cur.execute(f"SET lock_timeout = '{SCHEMA['lock_timeout']}'")
+        
+        for table in TABLE_COLUMNS:
+            to_convert = columns_to_migrate(cur, table)
+            if not to_convert:
+                continue
+            
+            alterations = ", ".join(
+                f"ALTER COLUMN {column} TYPE {COLUMN_TYPES[column][0]} USING {COLUMN_TYPES[column][1]}"
+                for column in to_convert)
+            cur.execute(f"ALTER TABLE {table} {alterations}")
+            print(f"Migrated {table}: {', '.join(to_convert)}")
         
-def setup_module():
+        connection.commit()
+    except psycopg2.Error as e:
+        print(f"Error migrating tables: {e}")
+        connection.rollback()
+        return None
+    finally:
+        cur.close()
+        connection.close()
+    
+    try:
+        with get_engine(database).connect().execution_options(isolation_level="AUTOCOMMIT") as autocommit:
+            # indexes on partitioned tables cannot be built concurrently
+            partitioned = autocommit.exec_driver_sql(
+                "SELECT 1 FROM pg_class WHERE relname = 'cc050' AND relkind = 'p'").first()
+            for command in INDEX_COMMANDS:
+                autocommit.exec_driver_sql(command.format(concurrently="" if partitioned else "CONCURRENTLY "))
+    except Exception as e:
+        print(f"Error creating indexes: {e}")
+        return None
+    
+    return True
+        
+def setup_module(commit_size=None):
     
     """populates predefined files into the Postgres database
+    
+    Args:
+        commit_size (int, optional): rows per batch and commit. Defaults to INGEST['commit_size']
+    
+    Returns:
+        bool: True if both fixtures were loaded, None on failure
     """
     
     try:
-        cc050_data = load_fixtures("cc050.json")
-        ci050_data = load_fixtures("ci050.json")
-        
-        upload_helper(
-            "cc050",
-            cc050_data,
-            ["date", "clearing_member", "account", "margin_type", "margin"])
-        upload_helper(
-            "ci050", 
-            ci050_data, 
-            ["date", "time_of_day", "clearing_member", "account", "margin_type", "margin"])
+        for table in ("cc050", "ci050"):
+            stats = ingest_feed(
+                table,
+                TABLE_COLUMNS[table],
+                os.path.join(os.path.dirname(__file__), "fixtures", f"{table}.json"),
+                commit_size=commit_size)
+            if stats is None:
+                raise Exception(f"{table} fixture could not be loaded")
         
         test_population()
     except Exception as e:
         print(f"Error populating tables: {e}")
+        return None
+    
+    return True
+
+def check_integrity(database=DATABASE):
+    """checks that the report tables exist with the expected columns and counts their rows
+    
+    The columns are read from an empty result instead of information_schema, which
+    the embedded backend does not have.
+    
+    Args:
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+    
+    Returns:
+        dict: row count per table, None if a table or column is missing
+    """
+    
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    try:
+        counts = {}
+        for table, columns in TABLE_COLUMNS.items():
+            cur.execute(f"SELECT * FROM {table} LIMIT 0")
+            missing = set(columns) - {column[0] for column in cur.description}
+            if missing:
+                raise Exception(f"{table} lacks column(s) {', '.join(sorted(missing))}")
+            
+            cur.execute(f"SELECT COUNT(*) FROM {table}")
+            counts[table] = cur.fetchone()[0]
+    except Exception as e:
+        print(f"Error at database integrity check: {e}")
+        return None
+    finally:
+        cur.close()
+        connection.close()
+    
+    return counts
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Create, populate or migrate the report tables")
+    parser.add_argument("command", nargs="?", choices=["init", "migrate", "partition", "retention", "catalog"], default="init",
+                        help="partition converts the tables if needed and creates upcoming partitions, "
+                             "retention detaches or drops expired partitions, "
+                             "catalog rebuilds the snapshot catalog from the tables")
+    parser.add_argument("--keep-days", type=int, default=None, help="days of history kept by retention")
+    parser.add_argument("--drop", action="store_true", help="drop expired partitions instead of detaching them")
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
-    create_tables()
-    setup_module()
+    args = parse_args()
+    
+    if args.command == "migrate":
+        migrate_tables()
+    elif args.command == "partition":
+        partition_tables()
+    elif args.command == "retention":
+        apply_retention(args.keep_days, "drop" if args.drop else None)
+    elif args.command == "catalog":
+        refresh_catalog()
+    else:
+        create_tables()
+        setup_module()
@@ -1,29 +1,200 @@
+import csv
+import io
 import json
 import psycopg2
+import psycopg2.extras
+import hashlib
 import os
+import re
+import threading
+import time
 
-from config.settings import DATABASE
+from collections import Counter
+from decimal import Decimal
+from itertools import islice
+from sqlalchemy import bindparam, create_engine, event, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.sql.elements import TextClause
+
+from config.settings import CATALOG, DATABASE, INGEST, NOTIFY, POOL, QUERIES
+from .querylog import logged_query
+
+_engines = {}
+_engines_lock = threading.Lock()
+_pool_counters = {"opened": 0, "checkouts": 0}
+
+def backend(database=DATABASE):
+    """storage backend of a database setup, "postgres" or the embedded "sqlite"
+    
+    """
+    
+    return database.get("backend", "postgres")
+
+def database_url(database=DATABASE):
+    if backend(database) == "sqlite":
+        path = database.get("path", ":memory:")
+        return "sqlite://" if path == ":memory:" else f"sqlite:///{path}"
+    
+    return (f'postgresql://{database["user"]}:{database["password"]}'
+            f'@{database["host"]}:{database["port"]}/{database["name"]}')
+
+def in_memory(database=DATABASE):
+    """True for an in-memory SQLite database, which every process sees empty
+    
+    """
+    
+    return backend(database) == "sqlite" and database.get("path", ":memory:") == ":memory:"
+
+def backend_sql(query, database=DATABASE):
+    """adapts a psycopg2 style statement to the parameter style of the backend
+    
+    """
+    
+    return query.replace("%s", "?") if backend(database) == "sqlite" else query
+
+def text_with_lists(query, names, dialect="postgresql"):
+    """builds a TextClause whose list parameters, written as "= ANY(:name)", match any
+       element of the bound list. Postgres binds each list as one array, SQLite has no
+       arrays and gets an IN with one placeholder per element instead
+
+    Args:
+        query (string): statement with :name parameters
+        names (list): names of the list parameters
+        dialect (string, optional): backend or SQLAlchemy dialect name. Defaults to "postgresql"
+
+    Returns:
+        TextClause
+    """
+    
+    if dialect != "sqlite":
+        return text(query)
+    
+    for name in names:
+        query = query.replace(f"= ANY(:{name})", f"IN :{name}")
+    
+    return text(query).bindparams(*[bindparam(name, expanding=True) for name in names])
+
+def _count_connect(dbapi_connection, connection_record):
+    with _engines_lock:
+        _pool_counters["opened"] += 1
+
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    with _engines_lock:
+        _pool_counters["checkouts"] += 1
+
+def get_engine(database=DATABASE):
+    """returns the process-wide pooled engine for a database, building it on first use
+
+    Args:
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        Engine
+    """
+    
+    url = database_url(database)
+    
+    with _engines_lock:
+        engine = _engines.get(url)
+        if engine is None and backend(database) == "sqlite":
+            options = {"connect_args": {"check_same_thread": False}}
+            if url == "sqlite://":
+                # an in-memory database lives as long as its only connection
+                options["poolclass"] = StaticPool
+            engine = create_engine(url, **options)
+        elif engine is None:
+            engine = create_engine(
+                url,
+                pool_size=POOL['pool_size'],
+                max_overflow=POOL['max_overflow'],
+                pool_pre_ping=POOL['pre_ping'],
+                pool_recycle=POOL['recycle'],
+            )
+        if url not in _engines:
+            event.listen(engine, "connect", _count_connect)
+            event.listen(engine, "checkout", _count_checkout)
+            _engines[url] = engine
+    
+    return engine
+
+def dispose_engines(close=True):
+    """drops all pooled connections, e.g. at shutdown or after a fork
+
+    Args:
+        close (bool, optional): close the connections, a forked child process passes
+            False so the connections of its parent are left untouched. Defaults to True
+    """
+    
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose(close=close)
+        _engines.clear()
+
+def pool_stats():
+    """counters for connections opened against the database vs. reused from the pool
+
+    Returns:
+        dict: opened, reused and checkouts
+    """
+    
+    with _engines_lock:
+        opened = _pool_counters["opened"]
+        checkouts = _pool_counters["checkouts"]
+    
+    return {"opened": opened, "reused": max(checkouts - opened, 0), "checkouts": checkouts}
 
 def create_connection(database=DATABASE):
-    """creates a connection to the Postgres Database
+    """checks out a DBAPI connection to the database from the shared pool,
+       closing the connection returns it to the pool
 
     Returns:
         connection
     """
 
     try:
-        connection = psycopg2.connect(
-            host=DATABASE['host'],
-            port=DATABASE['port'],
-            user=DATABASE['user'],
-            password=DATABASE['password'],
-            dbname=DATABASE['name'],
-        )
-        return connection
-    except psycopg2.Error as e:
+        return get_engine(database).raw_connection()
+    except (psycopg2.Error, SQLAlchemyError) as e:
         print(f"Error connecting to database: {e}")
         return None
 
+BIND_PARAMETER = re.compile(r"(?<!:):(\w+)")
+
+def prepare_query(connection, query):
+    """turns a parameterized statement into an EXECUTE of a server-side prepared
+       statement, preparing it on first use per pooled connection. Postgres then
+       parses and plans the statement once per connection instead of once per call.
+
+    Args:
+        connection (Connection): SQLAlchemy connection the statement will run on
+        query (TextClause): statement with :name parameters, values may be bound
+
+    Returns:
+        TextClause: EXECUTE statement taking the same parameters, query itself if it is
+                    not a TextClause, not run on postgres or QUERIES['prepared'] is off
+    """
+    
+    if not QUERIES['prepared'] or not isinstance(query, TextClause) \
+            or connection.dialect.name != "postgresql":
+        return query
+    
+    names = list(dict.fromkeys(BIND_PARAMETER.findall(query.text)))
+    statement_name = f"stmt_{hashlib.sha1(query.text.encode()).hexdigest()[:16]}"
+    
+    # the info dict follows the DBAPI connection through the pool, like the prepared statement
+    prepared = connection.info.setdefault("prepared_statements", set())
+    if statement_name not in prepared:
+        body = query.text
+        for position, name in enumerate(names, start=1):
+            body = re.sub(rf"(?<!:):{name}\b", f"${position}", body)
+        connection.exec_driver_sql(f"PREPARE {statement_name} AS {body}")
+        prepared.add(statement_name)
+    
+    execute = text(f"EXECUTE {statement_name}({', '.join(f':{name}' for name in names)})")
+    bound = {name: value for name, value in query.compile().params.items() if value is not None}
+    
+    return execute.bindparams(**bound) if bound else execute
+
 def insert_rows(table, columns, values, database=DATABASE):
     
     """insets records into the Postgres database
@@ -34,6 +205,7 @@ def insert_rows(table, columns, values, database=DATABASE):
              f"({', '.join(columns)}) "
              f"VALUES ({', '.join(['%s'] * len(values))})"
              )
+    query = backend_sql(query, database)
     
     connection = create_connection(database)
     cur = connection.cursor()
@@ -62,14 +234,17 @@ def select_rows(table, columns, n, database=DATABASE):
     query = (f"SELECT "
              f"{', '.join(columns)} " 
              f"FROM {table} "
-             f"ORDER BY id DESC LIMIT {n}")
+             f"ORDER BY id DESC LIMIT %s")
+    query = backend_sql(query, database)
     
     connection = create_connection(database)
     cur = connection.cursor()
     
     try:
-        cur.execute(query)
-        rows = cur.fetchall()
+        with logged_query(query, (n,), database) as entry:
+            cur.execute(query, (n,))
+            rows = cur.fetchall()
+            entry["rows"] = len(rows)
         return rows
     except Exception as e:
         print(f"Error selecting rows: {e}")
@@ -89,8 +264,10 @@ def execute_query(query, database=DATABASE):
     cur = connection.cursor()
     
     try:
-        cur.execute(query)
-        rows = cur.fetchall()
+        with logged_query(query, database=database) as entry:
+            cur.execute(query)
+            rows = cur.fetchall()
+            entry["rows"] = len(rows)
         return rows
     except Exception as e:
         print(f"Error selecting rows: {e}")
@@ -121,6 +298,216 @@ def upload_helper(table, input_data, col_names):
                 )
     return True
 
+def iter_fixture_rows(input_data):
+    """flattens the nested fixture layout ({section: [row, ...]}) into rows
+
+    Yields:
+        list: a single record
+    """
+    
+    for key in input_data.keys():
+        for value in input_data[key]:
+            yield value
+
+def batch_rows(rows, size):
+    """splits an iterable of records into lists of at most size records
+
+    Yields:
+        list: a batch of records
+    """
+    
+    iterator = iter(rows)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def copy_rows(cur, table, columns, rows):
+    """streams a batch of records into a table through COPY FROM STDIN
+    
+    """
+    
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
+
+def insert_batch(cur, table, columns, rows):
+    """inserts a batch of records with a single multi-row INSERT statement
+    
+    """
+    
+    psycopg2.extras.execute_values(
+        cur,
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s",
+        rows,
+        page_size=len(rows))
+
+SNAPSHOT_TABLES = ("cc050", "ci050")
+
+def record_snapshots(cur, table, columns, rows, database=DATABASE):
+    """adds the row counts of a loaded batch to the snapshot catalog, per date and
+       time of day. Runs in the load transaction so the catalog never lists rows
+       which were not committed
+
+    Args:
+        cur (cursor): cursor of the load transaction
+        table (string): table name, other tables than cc050/ci050 are ignored
+        columns (list): column names in the order of the record values
+        rows (list): the records of the batch
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        Counter: rows per (date, time_of_day), cc050 uses an empty time_of_day
+    """
+    
+    if not CATALOG['enabled'] or table not in SNAPSHOT_TABLES:
+        return Counter()
+    
+    date_at = columns.index("date")
+    time_at = columns.index("time_of_day") if "time_of_day" in columns else None
+    counts = Counter(
+        (str(row[date_at]), str(row[time_at]) if time_at is not None else "")
+        for row in rows)
+    
+    query = ("INSERT INTO snapshot_catalog (snapshot_table, date, time_of_day, row_count) VALUES %s "
+             "ON CONFLICT (snapshot_table, date, time_of_day) DO UPDATE "
+             "SET row_count = snapshot_catalog.row_count + EXCLUDED.row_count, loaded_at = CURRENT_TIMESTAMP")
+    values = [(table, date, time_of_day, count) for (date, time_of_day), count in counts.items()]
+    
+    if backend(database) == "sqlite":
+        cur.executemany(query.replace("%s", "(?, ?, ?, ?)"), values)
+    else:
+        psycopg2.extras.execute_values(cur, query, values)
+    
+    return counts
+
+def notify_snapshots(cur, table, columns, rows, database=DATABASE):
+    """queues a NOTIFY on NOTIFY['channel'] per date and time of day of a loaded batch.
+       Postgres delivers notifications on commit only, so listeners never see a
+       load which is still running or was rolled back
+
+    Args:
+        cur (cursor): cursor of the load transaction
+        table (string): table name, other tables than cc050/ci050 are ignored
+        columns (list): column names in the order of the record values
+        rows (list): the records of the batch
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        list: the JSON payloads sent, see app.daemon
+    """
+    
+    if not NOTIFY['enabled'] or table not in SNAPSHOT_TABLES or backend(database) == "sqlite":
+        return []
+    
+    date_at = columns.index("date")
+    time_at = columns.index("time_of_day") if "time_of_day" in columns else None
+    margin_at = columns.index("margin_type")
+    
+    slices = {}
+    for row in rows:
+        key = (str(row[date_at]), str(row[time_at]) if time_at is not None else "")
+        slices.setdefault(key, set()).add(str(row[margin_at]))
+    
+    payloads = [json.dumps({"table": table, "date": date, "time_of_day": time_of_day,
+                            "margin_types": sorted(margin_types)})
+                for (date, time_of_day), margin_types in slices.items()]
+    for payload in payloads:
+        cur.execute("SELECT pg_notify(%s, %s)", (NOTIFY['channel'], payload))
+    
+    return payloads
+
+def executemany_batch(cur, table, columns, rows):
+    """inserts a batch of records with executemany, for the embedded backend. sqlite3
+       cannot bind Decimal, those margins go in as their exact text
+    
+    """
+    
+    cur.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})",
+        ([str(value) if isinstance(value, Decimal) else value for value in row] for row in rows))
+
+def bulk_insert_rows(table, columns, rows, commit_size=None, method=None, database=DATABASE):
+    """inserts records over a single connection, committing every commit_size rows
+
+    Args:
+        table (string): table name
+        columns (list): column names in the order of the record values
+        rows (iterable): records to insert, may be a generator
+        commit_size (int, optional): rows per batch and commit. Defaults to INGEST['commit_size']
+        method (string, optional): "copy" for COPY FROM STDIN or "insert" for
+            multi-row INSERT statements, ignored by the embedded backend. Defaults to INGEST['method']
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        dict: rows written, elapsed seconds and rows per second, None on failure
+    """
+    
+    commit_size = commit_size or INGEST['commit_size']
+    method = method or INGEST['method']
+    write_batch = copy_rows if method == "copy" else insert_batch
+    if backend(database) == "sqlite":
+        write_batch = executemany_batch
+    
+    connection = create_connection(database)
+    if connection is None:
+        return None
+    cur = connection.cursor()
+    
+    total = 0
+    started = time.perf_counter()
+    
+    try:
+        for batch in batch_rows(rows, commit_size):
+            write_batch(cur, table, columns, batch)
+            record_snapshots(cur, table, columns, batch, database)
+            notify_snapshots(cur, table, columns, batch, database)
+            connection.commit()
+            total += len(batch)
+    except psycopg2.Error as e:
+        print(f"Error bulk inserting rows into {table}: {e}")
+        connection.rollback()
+        return None
+    except Exception as e:
+        print(f"Error bulk inserting rows into {table}: {e}")
+        connection.rollback()
+        return None
+    finally:
+        cur.close()
+        connection.close()
+    
+    elapsed = time.perf_counter() - started
+    stats = {
+        "table": table,
+        "rows": total,
+        "seconds": elapsed,
+        "rows_per_sec": total / elapsed if elapsed > 0 else float(total),
+    }
+    print(f"Loaded {total} rows into {table} in {elapsed:.2f}s "
+          f"({stats['rows_per_sec']:.0f} rows/sec)")
+    
+    return stats
+
+def bulk_upload_helper(table, input_data, col_names, commit_size=None, method=None, database=DATABASE):
+    """bulk counterpart of upload_helper for the nested fixture layout
+
+    Returns:
+        dict: load statistics, see bulk_insert_rows
+    """
+    
+    return bulk_insert_rows(
+        table,
+        col_names,
+        iter_fixture_rows(input_data),
+        commit_size=commit_size,
+        method=method,
+        database=database)
+
 def value_list_generator(columns, values):
     insert_list = []
     insert_list.append(dict(zip(columns, values)))
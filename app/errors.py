@@ -8,9 +8,12 @@ class CustomError(Exception):
     def __str__(self):
         return f"CustomError: {self.message}"
     
-    def send_error_report(self):
-        subject = "CustomError"
+    def send_error_report(self, sink=None):
+        """records the error with the run's break report, see app.sink.BreakSink
+        
+        """
         body = f"Error: {self.message}"
         
-        # send email or to reporting tool
-        print("Error report sent successfully.")
+        if sink is not None:
+            sink.record_error(body)
+        print(body)
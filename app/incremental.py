@@ -0,0 +1,247 @@
+"""Incremental intraday reconciliation of ci050 snapshots
+
+Every run reconciles only the ci050 snapshots of a date which are not yet recorded
+in recon_state, compares their breaks with the breaks of the previous snapshot and
+stores the result, so hourly runs only fetch the new snapshot.
+
+Usage:
+    python -m app.incremental --date 2020-05-12
+"""
+
+import argparse
+import pandas as pd
+import psycopg2
+import psycopg2.extras
+
+from config.settings import CATALOG, DATABASE
+from .db_utils import create_connection
+from .reconcile import ReconciliationIndex
+from .utils import get_report
+
+# key columns recon_state_breaks can hold, the key of a run is its cols_to_check
+BREAK_COLUMNS = ["clearing_member", "account", "margin_type", "margin"]
+
+def break_key(report_config):
+    """the break key of a run, its cols_to_check
+    
+    Raises:
+        ValueError: if a column cannot be stored in recon_state_breaks
+    
+    Returns:
+        list: column names
+    """
+    
+    key = list(report_config.get('cols_to_check') or BREAK_COLUMNS)
+    unknown = [column for column in key if column not in BREAK_COLUMNS]
+    if unknown:
+        raise ValueError(f"recon_state_breaks cannot hold {', '.join(unknown)}, expected {', '.join(BREAK_COLUMNS)}")
+    
+    return key
+
+def reference_label(report):
+    return f"{report['table']}:{report['date']}"
+
+def pending_snapshots(table, date, reference, database=DATABASE):
+    """lists the snapshots of a date which have not been reconciled against reference
+
+    Returns:
+        list: time_of_day strings in ascending order
+    """
+    
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    try:
+        if CATALOG['enabled']:
+            cur.execute(
+                "SELECT time_of_day FROM snapshot_catalog "
+                "WHERE snapshot_table = %s AND date = %s AND row_count > 0",
+                (table, date))
+        else:
+            cur.execute(
+                f"SELECT DISTINCT time_of_day FROM {table} WHERE date = %s", (date,))
+        available = {str(row[0]) for row in cur.fetchall()}
+        
+        cur.execute(
+            "SELECT time_of_day FROM recon_state "
+            "WHERE snapshot_table = %s AND date = %s AND reference = %s",
+            (table, date, reference))
+        reconciled = {row[0] for row in cur.fetchall()}
+        
+        return sorted(available - reconciled)
+    finally:
+        cur.close()
+        connection.close()
+
+def previous_breaks(table, date, time_of_day, reference, columns=None, database=DATABASE):
+    """loads the breaks of the reconciled snapshot of a date which precedes time_of_day,
+       so a snapshot loaded late is compared with its actual predecessor
+
+    Args:
+        columns (list, optional): break key, see break_key. Defaults to BREAK_COLUMNS
+
+    Returns:
+        Series: multiplicity indexed by break key and category, empty if nothing was reconciled
+    """
+    
+    key = list(columns or BREAK_COLUMNS) + ["category"]
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    try:
+        cur.execute(
+            f"SELECT {', '.join(key)}, multiplicity FROM recon_state_breaks "
+            "WHERE snapshot_table = %s AND date = %s AND reference = %s AND time_of_day = ("
+            "    SELECT MAX(time_of_day) FROM recon_state "
+            "    WHERE snapshot_table = %s AND date = %s AND reference = %s AND time_of_day < %s)",
+            (table, date, reference, table, date, reference, time_of_day))
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+        connection.close()
+    
+    frame = pd.DataFrame(rows, columns=key + ["multiplicity"])
+    if "margin" in frame.columns:
+        frame["margin"] = frame["margin"].astype("float64")
+    
+    return frame.set_index(key)["multiplicity"]
+
+def break_delta(current, previous):
+    """compares the breaks of two consecutive snapshots
+
+    Args:
+        current (Series): multiplicity per break key of the new snapshot
+        previous (Series): multiplicity per break key of the previous snapshot
+
+    Returns:
+        DataFrame: break keys whose multiplicity changed, with the change as
+                   multiplicity and "opened" or "resolved" as change
+    """
+    
+    counts = pd.concat(
+        [current.rename("current"), previous.rename("previous")],
+        axis=1).fillna(0).astype("int64")
+    difference = counts["current"] - counts["previous"]
+    difference = difference[difference != 0]
+    
+    return pd.DataFrame({
+        "multiplicity": difference.abs(),
+        "change": (difference > 0).map({True: "opened", False: "resolved"}),
+    }).reset_index()
+
+def save_snapshot(table, date, time_of_day, reference, matched, breaks, delta, database=DATABASE):
+    """records a reconciled snapshot and its breaks in one transaction, key columns
+       the run does not check are stored empty
+    
+    """
+    
+    connection = create_connection(database)
+    cur = connection.cursor()
+    
+    try:
+        cur.execute(
+            "INSERT INTO recon_state "
+            "(snapshot_table, date, time_of_day, reference, matched, breaks, opened, resolved) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+            (table, date, time_of_day, reference, matched,
+             int(breaks["multiplicity"].sum()),
+             int(delta.loc[delta["change"] == "opened", "multiplicity"].sum()),
+             int(delta.loc[delta["change"] == "resolved", "multiplicity"].sum())))
+        
+        stored = breaks.reindex(columns=BREAK_COLUMNS + ["category", "multiplicity"])
+        for column in BREAK_COLUMNS:
+            if column not in breaks.columns:
+                stored[column] = None if column == "margin" else ""
+        rows = [(table, date, time_of_day, reference, *values)
+                for values in stored.itertuples(index=False)]
+        if rows:
+            psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO recon_state_breaks "
+                "(snapshot_table, date, time_of_day, reference, "
+                f"{', '.join(BREAK_COLUMNS)}, category, multiplicity) VALUES %s",
+                rows)
+        
+        connection.commit()
+    except psycopg2.Error as e:
+        print(f"Error saving reconciliation state: {e}")
+        connection.rollback()
+        raise
+    finally:
+        cur.close()
+        connection.close()
+
+def reconcile_incremental(report_config, date, reference="cc050_eod_report", table="ci050", database=DATABASE):
+    """reconciles only the snapshots of a date which have not been reconciled yet
+
+    Args:
+        report_config (dict): report configuration setup
+        date (string): date of the snapshots
+        reference (string, optional): name of the reference report. Defaults to "cc050_eod_report"
+        table (string, optional): table holding the snapshots. Defaults to "ci050"
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        list: one dict per reconciled snapshot with time_of_day, matched, breaks and
+              the delta against the previous snapshot, None on failure
+    """
+    
+    margins = report_config['margin_classes']
+    
+    try:
+        key = break_key(report_config)
+        report = next(item for item in report_config['reports'] if item['name'] == reference)
+        label = reference_label(report)
+        
+        snapshots = pending_snapshots(table, date, label, database)
+        if not snapshots:
+            print(f"No new {table} snapshots for {date}")
+            return []
+        
+        reference_df = get_report(reference, report['table'], margins, report['date'],
+                                  report.get('time_of_day'), database)
+        if reference_df is None:
+            raise Exception(f"Error fetching report '{reference}'")
+        index = ReconciliationIndex(reference_df, key)
+        
+        results = []
+        
+        for time_of_day in snapshots:
+            snapshot = get_report(f"{table}_report", table, margins, date, time_of_day, database)
+            if snapshot is None:
+                raise Exception(f"Error fetching {table} snapshot {date} {time_of_day}")
+            
+            matching, breaks = index.probe(snapshot, f"{table}_{time_of_day}")
+            current = breaks.set_index(key + ["category"])["multiplicity"]
+            delta = break_delta(current, previous_breaks(table, date, time_of_day, label, key, database))
+            
+            matched = int(matching["multiplicity"].sum())
+            save_snapshot(table, date, time_of_day, label, matched, breaks, delta, database)
+            print(f"{table} {date} {time_of_day}: {matched} matched, "
+                  f"{int(breaks['multiplicity'].sum())} breaks, {len(delta)} changed")
+            
+            results.append({
+                "time_of_day": time_of_day,
+                "matched": matched,
+                "breaks": breaks,
+                "delta": delta,
+            })
+        
+        return results
+    
+    except Exception as e:
+        print(f"Error at incremental reconciliation: {str(e)}")
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile new ci050 snapshots incrementally")
+    parser.add_argument("--date", required=True, help="date of the ci050 snapshots")
+    parser.add_argument("--reference", default="cc050_eod_report")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    from .main import build_report_settings
+    from .utils import create_dates
+    
+    args = parse_args()
+    reconcile_incremental(build_report_settings(create_dates()), args.date, args.reference)
@@ -0,0 +1,317 @@
+"""Streaming ingest of cc050/ci050 feed files
+
+Feeds are parsed incrementally as NDJSON, CSV or the nested JSON fixture layout
+({section: [row, ...]}), optionally gzip compressed. Every row is validated and typed
+while it streams through and handed to bulk_insert_rows, which writes it in batches
+of INGEST['commit_size'] rows, so memory stays flat however large the feed is. Lines
+and records which do not parse are rejected and counted like invalid rows instead of
+stopping a load whose first batches are already committed.
+
+Usage:
+    python -m app.loader ci050 feeds/ci050.ndjson.gz
+"""
+
+import csv
+import gzip
+import json
+import os
+import re
+import time
+
+from datetime import date, time as time_of_day_type
+from decimal import Decimal, InvalidOperation
+
+from config.settings import DATABASE, INGEST
+from .db_utils import bulk_insert_rows
+
+FEED_FORMATS = ["ndjson", "csv", "json"]
+
+COLUMN_LIMITS = {
+    "clearing_member": 64,
+    "account": 64,
+    "margin_type": 16,
+}
+
+# margins are decoded as Decimal, a float would round NUMERIC values before the load
+_decoder = json.JSONDecoder(parse_float=Decimal)
+_whitespace = re.compile(r"\s*")
+
+def detect_format(path):
+    """derives the feed format from the file extension, ignoring a trailing .gz
+    
+    Returns:
+        string: one of FEED_FORMATS
+    """
+    
+    name = path[:-3] if path.endswith(".gz") else path
+    extension = os.path.splitext(name)[1].lower()
+    
+    if extension in (".ndjson", ".jsonl"):
+        return "ndjson"
+    if extension == ".csv":
+        return "csv"
+    return "json"
+
+def open_feed(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    return opener(path, "rt", encoding="utf-8", newline="")
+
+def read_ndjson(stream, columns):
+    """yields one row per line, lines are either arrays in column order or objects.
+       A line which is no valid JSON is yielded as a ValueError, see typed_rows
+    
+    """
+    
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            value = _decoder.decode(line)
+        except json.JSONDecodeError as e:
+            yield ValueError(f"invalid JSON: {e}")
+            continue
+        yield [value.get(column) for column in columns] if isinstance(value, dict) else value
+
+def read_csv(stream, columns):
+    """yields one row per line, a header line naming the columns is skipped and may
+       reorder them. A line which is no valid CSV is yielded as a ValueError
+    
+    """
+    
+    reader = csv.reader(stream)
+    order = None
+    
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield ValueError(f"invalid CSV: {e}")
+            continue
+        if not row:
+            continue
+        if order is None:
+            header = [value.strip() for value in row]
+            if set(header) >= set(columns):
+                order = [header.index(column) for column in columns]
+                continue
+            order = list(range(len(columns)))
+        yield [row[position] if position < len(row) else None for position in order]
+
+def read_nested_json(stream, chunk_size=None):
+    """yields the rows of the nested fixture layout without loading the whole document
+    
+    Only the current row and one read chunk are held in memory: the outer object and
+    its arrays are walked by hand and every row is decoded on its own. A row which is
+    no valid JSON is yielded as a ValueError and skipped up to its closing bracket,
+    rows are flat arrays. A broken document structure, e.g. a missing or repeated
+    comma, raises ValueError.
+    
+    Args:
+        stream (file): text stream of the feed
+        chunk_size (int, optional): characters read at a time. Defaults to INGEST['chunk_size']
+    
+    Yields:
+        list: a single record
+    """
+    
+    chunk_size = chunk_size or INGEST['chunk_size']
+    buffer = ""
+    position = 0
+    eof = False
+    
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+        return not eof
+    
+    def peek():
+        nonlocal position
+        while True:
+            position = _whitespace.match(buffer, position).end()
+            if position < len(buffer) or not fill():
+                return buffer[position] if position < len(buffer) else ""
+    
+    def expect(token):
+        nonlocal position
+        if peek() != token:
+            raise ValueError(f"Expected '{token}' at offset {position} of nested feed")
+        position += 1
+    
+    def complete(error):
+        if error.msg.startswith("Unterminated string"):
+            return False
+        return "]" in buffer[error.pos:]
+    
+    def decode():
+        nonlocal position
+        while True:
+            try:
+                value, end = _decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError as e:
+                # only a value cut off by the end of the buffer continues in the next
+                # chunk, a malformed row is rejected as soon as its closing bracket is read
+                if complete(e) or not fill():
+                    raise
+                continue
+            position = end
+            return value
+    
+    def skip_row():
+        nonlocal position
+        while "]" not in buffer[position:]:
+            position = len(buffer)
+            if not fill():
+                raise ValueError("Unexpected end of nested feed")
+        position = buffer.index("]", position) + 1
+    
+    def separator(first, closing):
+        if first:
+            return
+        expect(",")
+        if peek() in (closing, ",", ""):
+            raise ValueError(f"Unexpected '{peek()}' after ',' at offset {position} of nested feed")
+    
+    expect("{")
+    first_section = True
+    while peek() != "}":
+        if peek() == "":
+            raise ValueError("Unexpected end of nested feed")
+        separator(first_section, "}")
+        first_section = False
+        decode()
+        expect(":")
+        expect("[")
+        first_row = True
+        while peek() != "]":
+            if peek() == "":
+                raise ValueError("Unexpected end of nested feed")
+            separator(first_row, "]")
+            first_row = False
+            try:
+                row = decode()
+            except json.JSONDecodeError as e:
+                skip_row()
+                row = ValueError(f"invalid JSON: {e}")
+            yield row
+        expect("]")
+    expect("}")
+
+def type_row(columns, row):
+    """validates a raw row and converts it into the typed record written to the tables
+    
+    Raises:
+        ValueError: if the row has the wrong length or a value does not parse
+    
+    Returns:
+        tuple: date and time_of_day as ISO strings, text stripped, margin as Decimal
+    """
+    
+    if row is None or len(row) != len(columns):
+        raise ValueError(f"expected {len(columns)} values, got {0 if row is None else len(row)}")
+    
+    record = []
+    for column, value in zip(columns, row):
+        if value is None or (isinstance(value, str) and not value.strip()):
+            raise ValueError(f"missing {column}")
+        if column == "date":
+            value = date.fromisoformat(str(value).strip()).isoformat()
+        elif column == "time_of_day":
+            value = time_of_day_type.fromisoformat(str(value).strip()).strftime("%H:%M:%S")
+        elif column == "margin":
+            if isinstance(value, bool):
+                raise ValueError("margin is not a number")
+            try:
+                value = value if isinstance(value, Decimal) else Decimal(str(value).strip())
+            except InvalidOperation:
+                raise ValueError(f"margin {value!r} is not a number")
+            if not value.is_finite():
+                raise ValueError(f"margin {value} is not finite")
+        else:
+            value = str(value).strip()
+            if len(value) > COLUMN_LIMITS.get(column, len(value)):
+                raise ValueError(f"{column} longer than {COLUMN_LIMITS[column]} characters")
+        record.append(value)
+    
+    return tuple(record)
+
+def typed_rows(columns, rows, rejects):
+    """types the rows as they stream through, invalid rows and the lines or records
+       the reader could not parse (yielded as ValueError) are counted in rejects and
+       skipped
+    
+    Yields:
+        tuple: a typed record
+    """
+    
+    for number, row in enumerate(rows, start=1):
+        try:
+            if isinstance(row, ValueError):
+                raise row
+            yield type_row(columns, row)
+        except (ValueError, TypeError) as e:
+            if rejects["rows"] == 0:
+                print(f"Rejected row {number}: {e}")
+            rejects["rows"] += 1
+
+def read_feed(stream, columns, feed_format):
+    if feed_format == "ndjson":
+        return read_ndjson(stream, columns)
+    if feed_format == "csv":
+        return read_csv(stream, columns)
+    return read_nested_json(stream)
+
+def ingest_feed(table, columns, path, feed_format=None, commit_size=None, method=None, database=DATABASE):
+    """streams a feed file into a table
+    
+    Args:
+        table (string): table name
+        columns (list): column names in the order of the record values
+        path (string): feed file, .gz files are decompressed on the fly
+        feed_format (string, optional): one of FEED_FORMATS. Defaults to the file extension
+        commit_size (int, optional): rows per batch and commit. Defaults to INGEST['commit_size']
+        method (string, optional): "copy" or "insert". Defaults to INGEST['method']
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+    
+    Returns:
+        dict: load statistics of bulk_insert_rows plus rejected rows and MB per second
+              of the feed file, None on failure
+    """
+    
+    feed_format = feed_format or detect_format(path)
+    rejects = {"rows": 0}
+    started = time.perf_counter()
+    
+    try:
+        with open_feed(path) as stream:
+            stats = bulk_insert_rows(
+                table,
+                columns,
+                typed_rows(columns, read_feed(stream, columns, feed_format), rejects),
+                commit_size=commit_size,
+                method=method,
+                database=database)
+    except (OSError, ValueError) as e:
+        print(f"Error reading feed {path}: {e}")
+        return None
+    
+    if stats is None:
+        return None
+    
+    elapsed = time.perf_counter() - started
+    megabytes = os.path.getsize(path) / (1024 * 1024)
+    stats.update({
+        "format": feed_format,
+        "rejected": rejects["rows"],
+        "mb": megabytes,
+        "mb_per_sec": megabytes / elapsed if elapsed > 0 else megabytes,
+    })
+    print(f"Ingested {path}: {stats['rows']} rows, {stats['rejected']} rejected, "
+          f"{stats['mb_per_sec']:.1f} MB/sec")
+    
+    return stats
@@ -0,0 +1,57 @@
+"""Command line entry point for bulk loading cc050/ci050 feed files
+
+Usage:
+    python -m app.loader cc050 path/to/cc050.json --commit-size 5000
+    python -m app.loader ci050 path/to/ci050.ndjson.gz
+"""
+
+import argparse
+
+from .db import TABLE_COLUMNS, maintain_partitions
+from .ingest import FEED_FORMATS, ingest_feed
+
+def load_feed(table, path, commit_size=None, method=None, feed_format=None):
+    """streams a feed file into a table, see app.ingest. The date partitions are rolled
+       forward first, see maintain_partitions
+
+    Args:
+        table (string): table name, one of TABLE_COLUMNS
+        path (string): path to the feed file, NDJSON, CSV or the nested fixture layout
+        commit_size (int, optional): rows per batch and commit
+        method (string, optional): "copy" or "insert"
+        feed_format (string, optional): one of FEED_FORMATS. Defaults to the file extension
+
+    Returns:
+        dict: load statistics, None on failure
+    """
+    
+    maintain_partitions()
+    
+    return ingest_feed(
+        table,
+        TABLE_COLUMNS[table],
+        path,
+        feed_format=feed_format,
+        commit_size=commit_size,
+        method=method)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk load a cc050/ci050 feed file")
+    parser.add_argument("table", choices=sorted(TABLE_COLUMNS))
+    parser.add_argument("path", help="feed file, optionally gzip compressed")
+    parser.add_argument("--commit-size", type=int, default=None)
+    parser.add_argument("--method", choices=["copy", "insert"], default=None)
+    parser.add_argument("--format", dest="feed_format", choices=FEED_FORMATS, default=None,
+                        help="defaults to the file extension")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    stats = load_feed(args.table, args.path, args.commit_size, args.method, args.feed_format)
+    
+    if stats is None:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,56 +1,106 @@
 import pandas as pd
 
+from config.settings import CATALOG
+
+from .cache import cache_stats
+from .metrics import flush_metrics, print_summary
+from .parallel import check_reports_parallel, fetch_reports_parallel
+from .sink import BreakSink
 from .utils import *
 
-dates = create_dates()
-
-report_settings = {
-    "cols_to_check": ['clearing_member', 'account', 'margin_type', 'margin'],
-    "margin_classes": ["SPAN", "IMSM", "CESM", "AMPO", "AMEM", "AMCO", "AMCU", "AMWI", "DMEM"],
-    "reports": [
-        {
-            "name": "cc050_eod_report",
-            "table": "cc050",
-            "date": create_dates()["last_day"],
-            "valid_report": True,
-        },
-        {
-            "name": "ci050_last_report",
-            "table": "ci050",
-            "date": create_dates()["last_day"],
-            "time_of_day": create_dates()["max_time_of_day"],
-            "valid_report": True,
-        },
-        {
-            "name": "ci050_first_report",
-            "table": "ci050",
-            "date": create_dates()["current_day"],
-            "time_of_day": create_dates()["min_time_of_day"],
-            "valid_report": True,
-        }
-    ]
-}
+def build_report_settings(dates):
+    """builds the report configuration for the dates of one run day, see create_dates.
+       With the snapshot catalog the ci050 reports name their snapshot ("last" of the
+       previous day, "first" of the run day) instead of a fixed time of day, which
+       stays as the fallback until the catalog is filled
+    
+    """
+    
+    catalog = CATALOG['enabled']
+    
+    return {
+        "cols_to_check": ['clearing_member', 'account', 'margin_type', 'margin'],
+        "margin_classes": ["SPAN", "IMSM", "CESM", "AMPO", "AMEM", "AMCO", "AMCU", "AMWI", "DMEM"],
+        "reports": [
+            {
+                "name": "cc050_eod_report",
+                "table": "cc050",
+                "date": dates["last_day"],
+                "valid_report": True,
+            },
+            {
+                "name": "ci050_last_report",
+                "table": "ci050",
+                "date": dates["last_day"],
+                "time_of_day": "last" if catalog else dates["max_time_of_day"],
+                "fallback_time_of_day": dates["max_time_of_day"],
+                "valid_report": True,
+            },
+            {
+                "name": "ci050_first_report",
+                "table": "ci050",
+                "date": dates["current_day"],
+                "time_of_day": "first" if catalog else dates["min_time_of_day"],
+                "fallback_time_of_day": dates["min_time_of_day"],
+                "valid_report": True,
+            }
+        ]
+    }
+
+REPORT_PAIRS = [
+    ("cc050_eod_report", "ci050_first_report"),
+    ("cc050_eod_report", "ci050_last_report"),
+]
 
 def main(report_config):
     
     try:
         # input validation and reporting
-        is_valid, message = validate_input(report_config)
+        with stage("validation"):
+            is_valid, message = validate_input(report_config)
         send_report(is_valid, message)
         
-        reports = fetch_reports(report_config)
+        # the sql and streaming engines read from the server themselves, so only the
+        # report slices are described
+        engine = reconciliation_engine(report_config)
+        matching = report_config.get('matching')
+        columns = report_config['cols_to_check']
+        fetch_mode = "handles" if engine in SERVER_SIDE_ENGINES else None
+        sink = BreakSink()
         
-        for key in reports.keys():
-            print(key)
+        if report_config.get('parallel', PARALLEL['enabled']):
+            workers = report_config.get('workers')
+            reports, errors = fetch_reports_parallel(report_config, fetch_mode, workers)
+            for error in errors:
+                print(error)
+                sink.record_error(error)
             
-            items = reports[key]
+            check_reports_parallel(reports, REPORT_PAIRS, columns, engine, matching, workers, sink=sink)
+        else:
+            reports = fetch_reports(report_config, fetch_mode)
+            
+            for key in reports.keys():
+                print(key)
+                
+                items = reports[key]
+                
+                for left, right in REPORT_PAIRS:
+                    check_report(items[left], items[right], columns, engine, matching, sink)
+        
+        summary = sink.close()
 
-            check_report(items['cc050_eod_report'], items['ci050_first_report'], report_config['cols_to_check'])
-            check_report(items['cc050_eod_report'], items['ci050_last_report'], report_config['cols_to_check'])
+        print(f"Connection pool: {pool_stats()}")
+        if report_cache() is not None:
+            print(f"Report cache: {cache_stats()}")
+        
+        print_summary()
+        flush_metrics()
+        
+        return summary
 
     except Exception as e:
         print(f"Error at main: {str(e)}")
         return None
 
 if __name__ == '__main__':
-    main(report_settings)
+    main(build_report_settings(create_dates()))
@@ -0,0 +1,191 @@
+"""Per-stage timing and throughput instrumentation for the report pipeline
+
+Stages are timed with stage(), which records duration, rows and bytes labelled by
+margin class and report. Records are kept in memory and written by flush_metrics()
+as JSON lines (METRICS['json_log']) and/or a Prometheus textfile (METRICS['textfile']).
+A flush clears the records but adds them to running totals first, so the textfile
+counters only ever grow for the lifetime of the process.
+Recording a stage costs two perf_counter calls and a list append.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+from config.settings import METRICS
+
+_records = []
+_totals = {}
+_records_lock = threading.Lock()
+
+@contextmanager
+def stage(name, **labels):
+    """times a pipeline stage, the yielded record takes rows and bytes
+
+    Args:
+        name (string): stage name, e.g. "query"
+        **labels: labels such as margin and report
+
+    Yields:
+        dict: the record of the stage
+    """
+    
+    record = {"stage": name, "labels": labels, "rows": None, "bytes": None}
+    
+    if not METRICS['enabled']:
+        yield record
+        return
+    
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["seconds"] = time.perf_counter() - started
+        record["timestamp"] = time.time()
+        with _records_lock:
+            _records.append(record)
+
+def frame_size(record, df):
+    """adds the rows and memory size of a DataFrame to a stage record, strings of
+       object columns included
+    
+    """
+    
+    if df is not None:
+        record["rows"] = len(df)
+        record["bytes"] = int(df.memory_usage(index=False, deep=True).sum())
+    
+    return df
+
+def records():
+    with _records_lock:
+        return list(_records)
+
+def accumulate(totals, items):
+    for record in items:
+        key = (record["stage"], tuple(sorted(record["labels"].items())))
+        total = totals.setdefault(key, {
+            "stage": record["stage"], "labels": record["labels"],
+            "calls": 0, "seconds": 0.0, "rows": 0, "bytes": 0})
+        total["calls"] += 1
+        total["seconds"] += record["seconds"]
+        total["rows"] += record["rows"] or 0
+        total["bytes"] += record["bytes"] or 0
+    
+    return totals
+
+def summary():
+    """aggregates the records since the last flush by stage and labels
+
+    Returns:
+        list: dicts with stage, labels, calls, seconds, rows and bytes
+    """
+    
+    return list(accumulate({}, records()).values())
+
+def running_totals():
+    """aggregates every record of the process by stage and labels, flushed ones included
+
+    Returns:
+        list: dicts with stage, labels, calls, seconds, rows and bytes
+    """
+    
+    with _records_lock:
+        totals = {key: dict(total) for key, total in _totals.items()}
+        return list(accumulate(totals, _records).values())
+
+def reset_metrics():
+    with _records_lock:
+        _records.clear()
+        _totals.clear()
+
+def write_json_log(path, items=None):
+    """appends every record as one JSON line, "-" writes to stdout
+    
+    """
+    
+    items = records() if items is None else items
+    lines = "".join(json.dumps(record, default=str) + "\n" for record in items)
+    
+    if path == "-":
+        sys.stdout.write(lines)
+    else:
+        with open(path, "a") as f:
+            f.write(lines)
+
+def prometheus_labels(labels):
+    return ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()) if value is not None)
+
+def write_prometheus_textfile(path):
+    """writes the running totals of the stages in the Prometheus textfile exposition
+       format, replacing the file atomically so the node exporter never reads a partial file
+    
+    """
+    
+    metrics = [
+        ("recon_stage_calls_total", "counter", "Number of executions of a pipeline stage", "calls"),
+        ("recon_stage_seconds_total", "counter", "Time spent in a pipeline stage", "seconds"),
+        ("recon_stage_rows_total", "counter", "Rows handled by a pipeline stage", "rows"),
+        ("recon_stage_bytes_total", "counter", "Bytes handled by a pipeline stage", "bytes"),
+    ]
+    totals = running_totals()
+    
+    lines = []
+    for metric, metric_type, description, field in metrics:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for total in totals:
+            labels = prometheus_labels(dict(total["labels"], stage=total["stage"]))
+            lines.append(f"{metric}{{{labels}}} {total[field]}")
+    
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temporary, path)
+
+def print_summary():
+    """prints the time spent per stage over all labels
+    
+    """
+    
+    stages = {}
+    for total in summary():
+        item = stages.setdefault(total["stage"], {"calls": 0, "seconds": 0.0, "rows": 0})
+        item["calls"] += total["calls"]
+        item["seconds"] += total["seconds"]
+        item["rows"] += total["rows"]
+    
+    for name, item in stages.items():
+        print(f"Stage {name}: {item['seconds']:.3f}s, {item['calls']} call(s), {item['rows']} rows")
+
+def flush_metrics(json_log=None, textfile=None):
+    """writes the recorded stages to the configured sinks and clears them, the textfile
+       keeps counting from the running totals
+
+    Args:
+        json_log (string, optional): JSON lines file, "-" for stdout. Defaults to METRICS['json_log']
+        textfile (string, optional): Prometheus textfile. Defaults to METRICS['textfile']
+    """
+    
+    if not METRICS['enabled']:
+        return
+    
+    json_log = json_log or METRICS['json_log']
+    textfile = textfile or METRICS['textfile']
+    
+    with _records_lock:
+        flushed = list(_records)
+        _records.clear()
+        accumulate(_totals, flushed)
+    
+    try:
+        if json_log:
+            write_json_log(json_log, flushed)
+        if textfile:
+            write_prometheus_textfile(textfile)
+    except OSError as e:
+        print(f"Error writing metrics: {e}")
@@ -0,0 +1,161 @@
+"""Parallel execution of fetch and reconciliation across margin classes
+
+The margin classes are independent of each other, so the I/O-bound queries run on a
+thread pool and the reconciliation optionally on a process pool. Results are always
+collected and reported in configuration order, a failing task is recorded as error
+instead of failing the whole run.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from config.settings import FETCH, PARALLEL
+from .catalog import resolve_reports
+from .db_utils import dispose_engines
+from .utils import (
+    compact_reports,
+    get_margins,
+    get_report_margins,
+    reconcile_reports,
+    report_breaks,
+    report_handle,
+)
+
+def fetch_reports_parallel(report_config, fetch_mode=None, workers=None):
+    """same as fetch_reports, but runs the queries on a thread pool
+
+    Args:
+        report_config (dict): report configuration setup
+        fetch_mode (string, optional): see fetch_reports
+        workers (int, optional): number of threads. Defaults to PARALLEL['workers']
+
+    Returns:
+        tuple: the nested reports dictionary, holding only margin classes whose
+               reports were all fetched, and a list of error messages
+    """
+    
+    fetch_mode = fetch_mode or report_config.get('fetch_mode') or FETCH['mode']
+    workers = workers or report_config.get('workers') or PARALLEL['workers']
+    report_config = resolve_reports(report_config)
+    margins = report_config['margin_classes']
+    
+    reports = {margin: {} for margin in margins}
+    errors = []
+    
+    if fetch_mode == "handles":
+        for margin in margins:
+            for report in report_config['reports']:
+                reports[margin][report['name']] = report_handle(
+                    report['name'], report['table'], margin, report['date'], report.get('time_of_day'))
+        return reports, errors
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if fetch_mode == "batched":
+            tasks = [(report, None, executor.submit(
+                         get_report_margins, report['name'], report['table'], margins,
+                         report['date'], report.get('time_of_day')))
+                     for report in report_config['reports']]
+        else:
+            tasks = [(report, margin, executor.submit(
+                         get_margins, report['name'], report['table'], margin,
+                         report['date'], report.get('time_of_day')))
+                     for margin in margins
+                     for report in report_config['reports']]
+        
+        failed = set()
+        for report, margin, future in tasks:
+            try:
+                result = future.result()
+            except Exception as e:
+                result = None
+                print(f"Error fetching report '{report['name']}': {str(e)}")
+            
+            if result is None:
+                errors.append(f"Error fetching report '{report['name']}' for margin '{margin or 'all'}'")
+                failed.update([margin] if margin else margins)
+                continue
+            
+            if margin is None:
+                for item in margins:
+                    reports[item][report['name']] = result[item]
+            else:
+                reports[margin][report['name']] = result
+    
+    reports = {margin: items for margin, items in reports.items() if margin not in failed}
+    if report_config.get('compact', FETCH['compact']):
+        compact_reports(reports)
+    
+    return reports, errors
+
+def init_worker():
+    # a forked worker must not reuse the pooled connections of its parent
+    dispose_engines(close=False)
+
+def _reconcile_task(df1, name1, df2, name2, columns, engine, matching):
+    # DataFrame.name does not survive pickling into a worker process
+    df1.name = name1
+    df2.name = name2
+    
+    result = reconcile_reports(df1, df2, columns, engine, matching)
+    if result is None:
+        raise Exception(f"Error processing reports {name1} and {name2}")
+    
+    return result
+
+def check_reports_parallel(reports, pairs, columns, engine=None, matching=None, workers=None, processes=None,
+                           sink=None):
+    """reconciles every report pair of every margin class in parallel and reports
+       the results in order
+
+    Args:
+        reports (dict): nested reports dictionary, see fetch_reports
+        pairs (list): tuples of report names which should be compared
+        columns (list): the columns which should be matched against
+        engine (string, optional): see check_report
+        matching (string, optional): see check_report
+        workers (int, optional): number of workers. Defaults to PARALLEL['workers']
+        processes (bool, optional): use a process pool instead of a thread pool.
+            Defaults to PARALLEL['processes']
+        sink (BreakSink, optional): collects the breaks, see report_breaks
+
+    Returns:
+        list: one dict per margin class and pair with margin, reports, clean and error
+    """
+    
+    workers = workers or PARALLEL['workers']
+    processes = PARALLEL['processes'] if processes is None else processes
+    
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    
+    results = []
+    
+    with executor:
+        tasks = []
+        for margin, items in reports.items():
+            for left, right in pairs:
+                df1, df2 = items[left], items[right]
+                future = executor.submit(
+                    _reconcile_task, df1, df1.name, df2, df2.name, columns, engine, matching)
+                tasks.append((margin, df1.name, df2.name, future))
+        
+        current_margin = None
+        for margin, name1, name2, future in tasks:
+            if margin != current_margin:
+                print(margin)
+                current_margin = margin
+            
+            try:
+                match, non_matching = future.result()
+            except Exception as e:
+                print(f"Error checking report: {str(e)}")
+                if sink is not None:
+                    sink.record_error(f"Error checking {name1} and {name2}: {e}")
+                results.append({"margin": margin, "reports": (name1, name2), "clean": None, "error": str(e)})
+                continue
+            
+            clean = report_breaks(name1, name2, non_matching, sink, margin) is True
+            results.append({"margin": margin, "reports": (name1, name2), "clean": clean, "error": None})
+    
+    return results
@@ -0,0 +1,136 @@
+"""Opt-in log of generated SQL statements with latency and rows returned
+
+With QUERY_LOG['enabled'] every statement run through logged_query() is written to a
+JSON lines file or the query_log table. Statements slower than
+QUERY_LOG['threshold_ms'] are run again under EXPLAIN (ANALYZE, BUFFERS) and the plan
+is stored with the entry, as long as they are read-only (see read_only), since EXPLAIN
+ANALYZE executes them. The EXPLAIN is timed as a stage of its own, "explain", and
+callers open logged_query outside their own stage so it is not counted as query time.
+Failures of the log itself never fail the query.
+"""
+
+import json
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.sql.elements import TextClause
+
+from config.settings import DATABASE, QUERY_LOG
+from . import db_utils
+from .metrics import stage
+
+_file_lock = threading.Lock()
+
+_comments = re.compile(r"\s*(--[^\n]*\n?|/\*.*?\*/)", re.S)
+_writes = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|CREATE|DROP|ALTER|COPY|CALL|LOCK|FOR\s+SHARE)\b", re.I)
+
+def read_only(sql):
+    """True for a SELECT, WITH, VALUES or TABLE statement which does not write or lock
+       rows, i.e. one that may safely run again under EXPLAIN ANALYZE. Statements with a
+       writing keyword anywhere, e.g. a data-modifying CTE or FOR UPDATE, are refused
+    
+    """
+    
+    sql = _comments.sub(" ", sql).lstrip(" \t\n(")
+    keyword = sql.split(None, 1)[0].upper() if sql else ""
+    
+    return keyword in ("SELECT", "WITH", "VALUES", "TABLE") and not _writes.search(sql)
+
+def explain_query(statement, params=None, database=DATABASE):
+    """runs a read-only statement under EXPLAIN (ANALYZE, BUFFERS)
+
+    Args:
+        statement (string or TextClause): psycopg2 style string or SQLAlchemy text clause
+        params (dict or tuple, optional): bound parameters of the statement
+
+    Returns:
+        string: the query plan
+    """
+    
+    if isinstance(statement, TextClause):
+        with db_utils.get_engine(database).connect() as connection:
+            rows = connection.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {statement.text}"), params or {}).fetchall()
+    else:
+        connection = db_utils.create_connection(database)
+        cur = connection.cursor()
+        try:
+            cur.execute(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", params)
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+            connection.close()
+    
+    return "\n".join(row[0] for row in rows)
+
+def write_entry(entry, database=DATABASE):
+    if QUERY_LOG['target'] == "table":
+        connection = db_utils.create_connection(database)
+        cur = connection.cursor()
+        try:
+            cur.execute(db_utils.backend_sql(
+                "INSERT INTO query_log (logged_at, statement, params, duration_ms, row_count, plan) "
+                "VALUES (%s, %s, %s, %s, %s, %s)", database),
+                (entry["logged_at"], entry["statement"], entry["params"],
+                 entry["duration_ms"], entry["rows"], entry["plan"]))
+            connection.commit()
+        finally:
+            cur.close()
+            connection.close()
+    else:
+        with _file_lock:
+            with open(QUERY_LOG['path'], "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+def log_query(statement, params, seconds, rows, database=DATABASE):
+    """records a statement with its latency and rows returned, capturing the plan of
+       slow read-only statements
+    
+    """
+    
+    sql = statement.text if isinstance(statement, TextClause) else str(statement)
+    if params is None and isinstance(statement, TextClause):
+        params = statement.compile().params or None
+    duration_ms = seconds * 1000
+    
+    try:
+        plan = None
+        # EXPLAIN (ANALYZE, BUFFERS) is Postgres only
+        if (QUERY_LOG['explain'] and duration_ms >= QUERY_LOG['threshold_ms']
+                and read_only(sql)
+                and db_utils.backend(database) == "postgres"):
+            with stage("explain"):
+                plan = explain_query(statement, params, database)
+        
+        write_entry({
+            "logged_at": datetime.now().isoformat(),
+            "statement": " ".join(sql.split()),
+            "params": json.dumps(params, default=str) if params is not None else None,
+            "duration_ms": round(duration_ms, 3),
+            "rows": rows,
+            "plan": plan,
+        }, database)
+    except Exception as e:
+        print(f"Error logging query: {e}")
+
+@contextmanager
+def logged_query(statement, params=None, database=DATABASE):
+    """times the statement executed inside the block, the yielded dict takes rows
+
+    Yields:
+        dict: set "rows" to the number of rows returned
+    """
+    
+    entry = {"rows": None}
+    
+    if not QUERY_LOG['enabled']:
+        yield entry
+        return
+    
+    started = time.perf_counter()
+    yield entry
+    log_query(statement, params, time.perf_counter() - started, entry["rows"], database)
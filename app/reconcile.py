@@ -0,0 +1,460 @@
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import text
+
+from config.settings import DATABASE
+from .db_utils import get_engine
+from .querylog import logged_query
+
+def report_filter(prefix, report):
+    """builds the WHERE clause and parameters selecting one report slice
+
+    Args:
+        prefix (string): parameter name prefix, keeps both sides of a join apart
+        report (dict): report description with table, date and optional time_of_day
+
+    Returns:
+        tuple: SQL condition and parameter dict
+    """
+    
+    condition = f"margin_type = ANY(:margins) AND date = :{prefix}_date"
+    params = {f"{prefix}_date": report["date"]}
+    
+    if report.get("time_of_day") is not None:
+        condition += f" AND time_of_day = :{prefix}_time_of_day"
+        params[f"{prefix}_time_of_day"] = report["time_of_day"]
+    
+    return condition, params
+
+def reconciliation_query(left, right, columns):
+    """Generates a set-based reconciliation of two report slices, rows are paired
+       one-to-one per key occurrence so duplicated keys do not multiply
+
+    Args:
+        left (dict): report description of the left side
+        right (dict): report description of the right side
+        columns (list): the columns which should be matched against, must contain margin_type
+
+    Returns:
+        tuple: TextClause and parameter dict
+    """
+    
+    left_condition, left_params = report_filter("left", left)
+    right_condition, right_params = report_filter("right", right)
+    
+    key = ", ".join(columns)
+    coalesced = ", ".join(f"COALESCE(l.{column}, r.{column}) AS {column}" for column in columns)
+    join_on = " AND ".join(f"l.{column} = r.{column}" for column in columns)
+    counted = ", ".join(column if column == "margin_type" else f"NULL AS {column}" for column in columns)
+    
+    query = f"""
+        WITH left_side AS (
+            SELECT {key}, ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY id) AS occurrence
+            FROM {left["table"]}
+            WHERE {left_condition}
+        ), right_side AS (
+            SELECT {key}, ROW_NUMBER() OVER (PARTITION BY {key} ORDER BY id) AS occurrence
+            FROM {right["table"]}
+            WHERE {right_condition}
+        ), joined AS (
+            SELECT {coalesced},
+                   CASE WHEN r.occurrence IS NULL THEN 'left_only'
+                        WHEN l.occurrence IS NULL THEN 'right_only'
+                        ELSE 'both' END AS _merge
+            FROM left_side l
+            FULL OUTER JOIN right_side r ON {join_on} AND l.occurrence = r.occurrence
+        )
+        SELECT {key}, _merge, 1 AS row_count FROM joined WHERE _merge <> 'both'
+        UNION ALL
+        SELECT {counted}, 'both' AS _merge, COUNT(*) AS row_count FROM joined
+        WHERE _merge = 'both' GROUP BY margin_type
+    """
+    
+    return text(query), {**left_params, **right_params}
+
+def report_label(report):
+    if report.get("margin") is None:
+        return report["name"]
+    return f"{report['name']}_{report['margin']}"
+
+def process_reports_sql(left, right, columns, margins=None, database=DATABASE):
+    """Reconciles two report slices on the database server and transfers only the
+       non-matching rows plus the number of matches per margin class
+
+    Args:
+        left (dict): report description (name, table, date, time_of_day, margin) of the left side
+        right (dict): report description of the right side
+        columns (list): the columns which should be matched against
+        margins (list, optional): margin classes to reconcile. Defaults to the left report's margin
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        list: two DataFrames, first the matched row count per margin_type, second the
+              non-matching items with their source
+    """
+    
+    margins = margins or [left["margin"]]
+    query, params = reconciliation_query(left, right, columns)
+    params["margins"] = list(margins)
+    
+    try:
+        with get_engine(database).connect() as connection, logged_query(query, params, database) as entry:
+            result = pd.read_sql_query(query, connection, params=params)
+            entry["rows"] = len(result)
+        
+        both = result["_merge"] == "both"
+        
+        matching = (result.loc[both, ["margin_type", "row_count"]]
+                    .rename(columns={"row_count": "matched"})
+                    .set_index("margin_type")
+                    .reindex(margins, fill_value=0)
+                    .reset_index())
+        
+        non_matching = result.loc[~both].reset_index(drop=True)
+        non_matching["source"] = non_matching["_merge"].map({
+            "left_only": f"found in {report_label(left)}",
+            "right_only": f"found in {report_label(right)}",
+        })
+        if "margin" in non_matching.columns:
+            non_matching["margin"] = pd.to_numeric(non_matching["margin"], errors="coerce")
+        
+        return [matching, non_matching[columns + ["source"]]]
+    except Exception as e:
+        print(f"Error processing reports on the server: {str(e)}")
+        return None
+
+def key_counts(df, columns):
+    """counts the occurrences of every key in a report
+
+    Args:
+        df (DataFrame): report items
+        columns (list): the columns forming the key
+
+    Returns:
+        Series: number of occurrences indexed by key
+    """
+    
+    return df.groupby(columns, sort=False, dropna=False, observed=True).size()
+
+def diff_counts(left_counts, right_counts, columns, left_name, right_name):
+    """compares key occurrence counts of two reports, each key is visited once no
+       matter how often it occurs, so duplicated keys cannot multiply rows
+
+    Args:
+        left_counts (Series): occurrences per key of the left report, see key_counts
+        right_counts (Series): occurrences per key of the right report
+        columns (list): the columns forming the key
+        left_name (string): name of the left report used in the source tag
+        right_name (string): name of the right report used in the source tag
+
+    Returns:
+        list: two DataFrames, first the matched keys, second the surplus keys, both
+              with their multiplicity, the second also with source and category
+    """
+    
+    counts = pd.concat(
+        [left_counts.rename("left_count"), right_counts.rename("right_count")],
+        axis=1).fillna(0).astype("int64")
+    
+    return split_counts(counts, left_name, right_name)
+
+def classify_counts(counts):
+    """categorises every key of an aligned count frame
+
+    Args:
+        counts (DataFrame): left_count and right_count per key
+
+    Returns:
+        Series: "matched", "left_only", "right_only" or "duplicated" per key
+    """
+    
+    left_count = counts["left_count"]
+    right_count = counts["right_count"]
+    
+    duplicated = ((left_count > 0) & (right_count > 0)) | (counts[["left_count", "right_count"]].max(axis=1) > 1)
+    
+    category = pd.Series("matched", index=counts.index)
+    category = category.mask(left_count > right_count, "left_only")
+    category = category.mask(left_count < right_count, "right_only")
+    
+    return category.mask((left_count != right_count) & duplicated, "duplicated")
+
+def split_counts(counts, left_name, right_name):
+    """turns an aligned count frame into the matched and the surplus keys
+
+    Returns:
+        list: two DataFrames, see diff_counts
+    """
+    
+    left_count = counts["left_count"]
+    right_count = counts["right_count"]
+    surplus = left_count - right_count
+    
+    matched = counts.loc[(left_count > 0) & (right_count > 0)]
+    matching = (pd.DataFrame({"multiplicity": matched[["left_count", "right_count"]].min(axis=1)})
+                .reset_index())
+    
+    unmatched = surplus != 0
+    is_left = surplus.loc[unmatched] > 0
+    
+    non_matching = pd.DataFrame({
+        "multiplicity": surplus.loc[unmatched].abs(),
+        "source": is_left.map({True: f"found in {left_name}", False: f"found in {right_name}"}),
+        "category": classify_counts(counts.loc[unmatched]),
+    }).reset_index()
+    
+    return [matching, non_matching]
+
+def process_reports_counted(df1, df2, columns):
+    """Takes two Pandas DataFrames and matches them by counting the occurrences of
+       every key on both sides instead of merging the rows
+
+    Args:
+        df1 (DataFrame): dataframe which should be compared
+        df2 (DataFrame): dataframe which should be compared
+        columns (list): the columns which should be matched against
+
+    Returns:
+        list: two Dataframes, first which keys got matched, second which did not,
+              categorised as "left_only", "right_only" or "duplicated"
+    """
+    
+    try:
+        return diff_counts(
+            key_counts(df1, columns),
+            key_counts(df2, columns),
+            columns,
+            df1.name,
+            df2.name)
+    except Exception as e:
+        print(f"Error processing reports: {str(e)}")
+        return None
+
+class ReconciliationIndex:
+    """Hashed key index over a reference report (e.g. the cc050 EOD report), built
+       once and probed with any number of snapshots (e.g. every ci050 snapshot)
+
+    Args:
+        df (DataFrame): reference report items
+        columns (list): the columns which should be matched against
+        name (string, optional): name used in the source tag. Defaults to df.name
+    """
+    
+    def __init__(self, df, columns, name=None):
+        self.columns = list(columns)
+        self.name = name or getattr(df, "name", "reference")
+        self.counts = key_counts(df, self.columns)
+    
+    def align(self, df):
+        """aligns the key counts of a snapshot with the reference, only the snapshot
+           keys are hashed, the reference hash table is reused between probes
+
+        Returns:
+            DataFrame: left_count (reference) and right_count (snapshot) per key
+        """
+        
+        snapshot_counts = key_counts(df, self.columns)
+        positions = self.counts.index.get_indexer(snapshot_counts.index)
+        found = positions >= 0
+        
+        right_count = np.zeros(len(self.counts), dtype="int64")
+        right_count[positions[found]] = snapshot_counts.to_numpy()[found]
+        
+        known = pd.DataFrame(
+            {"left_count": self.counts.to_numpy(), "right_count": right_count},
+            index=self.counts.index)
+        unknown = pd.DataFrame(
+            {"left_count": 0, "right_count": snapshot_counts.to_numpy()[~found]},
+            index=snapshot_counts.index[~found])
+        
+        return pd.concat([known, unknown])
+    
+    def probe(self, df, name=None):
+        """reconciles a snapshot against the reference, see diff_counts
+
+        Returns:
+            list: two DataFrames, matched and surplus keys
+        """
+        
+        return split_counts(self.align(df), self.name, name or getattr(df, "name", "snapshot"))
+    
+    def summary(self, df):
+        """counts matched and break rows of a snapshot per margin class
+
+        Returns:
+            DataFrame: matched, left_only, right_only and duplicated rows per margin_type
+        """
+        
+        counts = self.align(df)
+        category = classify_counts(counts).to_numpy()
+        surplus = (counts["left_count"] - counts["right_count"]).abs().to_numpy()
+        
+        if "margin_type" in self.columns:
+            margin_type = counts.index.get_level_values("margin_type")
+        else:
+            margin_type = np.full(len(counts), "all")
+        
+        frame = pd.DataFrame({
+            "margin_type": margin_type,
+            "matched": np.minimum(counts["left_count"].to_numpy(), counts["right_count"].to_numpy()),
+        })
+        for name in ["left_only", "right_only", "duplicated"]:
+            frame[name] = np.where(category == name, surplus, 0)
+        
+        return frame.groupby("margin_type", observed=True).sum()
+
+def drift_matrix(reference, snapshots, columns, by=("date", "time_of_day")):
+    """Probes every snapshot contained in a frame against one reference report
+
+    Args:
+        reference (DataFrame or ReconciliationIndex): reference report or a prebuilt index
+        snapshots (DataFrame): items of any number of snapshots
+        columns (list): the columns which should be matched against
+        by (tuple, optional): columns identifying a snapshot. Defaults to (date, time_of_day)
+
+    Returns:
+        DataFrame: one row per snapshot and margin class with matched, left_only,
+                   right_only and duplicated row counts
+    """
+    
+    by = list(by)
+    index = reference if isinstance(reference, ReconciliationIndex) else ReconciliationIndex(reference, columns)
+    
+    frames = []
+    for snapshot_key, snapshot in snapshots.groupby(by, sort=True):
+        summary = index.summary(snapshot).reset_index()
+        for column, value in zip(by, snapshot_key):
+            summary[column] = value
+        frames.append(summary)
+    
+    result_columns = by + ["margin_type", "matched", "left_only", "right_only", "duplicated"]
+    if not frames:
+        return pd.DataFrame(columns=result_columns)
+    
+    return pd.concat(frames, ignore_index=True)[result_columns]
+
+def process_reports_tolerance(df1, df2, columns, abs_tolerance=0.0, rel_tolerance=0.0):
+    """Takes two Pandas DataFrames and matches them on every column except margin,
+       margins are compared within an absolute or relative tolerance
+
+    Within a key both sides are sorted by margin and paired in one sweep: two margins
+    within the tolerance form a pair, otherwise the smaller one is skipped, which pairs
+    as many margins as possible. Margins left over on both sides of a key are paired
+    in sorted order and reported as a difference, those left over on one side only
+    are left_only/right_only.
+
+    Args:
+        df1 (DataFrame): dataframe which should be compared
+        df2 (DataFrame): dataframe which should be compared
+        columns (list): the columns which should be matched against, margin is compared
+            with tolerance, all others exactly
+        abs_tolerance (float, optional): accepted absolute difference. Defaults to 0.0
+        rel_tolerance (float, optional): accepted difference relative to the larger margin.
+            Defaults to 0.0
+
+    Returns:
+        list: two DataFrames, first the pairs with status "matched" or "within_tolerance",
+              second the items with status "break" and their source
+    """
+    
+    key = [column for column in columns if column != "margin"]
+    
+    epsilon = float(np.finfo("float64").eps)
+    
+    def within(left, right):
+        magnitude = np.fmax(np.abs(left), np.abs(right))
+        # float representation noise must not turn 0.01 into a break at a 0.01 tolerance
+        tolerance = np.maximum(abs_tolerance, rel_tolerance * magnitude) + 4 * epsilon * magnitude
+        return np.abs(left - right) <= tolerance
+    
+    def within_scalar(left, right):
+        magnitude = max(abs(left), abs(right))
+        tolerance = max(abs_tolerance, rel_tolerance * magnitude) + 4 * epsilon * magnitude
+        return abs(left - right) <= tolerance
+    
+    def side(df, group):
+        margin = pd.to_numeric(df["margin"], errors="coerce").to_numpy(dtype="float64")
+        return pd.DataFrame({"group": group, "margin": margin, "row": np.arange(len(df))})
+    
+    def occurrence(df):
+        df = df.sort_values(["group", "margin", "row"], kind="stable")
+        return df.assign(occurrence=df.groupby("group", sort=False).cumcount())
+    
+    def sweep(left, right):
+        # both sides sorted by margin within a group, the smaller margin of a pair out of
+        # tolerance can not be paired with anything later, which gives the largest matching
+        left = left.sort_values(["group", "margin", "row"], kind="stable")
+        right = right.sort_values(["group", "margin", "row"], kind="stable")
+        left_group, left_margin, left_row = (left[column].tolist() for column in ("group", "margin", "row"))
+        right_group, right_margin, right_row = (right[column].tolist() for column in ("group", "margin", "row"))
+        
+        pairs = []
+        i = j = 0
+        while i < len(left_row) and j < len(right_row):
+            if left_group[i] != right_group[j]:
+                if left_group[i] < right_group[j]:
+                    i += 1
+                else:
+                    j += 1
+            elif within_scalar(left_margin[i], right_margin[j]):
+                pairs.append((left_row[i], right_row[j]))
+                i += 1
+                j += 1
+            elif left_margin[i] < right_margin[j]:
+                i += 1
+            else:
+                j += 1
+        
+        return pd.DataFrame(pairs, columns=["row_left", "row_right"], dtype="int64")
+    
+    try:
+        # a shared integer group per key keeps the pairing independent of the key dtypes
+        groups = pd.concat([df1[key], df2[key]], ignore_index=True).astype(object).groupby(
+            key, sort=False, dropna=False).ngroup().to_numpy()
+        left_side = side(df1, groups[:len(df1)])
+        right_side = side(df2, groups[len(df1):])
+        
+        paired = sweep(left_side[left_side["margin"].notna()], right_side[right_side["margin"].notna()])
+        unpaired_left = left_side[~left_side["row"].isin(paired["row_left"])]
+        unpaired_right = right_side[~right_side["row"].isin(paired["row_right"])]
+        different = pd.merge(occurrence(unpaired_left), occurrence(unpaired_right),
+                             on=["group", "occurrence"], how="outer", suffixes=("_left", "_right"), indicator=True)
+        
+        # rows backed by a left item first, so the key columns can be taken from df1 and df2 in turn
+        merged = pd.concat([paired.assign(_merge="both"),
+                            different[["row_left", "row_right", "_merge"]].astype({"_merge": object})],
+                           ignore_index=True)
+        merged = merged.sort_values("row_left", kind="stable", na_position="last")
+        rows_left = merged["row_left"].dropna().to_numpy(dtype="int64")
+        rows_right = merged["row_right"].to_numpy(dtype="float64")
+        only_right = rows_right[len(rows_left):].astype("int64")
+        
+        left = np.concatenate([left_side["margin"].to_numpy()[rows_left], np.full(len(only_right), np.nan)])
+        right = np.full(len(merged), np.nan)
+        has_right = ~np.isnan(rows_right)
+        right[has_right] = right_side["margin"].to_numpy()[rows_right[has_right].astype("int64")]
+        difference = np.abs(left - right)
+        
+        both = (merged["_merge"] == "both").to_numpy()
+        status = np.where(both & (difference == 0), "matched",
+                          np.where(both & within(left, right), "within_tolerance", "break"))
+        
+        result = pd.concat([df1[key].iloc[rows_left], df2[key].iloc[only_right]], ignore_index=True)
+        result["left_margin"] = left
+        result["right_margin"] = right
+        result["difference"] = difference
+        result["status"] = status
+        result["source"] = merged["_merge"].map({
+            "left_only": f"found in {df1.name}",
+            "right_only": f"found in {df2.name}",
+            "both": "found in both, difference above tolerance",
+        }).astype(object).to_numpy()
+        
+        matching = result[result["status"] != "break"].drop(columns=["source"])
+        non_matching = result[result["status"] == "break"]
+        
+        return [matching.reset_index(drop=True), non_matching.reset_index(drop=True)]
+    except Exception as e:
+        print(f"Error processing reports: {str(e)}")
+        return None
@@ -0,0 +1,239 @@
+"""Break-report sink
+
+Collects the non-matching items of every margin class and report pair of a run in
+one common layout, categorised as "duplicated", "left_only" (only in the left
+report, e.g. cc050), "right_only" (only in the right one, e.g. ci050) or "difference"
+(margins apart beyond the tolerance). Buffered breaks are written in batches of
+SINK['batch_rows'] to the recon_breaks table (COPY on Postgres), a Parquet file or a
+CSV file, and the run ends with a single summary line instead of printed frames.
+"""
+
+import os
+import time
+
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from config.settings import DATABASE, SINK
+from .db_utils import bulk_insert_rows
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+SINK_TARGETS = ["table", "parquet", "csv"]
+
+BREAK_CATEGORIES = ["duplicated", "left_only", "right_only", "difference"]
+
+BREAK_COLUMNS = [
+    "run_id", "left_report", "right_report", "margin_class", "clearing_member", "account",
+    "margin_type", "margin", "difference", "category", "multiplicity", "source",
+]
+
+KEY_COLUMNS = ["clearing_member", "account", "margin_type"]
+
+def new_run_id(now=None):
+    now = now or datetime.now()
+    return f"{now:%Y%m%dT%H%M%S}-{os.getpid()}"
+
+def categorize_breaks(non_matching, left_name, right_name):
+    """brings the non-matching items of any engine and matching mode into the
+       BREAK_COLUMNS layout, without run and report columns
+    
+    Counted and streaming results carry their category already. For row level
+    results an item whose key and margin occur more than once among the breaks is
+    "duplicated", otherwise its source decides between "left_only" and "right_only",
+    tolerance breaks found in both reports are a "difference".
+    
+    Args:
+        non_matching (DataFrame): second result of reconcile_reports
+        left_name (string): name of the left report
+        right_name (string): name of the right report
+    
+    Returns:
+        DataFrame: one row per break
+    """
+    
+    df = non_matching.reset_index(drop=True)
+    breaks = pd.DataFrame({column: df[column] if column in df.columns else None for column in KEY_COLUMNS})
+    
+    if "margin" in df.columns:
+        breaks["margin"] = pd.to_numeric(df["margin"], errors="coerce")
+    elif "left_margin" in df.columns:
+        breaks["margin"] = df["left_margin"].fillna(df["right_margin"])
+    else:
+        breaks["margin"] = np.nan
+    breaks["difference"] = df["difference"] if "difference" in df.columns else np.nan
+    
+    source = df["source"] if "source" in df.columns else pd.Series(None, index=df.index, dtype=object)
+    if "category" in df.columns:
+        category = df["category"].astype(object)
+    else:
+        category = pd.Series("difference", index=df.index, dtype=object)
+        category = category.mask(source == f"found in {left_name}", "left_only")
+        category = category.mask(source == f"found in {right_name}", "right_only")
+        duplicated = breaks.duplicated(subset=KEY_COLUMNS + ["margin"], keep=False)
+        category = category.mask(duplicated & (category != "difference"), "duplicated")
+    
+    breaks["category"] = category
+    breaks["multiplicity"] = df["multiplicity"].astype("int64") if "multiplicity" in df.columns else 1
+    breaks["source"] = source.astype(object)
+    
+    return breaks
+
+class BreakSink:
+    """collects the breaks of a run and writes them in batches
+    
+    Args:
+        target (string, optional): one of SINK_TARGETS. Defaults to SINK['target'],
+            "parquet" falls back to "csv" without pyarrow
+        directory (string, optional): output directory of the file targets. Defaults to SINK['directory']
+        batch_rows (int, optional): buffered breaks which trigger a write. Defaults to SINK['batch_rows']
+        run_id (string, optional): identifies the run in the output. Defaults to timestamp and pid
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+    """
+    
+    def __init__(self, target=None, directory=None, batch_rows=None, run_id=None, database=DATABASE):
+        self.target = target or SINK['target']
+        if self.target == "parquet" and not PARQUET_AVAILABLE:
+            self.target = "csv"
+        self.directory = directory or SINK['directory']
+        self.batch_rows = batch_rows or SINK['batch_rows']
+        self.run_id = run_id or new_run_id()
+        self.database = database
+        
+        self.buffer = []
+        self.buffered = 0
+        self.writer = None
+        self.path = None
+        self.written = 0
+        self.write_seconds = 0.0
+        self.pairs = 0
+        self.clean = 0
+        self.categories = Counter()
+        self.margins = Counter()
+        self.errors = []
+    
+    def add(self, left_name, right_name, non_matching, margin=None):
+        """adds the breaks of one report pair
+        
+        Returns:
+            bool: True if the pair has no breaks
+        """
+        
+        self.pairs += 1
+        if non_matching is None or non_matching.empty:
+            self.clean += 1
+            return True
+        
+        breaks = categorize_breaks(non_matching, left_name, right_name)
+        breaks.insert(0, "run_id", self.run_id)
+        breaks.insert(1, "left_report", left_name)
+        breaks.insert(2, "right_report", right_name)
+        breaks.insert(3, "margin_class", margin)
+        
+        self.categories.update(breaks.groupby("category")["multiplicity"].sum().to_dict())
+        self.margins[margin] += int(breaks["multiplicity"].sum())
+        self.buffer.append(breaks[BREAK_COLUMNS])
+        self.buffered += len(breaks)
+        
+        if self.buffered >= self.batch_rows:
+            self.flush()
+        
+        return False
+    
+    def record_error(self, message):
+        self.errors.append(message)
+    
+    def flush(self):
+        """writes the buffered breaks to the target
+        
+        """
+        
+        if not self.buffer:
+            return
+        
+        batch = pd.concat(self.buffer, ignore_index=True)
+        self.buffer = []
+        self.buffered = 0
+        started = time.perf_counter()
+        
+        try:
+            if self.target == "table":
+                # NaN would be written as the float NaN, missing values go in as NULL
+                rows = batch.astype(object).where(batch.notna(), None).itertuples(index=False, name=None)
+                if bulk_insert_rows("recon_breaks", BREAK_COLUMNS, rows, database=self.database) is None:
+                    raise Exception("recon_breaks could not be written")
+            else:
+                self.write_file(batch)
+            self.written += len(batch)
+        except Exception as e:
+            self.record_error(f"Error writing {len(batch)} breaks: {e}")
+            print(self.errors[-1])
+        finally:
+            self.write_seconds += time.perf_counter() - started
+    
+    def write_file(self, batch):
+        if self.path is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.path = os.path.join(self.directory, f"breaks_{self.run_id}.{self.target}")
+        
+        if self.target == "csv":
+            batch.to_csv(self.path, mode="a", header=self.written == 0, index=False)
+            return
+        
+        table = pa.Table.from_pandas(batch.astype({"margin": "float64", "difference": "float64"}),
+                                     schema=self.schema(), preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+    
+    def schema(self):
+        text = pa.string()
+        return pa.schema([(column, text) for column in BREAK_COLUMNS[:7]] + [
+            ("margin", pa.float64()), ("difference", pa.float64()), ("category", text),
+            ("multiplicity", pa.int64()), ("source", text)])
+    
+    def close(self):
+        """writes the remaining breaks and prints the run summary
+        
+        Returns:
+            dict: run id, target, pairs checked and clean, breaks per category and
+                  margin class, rows written, write time and errors
+        """
+        
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        
+        summary = self.summary()
+        categories = ", ".join(f"{category} {count}" for category, count in summary["categories"].items())
+        print(f"Run {self.run_id}: {self.pairs - self.clean} of {self.pairs} pair(s) with breaks, "
+              f"{summary['breaks']} break(s) ({categories or 'none'}), "
+              f"{self.written} row(s) written to {self.path or self.target} in {self.write_seconds:.2f}s"
+              + (f", {len(self.errors)} error(s)" if self.errors else ""))
+        
+        return summary
+    
+    def summary(self):
+        return {
+            "run_id": self.run_id,
+            "target": self.target,
+            "path": self.path,
+            "pairs": self.pairs,
+            "clean": self.clean,
+            "breaks": int(sum(self.categories.values())),
+            "categories": {category: int(self.categories[category])
+                           for category in BREAK_CATEGORIES if self.categories[category]},
+            "margins": {margin: int(count) for margin, count in self.margins.items()},
+            "written": self.written,
+            "write_seconds": self.write_seconds,
+            "errors": list(self.errors),
+        }
@@ -0,0 +1,151 @@
+"""Streaming, bounded-memory reconciliation for very large report days
+
+Both report slices are split into partitions by a hash computed on the server, each
+partition is read through a server-side cursor in chunks and reduced to key counts,
+so peak memory depends on STREAMING['max_memory_mb'] and not on the table size.
+"""
+
+import math
+import pandas as pd
+
+from sqlalchemy import text
+
+from config.settings import DATABASE, STREAMING
+from .db_utils import get_engine
+from .querylog import logged_query
+from .reconcile import diff_counts, key_counts, report_filter, report_label
+
+# key columns a partition may be hashed on, "key" hashes all of them
+PARTITION_BY = ["key", "clearing_member", "account", "margin_type"]
+
+def partition_expression(columns, partition_by=None):
+    """SQL expression assigning every row to a partition, rows with the same key
+       always share a partition
+
+    Raises:
+        ValueError: if partition_by is not one of PARTITION_BY or not part of the key
+
+    Returns:
+        string: SQL expression using the :partitions parameter
+    """
+    
+    partition_by = partition_by or STREAMING['partition_by']
+    if partition_by not in PARTITION_BY or (partition_by != "key" and partition_by not in columns):
+        raise ValueError(f"Cannot partition by '{partition_by}', expected one of "
+                         f"{', '.join(column for column in PARTITION_BY if column == 'key' or column in columns)}")
+    
+    if partition_by == "key":
+        hashed = f"hashtext(concat_ws('|', {', '.join(f'{column}::text' for column in columns)}))"
+    else:
+        hashed = f"hashtext({partition_by}::text)"
+    
+    return f"abs({hashed}::bigint) % :partitions"
+
+def count_rows(connection, report, margins, database=DATABASE):
+    condition, params = report_filter("side", report)
+    params["margins"] = list(margins)
+    
+    query = text(f"SELECT COUNT(*) FROM {report['table']} WHERE {condition}")
+    with logged_query(query, params, database) as entry:
+        rows = connection.execute(query, params).scalar()
+        entry["rows"] = 1
+    
+    return rows
+
+def partition_count(rows, max_memory_mb=None, bytes_per_row=None):
+    """number of partitions needed to keep the rows of one partition within the budget
+    
+    """
+    
+    max_memory = (max_memory_mb or STREAMING['max_memory_mb']) * 1024 * 1024
+    bytes_per_row = bytes_per_row or STREAMING['bytes_per_row']
+    
+    return max(1, math.ceil(rows * bytes_per_row / max_memory))
+
+def stream_key_counts(connection, report, columns, margins, partition, partitions, chunksize, partition_by=None,
+                      database=DATABASE):
+    """reads one partition of a report slice in chunks and reduces it to key counts,
+       the statement is logged with the rows streamed, see logged_query
+
+    Returns:
+        Series: number of occurrences indexed by key
+    """
+    
+    condition, params = report_filter("side", report)
+    params.update({"margins": list(margins), "partition": partition, "partitions": partitions})
+    
+    query = f"SELECT {', '.join(columns)} FROM {report['table']} WHERE {condition}"
+    if partitions > 1:
+        query += f" AND {partition_expression(columns, partition_by)} = :partition"
+    
+    query = text(query)
+    counts = None
+    with logged_query(query, params, database) as entry:
+        entry["rows"] = 0
+        for chunk in pd.read_sql_query(query, connection, params=params, chunksize=chunksize):
+            entry["rows"] += len(chunk)
+            if "margin" in chunk.columns:
+                chunk["margin"] = pd.to_numeric(chunk["margin"], errors="coerce").astype("float64")
+            
+            chunk_counts = key_counts(chunk, columns)
+            counts = chunk_counts if counts is None else counts.add(chunk_counts, fill_value=0)
+    
+    if counts is None:
+        return pd.Series(dtype="int64", index=pd.MultiIndex.from_tuples([], names=columns))
+    
+    return counts.astype("int64")
+
+def process_reports_streaming(left, right, columns, margins=None, max_memory_mb=None,
+                              chunksize=None, partition_by=None, database=DATABASE):
+    """Reconciles two report slices partition by partition, each partition is
+       streamed from a server-side cursor and matched on key counts
+
+    Args:
+        left (dict): report description (name, table, date, time_of_day, margin) of the left side
+        right (dict): report description of the right side
+        columns (list): the columns which should be matched against
+        margins (list, optional): margin classes to reconcile. Defaults to the left report's margin
+        max_memory_mb (int, optional): memory budget per partition. Defaults to STREAMING['max_memory_mb']
+        chunksize (int, optional): rows per fetch. Defaults to STREAMING['chunksize']
+        partition_by (string, optional): one of PARTITION_BY, "key" hashes the whole key.
+            Defaults to STREAMING['partition_by']
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        list: two DataFrames, first the matched row count per margin_type, second the
+              non-matching keys with multiplicity, source and category
+    """
+    
+    margins = margins or [left["margin"]]
+    chunksize = chunksize or STREAMING['chunksize']
+    
+    try:
+        engine = get_engine(database)
+        
+        with engine.connect() as connection:
+            rows = count_rows(connection, left, margins, database) + count_rows(connection, right, margins, database)
+        partitions = partition_count(rows, max_memory_mb)
+        
+        matched = pd.Series(0, index=pd.Index(margins, name="margin_type"), dtype="int64")
+        breaks = []
+        
+        for partition in range(partitions):
+            with engine.connect().execution_options(stream_results=True, max_row_buffer=chunksize) as connection:
+                left_counts = stream_key_counts(connection, left, columns, margins, partition,
+                                                partitions, chunksize, partition_by, database)
+                right_counts = stream_key_counts(connection, right, columns, margins, partition,
+                                                 partitions, chunksize, partition_by, database)
+            
+            matching, non_matching = diff_counts(
+                left_counts, right_counts, columns, report_label(left), report_label(right))
+            
+            partition_matched = matching.groupby("margin_type")["multiplicity"].sum()
+            matched = matched.add(partition_matched, fill_value=0).astype("int64")
+            breaks.append(non_matching)
+        
+        print(f"Streamed {rows} rows in {partitions} partition(s)")
+        
+        return [matched.rename("matched").reset_index(), pd.concat(breaks, ignore_index=True)]
+    except Exception as e:
+        print(f"Error processing reports in streaming mode: {str(e)}")
+        return None
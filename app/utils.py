@@ -2,12 +2,30 @@ import numpy as np
 import pandas as pd
 
 from datetime import datetime, date, timedelta
-from sqlalchemy import create_engine
+from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
 
-from config.settings import DATABASE
+from config.settings import DATABASE, FETCH, PARALLEL, RECONCILIATION
 from .db import *
+from .cache import report_cache, slice_fingerprints
+from .catalog import resolve_reports
 from .errors import *
+from .metrics import frame_size, stage
+from .querylog import logged_query
+from .reconcile import (
+    ReconciliationIndex,
+    drift_matrix,
+    process_reports_counted,
+    process_reports_sql,
+    process_reports_tolerance,
+)
+from .streaming import process_reports_streaming
+
+FETCH_MODES = ["per_margin", "batched", "handles"]
+CATEGORICAL_COLUMNS = ["clearing_member", "account", "margin_type", "date", "time_of_day"]
+RECONCILIATION_ENGINES = ["pandas", "sql", "streaming"]
+SERVER_SIDE_ENGINES = ["sql", "streaming"]
+MATCHING_MODES = ["merge", "counted", "tolerance"]
 
 def send_report(is_valid, message):
     if is_valid:
@@ -49,33 +67,63 @@ def validate_input(report_settings):
         
         if not isinstance(report.get("valid_report"), bool):
             return False, "Report valid_report is not a boolean."
+    
+    fetch_mode = report_settings.get("fetch_mode")
+    if fetch_mode is not None and fetch_mode not in FETCH_MODES:
+        return False, f"Invalid fetch_mode: {fetch_mode}"
+    
+    engine = report_settings.get("engine")
+    if engine is not None and engine not in RECONCILIATION_ENGINES:
+        return False, f"Invalid engine: {engine}"
+    
+    matching = report_settings.get("matching")
+    if matching is not None and matching not in MATCHING_MODES:
+        return False, f"Invalid matching: {matching}"
+    
+    if not isinstance(report_settings.get("parallel", False), bool):
+        return False, "parallel is not a boolean."
+    
+    workers = report_settings.get("workers")
+    if workers is not None and (not isinstance(workers, int) or workers < 1):
+        return False, f"Invalid workers: {workers}"
+    
+    if backend() == "sqlite" and reconciliation_engine(report_settings) in SERVER_SIDE_ENGINES:
+        return False, "The sql and streaming engines need the Postgres backend."
+    
+    if in_memory() and report_settings.get("parallel", PARALLEL['enabled']) and PARALLEL['processes']:
+        return False, "An in-memory SQLite database is not shared with worker processes, set STORAGE_PATH."
 
     return True, "Validation passed."
 
 def create_alchemy_connection(database=DATABASE):
     
-    """Creates a connection to a Postgres database based on settings database
+    """Checks out a connection to a Postgres database based on settings database
+       from the shared engine pool, closing the connection returns it to the pool
 
     Returns:
         connection
     """
     
-    engine_url = f'postgresql://{database["user"]}:{database["password"]}@{database["host"]}:{database["port"]}/{database["name"]}'
-    engine = create_engine(engine_url)
-
     try:
-        engine = create_engine(engine_url)
-        connection = engine.connect()
+        connection = get_engine(database).connect()
         return connection
     except SQLAlchemyError as e:
         raise CustomError(f"SQLAlchemyError connecting to database: {str(e)}")
     except Exception as e:
         print(f"Error connecting to database: {str(e)}")
-        engine.dispose()
         return None
     
-def create_dates():
-    now = datetime(2020, 5, 12, 0, 0, 0)
+def create_dates(now=None):
+    """dates and times of the reports to check for a run day
+
+    Args:
+        now (datetime, optional): run day. Defaults to 2020-05-12
+
+    Returns:
+        dict: last_day, current_day, max_time_of_day and min_time_of_day as strings
+    """
+    
+    now = now or datetime(2020, 5, 12, 0, 0, 0)
 
     last_day = (now - timedelta(days=1)).replace(hour=19, minute=0, second=0, microsecond=0).strftime('%Y-%m-%d')
     current_day = now.strftime('%Y-%m-%d')
@@ -88,7 +136,8 @@ def create_dates():
             "min_time_of_day": min_time_of_day}
     
 def query_generator(table, margin, date, time_of_day=None):
-    """Generates a query based on the report settings setup
+    """Generates a query based on the report settings setup, the filter values are
+       bound parameters so the statement text is the same for every margin class
 
     Args:
         table (sting): table name
@@ -97,18 +146,111 @@ def query_generator(table, margin, date, time_of_day=None):
         time_of_day (string, optional): time of the. Defaults to None.
 
     Returns:
-        string: SQL select statement
+        TextClause: SQL select statement with the values bound to :margin, :date and :time_of_day
     """
     
     query = (f"SELECT * "
              f"FROM {table} "
-             f"WHERE margin_type = '{margin}' "
-             f"AND date = '{date}';")
+             f"WHERE margin_type = :margin "
+             f"AND date = :date")
+    params = {"margin": margin, "date": date}
     
     if time_of_day is not None:
-        query = query[:-1] + f" AND time_of_day = '{time_of_day}';"
+        query += " AND time_of_day = :time_of_day"
+        params["time_of_day"] = time_of_day
     
-    return query
+    return text(query).bindparams(**params)
+
+def batched_query_generator(table, date, time_of_day=None, database=DATABASE):
+    """Generates a single query for all margin classes of a report, the margin
+       classes are bound to the :margins parameter as an array
+
+    Args:
+        table (sting): table name
+        date (string): date of report
+        time_of_day (string, optional): time of the. Defaults to None.
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        TextClause: SQL select statement with :margins, :date and :time_of_day parameters
+    """
+    
+    query = (f"SELECT * "
+             f"FROM {table} "
+             f"WHERE margin_type = ANY(:margins) "
+             f"AND date = :date")
+    
+    if time_of_day is not None:
+        query += " AND time_of_day = :time_of_day"
+    
+    return text_with_lists(query, ["margins"], backend(database))
+
+def type_report_frame(df):
+    """casts the report columns to their typed representation, independent of
+       whether the table uses the VARCHAR (version 1) or typed (version 2) schema
+
+    Args:
+        df (DataFrame): report items as returned by the database
+
+    Returns:
+        DataFrame: date as datetime64, time_of_day as timedelta64 and margin as float64
+    """
+    
+    if "date" in df.columns:
+        df["date"] = pd.to_datetime(df["date"], errors="coerce")
+    if "time_of_day" in df.columns:
+        df["time_of_day"] = pd.to_timedelta(df["time_of_day"].astype(str), errors="coerce")
+    if "margin" in df.columns:
+        df["margin"] = pd.to_numeric(df["margin"], errors="coerce").astype("float64")
+    
+    return df
+
+def split_by_margin(df, report_name, margins):
+    """splits a report DataFrame into one DataFrame per margin class, named the
+       same way get_margins names its result
+
+    Returns:
+        dict: margin class as key, DataFrame as value
+    """
+    
+    groups = dict(tuple(df.groupby("margin_type", sort=False)))
+    
+    frames = {}
+    for margin in margins:
+        frame = groups.get(margin, df.iloc[0:0]).reset_index(drop=True)
+        report = df.attrs.get("report", {})
+        frames[margin] = name_report_frame(
+            frame, report_name, report.get("table"), margin, report.get("date"), report.get("time_of_day"))
+    
+    return frames
+
+def report_handle(report_name, table, margin, date, time_of_day=None):
+    """describes a report slice without fetching it, used by the SQL engine which
+       reconciles on the database server
+
+    Returns:
+        DataFrame: empty frame named like get_margins with the report description in attrs
+    """
+    
+    return name_report_frame(pd.DataFrame(), report_name, table, margin, date, time_of_day)
+
+def name_report_frame(df, report_name, table, margin, date, time_of_day=None):
+    """names a report frame per margin class and stores the report description in attrs
+
+    Returns:
+        DataFrame: the same frame
+    """
+    
+    df.name = f"{report_name}_{margin}"
+    df.attrs["report"] = {
+        "name": report_name,
+        "table": table,
+        "date": date,
+        "time_of_day": time_of_day,
+        "margin": margin,
+    }
+    
+    return df
 
 def get_margins(report_name, table, margin, date, time_of_day=None, database=DATABASE):
     """creates a connection to the database and executes a SQL select statement
@@ -131,17 +273,92 @@ def get_margins(report_name, table, margin, date, time_of_day=None, database=DAT
     
     connection = None
     
+    labels = {"margin": margin, "report": report_name}
+    
     try:    
-        connection = create_alchemy_connection(database)
+        with stage("connection", **labels):
+            connection = create_alchemy_connection(database)
     
         if connection is None:
             raise CustomError("Failed to establish database connection")
         
-        query = query_generator(table, margin, date, time_of_day)
-        df = pd.read_sql_query(query, connection)
-               
-        df_name = f"{report_name}_{margin}"
-        df.name = df_name
+        cache = report_cache()
+        df = None
+        
+        if cache is not None:
+            key = (table, date, time_of_day, margin)
+            fingerprint = slice_fingerprints(connection, table, [margin], date, time_of_day)[margin]
+            df = cache.get(key, fingerprint)
+        
+        if df is None:
+            query = query_generator(table, margin, date, time_of_day)
+            # the query log runs a slow statement's EXPLAIN once the stage timer stopped
+            with logged_query(query, database=database) as entry, stage("query", **labels) as record:
+                df = frame_size(record, pd.read_sql_query(prepare_query(connection, query), connection))
+                entry["rows"] = len(df)
+            with stage("dataframe", **labels) as record:
+                df = frame_size(record, type_report_frame(df))
+            
+            if cache is not None:
+                cache.put(key, fingerprint, df)
+        
+        return name_report_frame(df, report_name, table, margin, date, time_of_day)
+    
+    except CustomError as e:
+        print(str(e))
+        return None
+    except Exception as e:
+        print(f"Error getting margins: {str(e)}")
+        return None
+    
+    finally:
+        if connection is not None:
+            connection.close()
+
+def get_report(report_name, table, margins, date, time_of_day=None, database=DATABASE):
+    """queries all requested margin classes of a report in a single round-trip
+
+    Args:
+        report_name (string): which report should be queried
+        table (sting): table name
+        margins (list): types of margin
+        date (string): date of report
+        time_of_day (string, optional): time of the, None selects every snapshot
+            of the date. Defaults to None.
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        DataFrame: items returned from the database, None on failure
+    """
+    
+    connection = None
+    
+    labels = {"margin": "all", "report": report_name}
+    
+    try:
+        with stage("connection", **labels):
+            connection = create_alchemy_connection(database)
+    
+        if connection is None:
+            raise CustomError("Failed to establish database connection")
+        
+        query = batched_query_generator(table, date, time_of_day, database)
+        params = {"margins": list(margins), "date": date}
+        if time_of_day is not None:
+            params["time_of_day"] = time_of_day
+        
+        with logged_query(query, params, database) as entry, stage("query", **labels) as record:
+            df = frame_size(record, pd.read_sql_query(prepare_query(connection, query), connection, params=params))
+            entry["rows"] = len(df)
+        with stage("dataframe", **labels) as record:
+            df = frame_size(record, type_report_frame(df))
+        df.attrs["report"] = {
+            "name": report_name,
+            "table": table,
+            "date": date,
+            "time_of_day": time_of_day,
+        }
+        df.name = report_name
         
         return df
     
@@ -156,12 +373,124 @@ def get_margins(report_name, table, margin, date, time_of_day=None, database=DAT
         if connection is not None:
             connection.close()
 
-def fetch_reports(report_config):
+def get_report_margins(report_name, table, margins, date, time_of_day=None, database=DATABASE):
+    """queries all requested margin classes of a report in a single round-trip and
+       splits the result by margin class in memory
+
+    Args:
+        see get_report
+
+    Returns:
+        dict: margin class as key, DataFrame as value, None on failure
+    """
+    
+    cache = report_cache()
+    cached = {}
+    fingerprints = {}
+    
+    if cache is not None:
+        fingerprints = get_fingerprints(table, margins, date, time_of_day, database) or {}
+        for margin, fingerprint in fingerprints.items():
+            df = cache.get((table, date, time_of_day, margin), fingerprint)
+            if df is not None:
+                cached[margin] = name_report_frame(df, report_name, table, margin, date, time_of_day)
+    
+    missing = [margin for margin in margins if margin not in cached]
+    frames = {}
+    
+    if missing:
+        df = get_report(report_name, table, missing, date, time_of_day, database)
+        
+        if df is None:
+            return None
+        
+        frames = split_by_margin(df, report_name, missing)
+        
+        for margin in missing:
+            if margin in fingerprints:
+                cache.put((table, date, time_of_day, margin), fingerprints[margin], frames[margin])
+    
+    frames.update(cached)
+    
+    return {margin: frames[margin] for margin in margins}
+
+def get_fingerprints(table, margins, date, time_of_day=None, database=DATABASE):
+    """fingerprints every margin class of a report slice for the report cache
+
+    Returns:
+        dict: margin class as key, [row count, max(id)] as value, None on failure
+    """
+    
+    connection = None
+    
+    try:
+        connection = create_alchemy_connection(database)
+        
+        if connection is None:
+            raise CustomError("Failed to establish database connection")
+        
+        return slice_fingerprints(connection, table, margins, date, time_of_day)
+    
+    except Exception as e:
+        print(f"Error getting fingerprints: {str(e)}")
+        return None
+    
+    finally:
+        if connection is not None:
+            connection.close()
+
+def fetch_drift_matrix(report_config, reference="cc050_eod_report", table="ci050", dates=None):
+    """probes every intraday snapshot of a table against one reference report, the
+       reference is fetched and indexed once
+
+    Args:
+        report_config (dict): report configuration setup
+        reference (string, optional): name of the reference report. Defaults to "cc050_eod_report"
+        table (string, optional): table holding the snapshots. Defaults to "ci050"
+        dates (list, optional): snapshot dates. Defaults to the dates of the reports on table
+
+    Returns:
+        DataFrame: drift matrix, see drift_matrix, None on failure
+    """
+    
+    margins = report_config['margin_classes']
+    columns = report_config['cols_to_check']
+    
+    try:
+        report = next(item for item in report_config['reports'] if item['name'] == reference)
+        reference_df = get_report(reference, report['table'], margins, report['date'], report.get('time_of_day'))
+        if reference_df is None:
+            raise Exception(f"Error fetching report '{reference}'")
+        
+        index = ReconciliationIndex(reference_df, columns)
+        
+        if dates is None:
+            dates = sorted({item['date'] for item in report_config['reports'] if item['table'] == table})
+        
+        snapshots = []
+        for date in dates:
+            df = get_report(f"{table}_snapshots", table, margins, date)
+            if df is None:
+                raise Exception(f"Error fetching snapshots of '{table}' for '{date}'")
+            snapshots.append(df)
+        
+        return drift_matrix(index, pd.concat(snapshots, ignore_index=True), columns)
+    
+    except Exception as e:
+        print(f"Error fetching drift matrix: {str(e)}")
+        return None
+
+def fetch_reports(report_config, fetch_mode=None, database=DATABASE):
     """runs through the report configuration dict and queries for each margin class
        and report type the items accordingly
 
     Args:
         report_config (dict): report configuration setup
+        fetch_mode (string, optional): "per_margin" runs one query per margin class and
+            report, "batched" one query per report and "handles" fetches nothing but
+            describes each report slice for the server-side engines. Defaults to
+            report_config['fetch_mode'] or FETCH['mode']
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
 
     Raises:
         Exception: if a query cannot be executed successfully
@@ -169,6 +498,37 @@ def fetch_reports(report_config):
     Returns:
         dict: a nested dictionary with margins and reported dataframes as keys 
     """
+    fetch_mode = fetch_mode or report_config.get('fetch_mode') or FETCH['mode']
+    
+    try:
+        # symbolic snapshots ("first", "last", "latest:N") are looked up in the catalog
+        report_config = resolve_reports(report_config, database)
+    except Exception as e:
+        print(f"Error resolving report snapshots: {e}")
+        return None
+    
+    if fetch_mode == "batched":
+        reports = fetch_reports_batched(report_config, database)
+    else:
+        reports = fetch_reports_per_margin(report_config, fetch_mode, database)
+    
+    if reports is not None and fetch_mode != "handles" and report_config.get('compact', FETCH['compact']):
+        compact_reports(reports)
+    
+    return reports
+
+def fetch_reports_per_margin(report_config, fetch_mode="per_margin", database=DATABASE):
+    """same as fetch_reports, but runs one query per margin class and report
+
+    Args:
+        report_config (dict): report configuration setup
+        fetch_mode (string, optional): "per_margin" or "handles". Defaults to "per_margin"
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        dict: a nested dictionary with margins and reported dataframes as keys 
+    """
+    
     reports = {}
     
     try:
@@ -180,7 +540,10 @@ def fetch_reports(report_config):
                 date = report['date']
                 time_of_day = report.get('time_of_day', None)
                 
-                df = get_margins(report_name, table, margin, date, time_of_day)
+                if fetch_mode == "handles":
+                    df = report_handle(report_name, table, margin, date, time_of_day)
+                else:
+                    df = get_margins(report_name, table, margin, date, time_of_day, database)
                 
                 if df is None:
                     raise Exception(f"Error fetching report '{report_name}' for margin '{margin}'")
@@ -193,18 +556,107 @@ def fetch_reports(report_config):
         print(f"Error fetching reports: {str(e)}")
         return None
 
-def process_reports(df1, df2, columns):
+def fetch_reports_batched(report_config, database=DATABASE):
+    """same as fetch_reports, but runs one query per report for all margin classes
+
+    Args:
+        report_config (dict): report configuration setup
+        database (dict, optional): dictionary with the database connection setup. Defaults to DATABASE
+
+    Returns:
+        dict: a nested dictionary with margins and reported dataframes as keys 
+    """
+    
+    margins = report_config['margin_classes']
+    reports = {margin: {} for margin in margins}
+    
+    try:
+        for report in report_config['reports']:
+            report_name = report['name']
+            
+            frames = get_report_margins(
+                report_name,
+                report['table'],
+                margins,
+                report['date'],
+                report.get('time_of_day', None),
+                database)
+            
+            if frames is None:
+                raise Exception(f"Error fetching report '{report_name}'")
+            
+            for margin in margins:
+                reports[margin][report_name] = frames[margin]
+        
+        return reports
+    
+    except Exception as e:
+        print(f"Error fetching reports: {str(e)}")
+        return None
+
+def compact_reports(reports, columns=None):
+    """converts the key columns of all report frames to categoricals sharing one
+       dictionary per column, so cc050 and ci050 frames are joined on integer codes,
+       and the margin column to float64. The frames are converted in place.
+
+    Args:
+        reports (dict): nested reports dictionary, see fetch_reports
+        columns (list, optional): columns to convert. Defaults to CATEGORICAL_COLUMNS
+
+    Returns:
+        dict: memory use in bytes of all frames before and after the conversion
+    """
+    
+    columns = columns or CATEGORICAL_COLUMNS
+    frames = list({id(df): df for items in reports.values() for df in items.values()}.values())
+    
+    before = int(sum(df.memory_usage(deep=True).sum() for df in frames))
+    
+    for column in columns:
+        values = [df[column].dropna().unique() for df in frames if column in df.columns]
+        if not values:
+            continue
+        
+        categories = pd.Index(np.concatenate(values)).unique().sort_values()
+        dtype = pd.CategoricalDtype(categories)
+        
+        for df in frames:
+            if column in df.columns:
+                df[column] = df[column].astype(dtype)
+    
+    for df in frames:
+        if "margin" in df.columns:
+            df["margin"] = pd.to_numeric(df["margin"], errors="coerce").astype("float64")
+    
+    after = int(sum(df.memory_usage(deep=True).sum() for df in frames))
+    print(f"Report memory: {before} bytes before, {after} bytes after compaction")
+    
+    return {"before": before, "after": after}
+
+def process_reports(df1, df2, columns, matching=None):
     """Takes two Pandas DataFrames and merges them based on the columns specified
 
     Args:
         df1 (DataFrame): dataframe which should be compared
         df2 (DataFrame): dataframe which should be compared
         columns (list): the columns which should be matched against
+        matching (string, optional): "merge" joins the rows, "counted" compares the
+            occurrences per key, see process_reports_counted, "tolerance" compares the
+            margins within RECONCILIATION['abs_tolerance'] / ['rel_tolerance'], see
+            process_reports_tolerance. Defaults to RECONCILIATION['matching']
 
     Returns:
         list: two Dataframes, first which items got matched, second which did not
     """
     
+    matching = matching or RECONCILIATION['matching']
+    
+    if matching == "counted":
+        return process_reports_counted(df1, df2, columns)
+    if matching == "tolerance":
+        return process_reports_tolerance(
+            df1, df2, columns, RECONCILIATION['abs_tolerance'], RECONCILIATION['rel_tolerance'])
+    
     try:
         merged = pd.merge(df1,
                           df2, 
@@ -213,9 +665,9 @@ def process_reports(df1, df2, columns):
                           indicator=True)
         
         matching = merged[merged['_merge'] == 'both']
-        non_matching = merged[merged['_merge'] != 'both']
+        non_matching = merged[merged['_merge'] != 'both'].copy()
         
-        non_matching["source"] = np.nan
+        non_matching["source"] = None
         non_matching.loc[non_matching["_merge"] == "left_only", "source"] = f"found in {df1.name}"
         non_matching.loc[non_matching["_merge"] == "right_only", "source"] = f"found in {df2.name}"
         
@@ -227,7 +679,68 @@ def process_reports(df1, df2, columns):
         print(f"Error processing reports: {str(e)}")
         return None
 
-def check_report(df1, df2, columns):
+def reconciliation_engine(report_config=None):
+    """returns the configured reconciliation engine, "pandas", "sql" or "streaming"
+    
+    """
+    
+    report_config = report_config or {}
+    return report_config.get("engine") or RECONCILIATION['engine']
+
+def reconcile_reports(df1, df2, columns, engine=None, matching=None):
+    """reconciles two reports with the configured engine, see check_report
+
+    Returns:
+        list: two DataFrames, first which items got matched, second which did not
+    """
+    
+    engine = reconciliation_engine({"engine": engine})
+    labels = {
+        "margin": df1.attrs.get("report", {}).get("margin"),
+        "report": f"{df1.attrs.get('report', {}).get('name')}:{df2.attrs.get('report', {}).get('name')}",
+        "engine": engine,
+    }
+    
+    with stage("merge", **labels) as record:
+        if engine == "sql":
+            result = process_reports_sql(df1.attrs["report"], df2.attrs["report"], columns)
+        elif engine == "streaming":
+            result = process_reports_streaming(df1.attrs["report"], df2.attrs["report"], columns)
+        else:
+            result = process_reports(df1, df2, columns, matching)
+            record["rows"] = len(df1) + len(df2)
+    
+    return result
+
+def report_breaks(name1, name2, non_matching, sink=None, margin=None):
+    """sends out the report for the non-matching items of two reports
+
+    Args:
+        name1 (string): name of the first report
+        name2 (string): name of the second report
+        non_matching (DataFrame): items which did not match
+        sink (BreakSink, optional): collects the breaks for the batched break report,
+            without a sink only their number is printed
+        margin (string, optional): margin class of the reports
+
+    Returns:
+        bool: True if there was nothing to report
+    """
+    
+    with stage("reporting", report=f"{name1}:{name2}") as record:
+        record["rows"] = len(non_matching)
+        
+        if sink is not None:
+            return sink.add(name1, name2, non_matching, margin)
+        
+        if non_matching.empty == True:
+            print("nothing to report")
+            return True
+        
+        print(f"need to report {len(non_matching)} item(s) for {name1} and {name2}")
+        return False
+
+def check_report(df1, df2, columns, engine=None, matching=None, sink=None):
     """Takes two Pandas DataFrames and sends out reports based on the subsequent
     requirements
 
@@ -235,28 +748,27 @@ def check_report(df1, df2, columns):
         df1 (DataFrame): dataframe which should be compared
         df2 (DataFrame): dataframe which should be compared
         columns (list): the columns which should be matched against
+        engine (string, optional): "pandas" merges the fetched frames, "sql" reconciles
+            the reports described in df.attrs["report"] on the database server and
+            "streaming" reads them partition by partition with bounded memory.
+            Defaults to RECONCILIATION['engine']
+        matching (string, optional): matching mode of the pandas engine, see process_reports
+        sink (BreakSink, optional): collects the breaks, see report_breaks
 
     """
     
     try:
-        match, non_matching = process_reports(df1, df2, columns)
-        
-        if non_matching.empty == True:
-            print("nothing to report")
-            return True
-        
-        # Send report with logic
-        # duplicateded
-        # only in cc050
-        # only in ci050
+        match, non_matching = reconcile_reports(df1, df2, columns, engine, matching)
         
-        print(f"need to report for {df1.name} and {df2.name}")
-        
-        # Send report via PMA
-        print(non_matching)
+        return report_breaks(df1.name, df2.name, non_matching, sink, df1.attrs.get("report", {}).get("margin"))
         
+    except CustomError as e:
+        e.send_error_report(sink)
+        return None
     except Exception as e:
         print(f"Error checking report: {str(e)}")
+        if sink is not None:
+            sink.record_error(f"Error checking {df1.name} and {df2.name}: {e}")
         return None
 
 # Utility function only
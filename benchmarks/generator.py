@@ -0,0 +1,95 @@
+"""Seeded synthetic cc050/ci050 data generator
+
+Produces an EOD cc050 report and hourly ci050 snapshots for any number of clearing
+members, accounts and margin classes. The duplicate rate controls how many positions
+appear twice, the break rate how many snapshot rows are changed, dropped or added
+relative to the EOD report.
+"""
+
+import numpy as np
+import pandas as pd
+
+MARGIN_CLASSES = ["SPAN", "IMSM", "CESM", "AMPO", "AMEM", "AMCO", "AMCU", "AMWI", "DMEM"]
+
+def generate_positions(rng, members, accounts, margin_classes, duplicate_rate):
+    """every (member, account, margin class) position with a random margin
+
+    Returns:
+        DataFrame: clearing_member, account, margin_type and margin
+    """
+    
+    member_codes = np.repeat(np.arange(members), accounts * len(margin_classes))
+    account_codes = np.tile(np.repeat(np.arange(accounts), len(margin_classes)), members)
+    margin_codes = np.tile(np.arange(len(margin_classes)), members * accounts)
+    
+    positions = pd.DataFrame({
+        "clearing_member": pd.Categorical.from_codes(
+            member_codes, [f"Bank {i + 1}" for i in range(members)]).astype(str),
+        "account": pd.Categorical.from_codes(
+            account_codes, [f"A{i + 1}" for i in range(accounts)]).astype(str),
+        "margin_type": pd.Categorical.from_codes(margin_codes, margin_classes).astype(str),
+        "margin": np.round(rng.lognormal(mean=8, sigma=1.5, size=len(member_codes)), 1),
+    })
+    
+    duplicated = positions[rng.random(len(positions)) < duplicate_rate]
+    
+    return pd.concat([positions, duplicated], ignore_index=True)
+
+def apply_breaks(rng, positions, break_rate):
+    """changes, drops and adds a break_rate share of the positions, in equal parts
+
+    Returns:
+        DataFrame: the modified positions
+    """
+    
+    draw = rng.random(len(positions))
+    changed = draw < break_rate / 3
+    dropped = (draw >= break_rate / 3) & (draw < 2 * break_rate / 3)
+    added = (draw >= 2 * break_rate / 3) & (draw < break_rate)
+    
+    snapshot = positions.copy()
+    snapshot.loc[changed, "margin"] = np.round(
+        snapshot.loc[changed, "margin"] * rng.uniform(0.5, 1.5, changed.sum()), 1)
+    
+    extra = positions[added].copy()
+    extra["margin"] = np.round(extra["margin"] + rng.uniform(1, 100, len(extra)), 1)
+    
+    return pd.concat([snapshot[~dropped], extra], ignore_index=True)
+
+def generate_feed(seed=42, members=100, accounts=10, margin_classes=None, snapshots=12,
+                  duplicate_rate=0.01, break_rate=0.02, date="2020-05-11", first_hour=8):
+    """generates one day of cc050 and ci050 data
+
+    Args:
+        seed (int, optional): random seed, the same arguments always yield the same data. Defaults to 42
+        members (int, optional): number of clearing members. Defaults to 100
+        accounts (int, optional): accounts per member. Defaults to 10
+        margin_classes (list, optional): margin classes. Defaults to MARGIN_CLASSES
+        snapshots (int, optional): hourly ci050 snapshots. Defaults to 12
+        duplicate_rate (float, optional): share of duplicated positions. Defaults to 0.01
+        break_rate (float, optional): share of snapshot rows which break. Defaults to 0.02
+        date (string, optional): report date. Defaults to "2020-05-11"
+        first_hour (int, optional): hour of the first snapshot. Defaults to 8
+
+    Returns:
+        tuple: cc050 and ci050 DataFrames with the columns of the report tables
+    """
+    
+    rng = np.random.default_rng(seed)
+    margin_classes = margin_classes or MARGIN_CLASSES
+    
+    positions = generate_positions(rng, members, accounts, margin_classes, duplicate_rate)
+    
+    cc050 = positions.copy()
+    cc050.insert(0, "date", date)
+    
+    frames = []
+    for hour in range(first_hour, first_hour + snapshots):
+        snapshot = apply_breaks(rng, positions, break_rate)
+        snapshot.insert(0, "time_of_day", f"{hour:02d}:00:00")
+        snapshot.insert(0, "date", date)
+        frames.append(snapshot)
+    
+    ci050 = pd.concat(frames, ignore_index=True)
+    
+    return cc050, ci050
@@ -0,0 +1,229 @@
+"""Timed load, fetch and reconcile scenarios on synthetic data
+
+The load and fetch scenarios time bulk_insert_rows and fetch_reports against a local
+Postgres (--backend postgres), in a separate benchmark database (BENCHMARK['database']),
+or against the embedded SQLite backend (--backend sqlite, BENCHMARK['embedded']), the
+reconcile scenarios run in memory.
+Results are written as JSON, so runs of different versions can be compared.
+
+Usage:
+    python -m benchmarks.run --members 1000 --accounts 10 --output bench_results.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import time
+
+from datetime import datetime
+
+import pandas as pd
+
+from config.settings import BENCHMARK, DATABASE
+from app.db import TABLE_COLUMNS
+from app.reconcile import drift_matrix, process_reports_counted, process_reports_tolerance
+from app.utils import process_reports
+from .generator import MARGIN_CLASSES, generate_feed
+
+COLUMNS = ["clearing_member", "account", "margin_type", "margin"]
+
+def timed(name, rows, function, *args, **kwargs):
+    """runs a scenario once and measures its wall-clock time
+
+    Returns:
+        tuple: scenario result dict and the return value of function
+    """
+    
+    started = time.perf_counter()
+    value = function(*args, **kwargs)
+    seconds = time.perf_counter() - started
+    
+    result = {
+        "scenario": name,
+        "rows": rows,
+        "seconds": round(seconds, 6),
+        "rows_per_sec": round(rows / seconds, 1) if seconds > 0 else None,
+    }
+    print(f"{name:<32} {rows:>10} rows {seconds:>9.3f}s")
+    
+    return result, value
+
+def named(df, name):
+    df.name = name
+    return df
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def report_config(cc050, ci050):
+    times = sorted(ci050["time_of_day"].unique())
+    date = cc050["date"].iloc[0]
+    
+    return {
+        "cols_to_check": COLUMNS,
+        "margin_classes": MARGIN_CLASSES,
+        "reports": [
+            {"name": "cc050_eod_report", "table": "cc050", "date": date, "valid_report": True},
+            {"name": "ci050_last_report", "table": "ci050", "date": date,
+             "time_of_day": times[-1], "valid_report": True},
+            {"name": "ci050_first_report", "table": "ci050", "date": date,
+             "time_of_day": times[0], "valid_report": True},
+        ],
+    }
+
+def bench_database(database):
+    """creates the Postgres benchmark database if it does not exist, connected through
+       the server's maintenance database
+
+    Raises:
+        ValueError: if database is the application database
+    """
+    
+    import psycopg2
+    
+    from app.db_utils import backend, database_url
+    
+    if database_url(database) == database_url(DATABASE):
+        raise ValueError("the benchmark must not run in the application database")
+    if backend(database) == "sqlite":
+        return
+    
+    connection = psycopg2.connect(database_url({**database, 'name': "postgres"}))
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (database['name'],))
+            if cur.fetchone() is None:
+                cur.execute(f'CREATE DATABASE "{database["name"]}"')
+    finally:
+        connection.close()
+
+def run_database(cc050, ci050, config, database=None):
+    """runs the load and fetch scenarios in the benchmark database, which is emptied
+       first. The application database is never touched
+
+    Args:
+        database (dict, optional): BENCHMARK['database'] or BENCHMARK['embedded'].
+            Defaults to BENCHMARK['database']
+    """
+    
+    from app.db import create_tables
+    from app.db_utils import backend, bulk_insert_rows, create_connection
+    from app.utils import fetch_reports
+    
+    database = database or BENCHMARK['database']
+    bench_database(database)
+    create_tables(database)
+    
+    tables = list(TABLE_COLUMNS) + ["snapshot_catalog"]
+    connection = create_connection(database)
+    cur = connection.cursor()
+    if backend(database) == "sqlite":
+        for table in tables:
+            cur.execute(f"DELETE FROM {table}")
+    else:
+        cur.execute(f"TRUNCATE {', '.join(tables)}")
+    connection.commit()
+    cur.close()
+    connection.close()
+    
+    results = []
+    for table, df in [("cc050", cc050), ("ci050", ci050)]:
+        columns = TABLE_COLUMNS[table]
+        rows = df[columns].itertuples(index=False, name=None)
+        results.append(timed(f"load_{table}", len(df), bulk_insert_rows, table, columns, rows,
+                             database=database)[0])
+    
+    rows = len(cc050) + 2 * len(ci050) // ci050["time_of_day"].nunique()
+    results.append(timed("fetch_per_margin", rows, fetch_reports, config, "per_margin", database)[0])
+    results.append(timed("fetch_batched", rows, fetch_reports, config, "batched", database)[0])
+    
+    return results
+
+def run_reconcile(cc050, ci050, abs_tolerance=0.01):
+    last = ci050[ci050["time_of_day"] == ci050["time_of_day"].max()]
+    eod = named(cc050[COLUMNS].copy(), "cc050_eod_report")
+    snapshot = named(last[COLUMNS].copy(), "ci050_last_report")
+    rows = len(eod) + len(snapshot)
+    
+    return [
+        timed("reconcile_merge", rows, process_reports, eod, snapshot, COLUMNS, "merge")[0],
+        timed("reconcile_counted", rows, process_reports_counted, eod, snapshot, COLUMNS)[0],
+        timed("reconcile_tolerance", rows, process_reports_tolerance, eod, snapshot, COLUMNS, abs_tolerance)[0],
+        timed("reconcile_drift_matrix", len(eod) + len(ci050), drift_matrix, eod, ci050, COLUMNS)[0],
+    ]
+
+def run(params, backend="sqlite", scenarios=("load", "fetch", "reconcile")):
+    """generates the data set and runs the requested scenarios
+
+    Args:
+        params (dict): keyword arguments of generate_feed
+        backend (string, optional): "sqlite" or "postgres". Defaults to "sqlite"
+        scenarios (tuple, optional): any of "load", "fetch" (both run together) and "reconcile"
+
+    Returns:
+        dict: machine-readable benchmark results
+    """
+    
+    result, (cc050, ci050) = timed("generate", 0, generate_feed, **params)
+    result["rows"] = len(cc050) + len(ci050)
+    results = [result]
+    
+    if "load" in scenarios or "fetch" in scenarios:
+        config = report_config(cc050, ci050)
+        database = BENCHMARK['database'] if backend == "postgres" else BENCHMARK['embedded']
+        results += run_database(cc050, ci050, config, database)
+    
+    if "reconcile" in scenarios:
+        results += run_reconcile(cc050, ci050)
+    
+    return {
+        "revision": git_revision(),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "backend": backend,
+        "params": params,
+        "results": results,
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark load, fetch and reconcile on synthetic data")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--accounts", type=int, default=10)
+    parser.add_argument("--snapshots", type=int, default=12)
+    parser.add_argument("--duplicate-rate", type=float, default=0.01)
+    parser.add_argument("--break-rate", type=float, default=0.02)
+    parser.add_argument("--backend", choices=["sqlite", "postgres"], default="sqlite")
+    parser.add_argument("--scenarios", nargs="+", choices=["load", "fetch", "reconcile"],
+                        default=["load", "fetch", "reconcile"])
+    parser.add_argument("--output", default="bench_results.json")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    params = {
+        "seed": args.seed,
+        "members": args.members,
+        "accounts": args.accounts,
+        "snapshots": args.snapshots,
+        "duplicate_rate": args.duplicate_rate,
+        "break_rate": args.break_rate,
+    }
+    
+    report = run(params, args.backend, args.scenarios)
+    
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    
+    return report
+
+if __name__ == '__main__':
+    main()
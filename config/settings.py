@@ -17,7 +17,6 @@ try:
             'password': "devp4ssword",
             'name': "lzdb",
         }
-    print(DATABASE)
 except KeyError:
     DATABASE = {
         'host': "127.0.0.1",
@@ -26,3 +25,120 @@ except KeyError:
         'password': "devp4ssword",
         'name': "lzdb",
     }
+
+INGEST = {
+    'commit_size': 10000,
+    'method': "copy",
+    'chunk_size': 1 << 20,
+}
+
+POOL = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pre_ping': True,
+    'recycle': 1800,
+}
+
+FETCH = {
+    'mode': "batched",
+    'compact': False,
+}
+
+SCHEMA = {
+    'version': 2,
+    'lock_timeout': "5s",
+}
+
+RECONCILIATION = {
+    'engine': "pandas",
+    'matching': "merge",
+    'abs_tolerance': 0.01,
+    'rel_tolerance': 0.0,
+}
+
+STREAMING = {
+    'max_memory_mb': 512,
+    'chunksize': 50000,
+    'bytes_per_row': 200,
+    # "key" hashes the whole key, so even one very large clearing member is split
+    'partition_by': "key",
+}
+
+PARALLEL = {
+    'enabled': False,
+    'workers': 4,
+    'processes': False,
+}
+
+CACHE = {
+    'enabled': False,
+    'directory': os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "reports"),
+    'max_mb': 1024,
+    'format': "parquet",
+}
+
+METRICS = {
+    'enabled': True,
+    'json_log': None,
+    'textfile': None,
+}
+
+QUERY_LOG = {
+    'enabled': False,
+    'target': "file",
+    'path': "query_log.jsonl",
+    'threshold_ms': 500,
+    'explain': True,
+}
+
+SINK = {
+    'target': "csv",
+    'directory': os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "reports"),
+    'batch_rows': 50000,
+}
+
+QUERIES = {
+    'prepared': True,
+}
+
+PARTITIONING = {
+    'enabled': False,
+    'interval': "day",
+    'premake': 7,
+    'retention_days': 90,
+    'retention_mode': "detach",
+}
+
+CATALOG = {
+    'enabled': True,
+}
+
+NOTIFY = {
+    'enabled': True,
+    'channel': "report_loaded",
+    'debounce_seconds': 2.0,
+    'max_delay_seconds': 30.0,
+    'reconnect_seconds': 5.0,
+}
+
+# the benchmark loads synthetic report rows, so it runs in a database of its own on the
+# same server, never in DATABASE, or in an embedded SQLite database (in memory by default)
+BENCHMARK = {
+    'database': {**DATABASE, 'name': os.environ.get('BENCH_DATABASE', f"{DATABASE['name']}_bench")},
+    'embedded': {'backend': "sqlite", 'path': os.environ.get('BENCH_STORAGE_PATH', ":memory:")},
+}
+
+# the embedded backend runs the pipeline in-process on SQLite, without a Postgres server,
+# e.g. STORAGE_BACKEND=sqlite python -m app.cli run. The database file is shared by all
+# commands and worker processes, ":memory:" lives only as long as one process
+STORAGE = {
+    'backend': os.environ.get('STORAGE_BACKEND', "postgres"),
+    'path': os.environ.get('STORAGE_PATH', os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lzdb.sqlite3")),
+}
+
+if STORAGE['backend'] == "sqlite":
+    DATABASE = {
+        'backend': "sqlite",
+        'path': STORAGE['path'],
+    }
@@ -1,9 +1,12 @@
 #!/bin/sh
 # python_commands.sh
 
-python -m app.db &
-python -m app.main &
+# schema, fixtures, integrity check and the first reconciliation run in order and
+# stop at the first failure, so no run ever reads half-populated tables
+python -m app.cli run || exit 1
+
 python -m tests.test_main &
 python -m tests.unittesting &
 
-wait
+# later loads are reconciled by the daemon as soon as they are committed
+python -m app.daemon
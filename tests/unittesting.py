@@ -1,9 +1,35 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from decimal import Decimal
 from unittest.mock import MagicMock, patch
 
 import pandas as pd
 
+from app.backfill import day_range, reconcile_day
+from app import cli
+from app.cache import ReportCache
+from app.catalog import lookup_snapshots
+from app.daemon import collect_event, plan_runs, run_pending, serve, wait_time
+from app.incremental import break_delta, break_key, previous_breaks
+from app.ingest import ingest_feed, read_csv, read_ndjson, read_nested_json, type_row
+from app.loader import load_feed
+from app.metrics import flush_metrics, frame_size, records, reset_metrics, stage, summary
+from app.querylog import logged_query, read_only
+from app.parallel import check_reports_parallel, fetch_reports_parallel
+from app.reconcile import *
+from app.sink import PARQUET_AVAILABLE, BreakSink, categorize_breaks
+from app.streaming import partition_count, partition_expression, stream_key_counts
 from app.utils import *
+from benchmarks.generator import generate_feed
 
 class TestGetMargins(unittest.TestCase):
     
@@ -52,5 +78,1154 @@ class TestGetMargins(unittest.TestCase):
         # Check if the function returns None when no connection is established
         self.assertIsNone(result)
 
+class TestGetReportMargins(unittest.TestCase):
+    
+    def setUp(self):
+        self.df = pd.DataFrame({
+            "clearing_member": ["Bank 1", "Bank 1", "Bank 2"],
+            "account": ["A1", "A1", "A2"],
+            "margin_type": ["SPAN", "IMSM", "SPAN"],
+            "margin": ["1.0", "2.0", "3.0"],
+        })
+
+    @patch("app.utils.create_alchemy_connection")
+    @patch("pandas.read_sql_query")
+    def test_get_report_margins_single_query(self, mock_read_sql_query, mock_create_alchemy_connection):
+        mock_read_sql_query.return_value = self.df
+
+        result = get_report_margins("cc050_eod_report", "cc050", ["SPAN", "IMSM", "AMPO"], "2020-05-11")
+
+        mock_read_sql_query.assert_called_once()
+        self.assertEqual(mock_read_sql_query.call_args.kwargs["params"]["margins"], ["SPAN", "IMSM", "AMPO"])
+        self.assertEqual(list(result.keys()), ["SPAN", "IMSM", "AMPO"])
+        self.assertEqual(len(result["SPAN"]), 2)
+        self.assertEqual(len(result["IMSM"]), 1)
+        self.assertTrue(result["AMPO"].empty)
+        self.assertEqual(result["SPAN"].name, "cc050_eod_report_SPAN")
+
+class TestTypeReportFrame(unittest.TestCase):
+
+    def test_type_report_frame(self):
+        df = pd.DataFrame({
+            "date": ["2020-05-11"],
+            "time_of_day": ["19:00:00"],
+            "margin": ["3212.2"],
+        })
+
+        result = type_report_frame(df)
+
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(result["date"]))
+        self.assertTrue(pd.api.types.is_timedelta64_dtype(result["time_of_day"]))
+        self.assertEqual(result["margin"].dtype, "float64")
+        self.assertAlmostEqual(result["margin"][0], 3212.2)
+
+class TestProcessReportsSql(unittest.TestCase):
+    
+    def setUp(self):
+        self.columns = ["clearing_member", "account", "margin_type", "margin"]
+        self.left = {"name": "cc050_eod_report", "table": "cc050", "date": "2020-05-11", "margin": "SPAN"}
+        self.right = {"name": "ci050_last_report", "table": "ci050", "date": "2020-05-11",
+                      "time_of_day": "19:00:00", "margin": "SPAN"}
+
+    def test_reconciliation_query(self):
+        query, params = reconciliation_query(self.left, self.right, self.columns)
+
+        self.assertIn("FULL OUTER JOIN", str(query))
+        self.assertEqual(params, {"left_date": "2020-05-11", "right_date": "2020-05-11",
+                                  "right_time_of_day": "19:00:00"})
+
+    @patch("app.reconcile.get_engine")
+    @patch("pandas.read_sql_query")
+    def test_process_reports_sql(self, mock_read_sql_query, mock_get_engine):
+        mock_read_sql_query.return_value = pd.DataFrame({
+            "clearing_member": ["Bank 2", None],
+            "account": ["A1", None],
+            "margin_type": ["SPAN", "SPAN"],
+            "margin": ["8766.4", None],
+            "_merge": ["left_only", "both"],
+            "row_count": [1, 2],
+        })
+
+        matching, non_matching = process_reports_sql(self.left, self.right, self.columns)
+
+        self.assertEqual(matching["matched"].tolist(), [2])
+        self.assertEqual(len(non_matching), 1)
+        self.assertEqual(non_matching["source"][0], "found in cc050_eod_report_SPAN")
+
+class TestProcessReportsCounted(unittest.TestCase):
+    
+    def setUp(self):
+        self.columns = ["clearing_member", "account", "margin_type", "margin"]
+        self.df1 = pd.DataFrame([
+            ["Bank 1", "A1", "SPAN", 3212.2],
+            ["Bank 2", "A1", "SPAN", 821.4],
+            ["Bank 2", "A1", "SPAN", 821.4],
+            ["Bank 2", "A1", "SPAN", 821.4],
+            ["Bank 3", "A1", "SPAN", 10.0],
+        ], columns=self.columns)
+        self.df1.name = "cc050_eod_report_SPAN"
+        self.df2 = pd.DataFrame([
+            ["Bank 1", "A1", "SPAN", 3212.2],
+            ["Bank 2", "A1", "SPAN", 821.4],
+            ["Bank 4", "A1", "SPAN", 10.0],
+        ], columns=self.columns)
+        self.df2.name = "ci050_last_report_SPAN"
+
+    def test_process_reports_counted(self):
+        matching, non_matching = process_reports(self.df1, self.df2, self.columns, "counted")
+
+        self.assertEqual(len(matching), 2)
+        self.assertEqual(matching["multiplicity"].sum(), 2)
+
+        by_member = non_matching.set_index("clearing_member")
+        self.assertEqual(by_member.loc["Bank 2", "category"], "duplicated")
+        self.assertEqual(by_member.loc["Bank 2", "multiplicity"], 2)
+        self.assertEqual(by_member.loc["Bank 3", "category"], "left_only")
+        self.assertEqual(by_member.loc["Bank 4", "category"], "right_only")
+        self.assertEqual(by_member.loc["Bank 4", "source"], "found in ci050_last_report_SPAN")
+
+    def test_process_reports_merge(self):
+        matching, non_matching = process_reports(self.df1, self.df2, self.columns, "merge")
+
+        self.assertEqual(len(non_matching), 2)
+        self.assertEqual(set(non_matching["source"]), {"found in cc050_eod_report_SPAN",
+                                                       "found in ci050_last_report_SPAN"})
+
+class TestReconciliationIndex(unittest.TestCase):
+    
+    def setUp(self):
+        self.columns = ["clearing_member", "account", "margin_type", "margin"]
+        self.eod = pd.DataFrame([
+            ["Bank 1", "A1", "SPAN", 3212.2],
+            ["Bank 1", "A1", "IMSM", 837.1],
+            ["Bank 2", "A1", "SPAN", 821.4],
+        ], columns=self.columns)
+        self.eod.name = "cc050_eod_report"
+        self.snapshots = pd.DataFrame([
+            ["18:00:00", "Bank 1", "A1", "SPAN", 2882.2],
+            ["18:00:00", "Bank 1", "A1", "IMSM", 837.1],
+            ["19:00:00", "Bank 1", "A1", "SPAN", 3212.2],
+            ["19:00:00", "Bank 1", "A1", "IMSM", 837.1],
+            ["19:00:00", "Bank 2", "A1", "SPAN", 821.4],
+        ], columns=["time_of_day"] + self.columns)
+
+    def test_probe_matches_counted_matching(self):
+        index = ReconciliationIndex(self.eod, self.columns)
+        snapshot = self.snapshots[self.snapshots["time_of_day"] == "18:00:00"].copy()
+        snapshot.name = "ci050_snapshot"
+
+        _, probed = index.probe(snapshot)
+        _, counted = process_reports_counted(self.eod, snapshot, self.columns)
+
+        self.assertEqual(sorted(probed["margin"]), sorted(counted["margin"]))
+
+    def test_drift_matrix(self):
+        matrix = drift_matrix(self.eod, self.snapshots, self.columns, by=("time_of_day",))
+        span = matrix[matrix["margin_type"] == "SPAN"].set_index("time_of_day")
+
+        self.assertEqual(span.loc["18:00:00", "left_only"], 2)
+        self.assertEqual(span.loc["18:00:00", "right_only"], 1)
+        self.assertEqual(span.loc["19:00:00", "matched"], 2)
+        self.assertEqual(span.loc["19:00:00", ["left_only", "right_only", "duplicated"]].sum(), 0)
+
+class TestBreakDelta(unittest.TestCase):
+
+    def test_break_delta(self):
+        key = ["clearing_member", "account", "margin_type", "margin", "category"]
+        previous = pd.DataFrame([
+            ["Bank 1", "A1", "SPAN", 2882.2, "right_only", 1],
+            ["Bank 2", "A1", "SPAN", 821.4, "duplicated", 2],
+        ], columns=key + ["multiplicity"]).set_index(key)["multiplicity"]
+        current = pd.DataFrame([
+            ["Bank 2", "A1", "SPAN", 821.4, "duplicated", 3],
+            ["Bank 3", "A2", "IMSM", 10.0, "left_only", 1],
+        ], columns=key + ["multiplicity"]).set_index(key)["multiplicity"]
+
+        delta = break_delta(current, previous).set_index("clearing_member")
+
+        self.assertEqual(delta.loc["Bank 1", "change"], "resolved")
+        self.assertEqual(delta.loc["Bank 2", "change"], "opened")
+        self.assertEqual(delta.loc["Bank 2", "multiplicity"], 1)
+        self.assertEqual(delta.loc["Bank 3", "change"], "opened")
+
+    def test_break_key(self):
+        self.assertEqual(break_key({'cols_to_check': ["clearing_member", "margin"]}), ["clearing_member", "margin"])
+        with self.assertRaises(ValueError):
+            break_key({'cols_to_check': ["clearing_member", "currency"]})
+
+    @patch("app.incremental.create_connection")
+    def test_previous_breaks_uses_preceding_snapshot(self, mock_connection):
+        cur = mock_connection.return_value.cursor.return_value
+        cur.fetchall.return_value = [("Bank 1", 2882.2, "right_only", 1)]
+
+        previous = previous_breaks("ci050", "2020-05-12", "12:00:00", "cc050_eod_report",
+                                   ["clearing_member", "margin"])
+
+        sql, params = cur.execute.call_args.args
+        self.assertIn("SELECT clearing_member, margin, category, multiplicity", sql)
+        self.assertIn("time_of_day < %s", sql)
+        self.assertEqual(params[-1], "12:00:00")
+        self.assertEqual(previous.index.names, ["clearing_member", "margin", "category"])
+        self.assertEqual(previous.loc[("Bank 1", 2882.2, "right_only")], 1)
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        self.columns = ["clearing_member", "account", "margin_type", "margin"]
+        self.report = {"name": "cc050_eod_report", "table": "cc050", "date": "2020-05-11"}
+
+    def test_partition_count(self):
+        self.assertEqual(partition_count(1000, max_memory_mb=1, bytes_per_row=200), 1)
+        self.assertEqual(partition_count(100000, max_memory_mb=1, bytes_per_row=200), 20)
+
+    @patch("pandas.read_sql_query")
+    def test_stream_key_counts_accumulates_chunks(self, mock_read_sql_query):
+        chunk = pd.DataFrame([["Bank 1", "A1", "SPAN", "3212.2"]], columns=self.columns)
+        mock_read_sql_query.return_value = iter([chunk, chunk.copy()])
+
+        counts = stream_key_counts(MagicMock(), self.report, self.columns, ["SPAN"], 1, 4, 1, "clearing_member")
+
+        self.assertEqual(counts.tolist(), [2])
+        self.assertIn("hashtext(clearing_member::text)", str(mock_read_sql_query.call_args.args[0]))
+        self.assertEqual(mock_read_sql_query.call_args.kwargs["params"]["partition"], 1)
+
+    def test_partition_expression(self):
+        self.assertIn("concat_ws('|', clearing_member::text, account::text", partition_expression(self.columns))
+        for partition_by in ("margin; DROP TABLE cc050", "currency"):
+            with self.assertRaises(ValueError):
+                partition_expression(self.columns, partition_by)
+        with self.assertRaises(ValueError):
+            partition_expression(["clearing_member", "margin"], "account")
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.columns = ["clearing_member", "account", "margin_type", "margin"]
+        self.report_config = {
+            "cols_to_check": self.columns,
+            "margin_classes": ["SPAN", "IMSM"],
+            "reports": [
+                {"name": "cc050_eod_report", "table": "cc050", "date": "2020-05-11", "valid_report": True},
+                {"name": "ci050_last_report", "table": "ci050", "date": "2020-05-11",
+                 "time_of_day": "19:00:00", "valid_report": True},
+            ],
+        }
+
+    @staticmethod
+    def fake_get_margins(report_name, table, margin, date, time_of_day=None):
+        if margin == "IMSM" and table == "ci050":
+            return None
+        df = pd.DataFrame([["Bank 1", "A1", margin, 1.0]],
+                          columns=["clearing_member", "account", "margin_type", "margin"])
+        df.name = f"{report_name}_{margin}"
+        return df
+
+    @patch("app.parallel.get_margins")
+    def test_fetch_reports_parallel_isolates_errors(self, mock_get_margins):
+        mock_get_margins.side_effect = self.fake_get_margins
+
+        reports, errors = fetch_reports_parallel(self.report_config, "per_margin", workers=2)
+
+        self.assertEqual(list(reports.keys()), ["SPAN"])
+        self.assertEqual(reports["SPAN"]["ci050_last_report"].name, "ci050_last_report_SPAN")
+        self.assertEqual(len(errors), 1)
+
+    def test_check_reports_parallel_process_pool(self):
+        reports = {margin: {
+            "cc050_eod_report": self.fake_get_margins("cc050_eod_report", "cc050", margin, "2020-05-11"),
+            "ci050_last_report": self.fake_get_margins("ci050_last_report", "cc050", margin, "2020-05-11"),
+        } for margin in ["SPAN", "IMSM"]}
+
+        results = check_reports_parallel(
+            reports, [("cc050_eod_report", "ci050_last_report")], self.columns,
+            engine="pandas", workers=2, processes=True)
+
+        self.assertEqual([result["margin"] for result in results], ["SPAN", "IMSM"])
+        self.assertTrue(all(result["clean"] for result in results))
+
+class TestReportCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ReportCache(self.directory.name, max_mb=1)
+        self.key = ("cc050", "2020-05-11", None, "SPAN")
+        self.df = type_report_frame(pd.DataFrame({
+            "id": [1, 2],
+            "date": ["2020-05-11", "2020-05-11"],
+            "clearing_member": ["Bank 1", "Bank 2"],
+            "margin": ["3212.2", "821.4"],
+        }))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_hit_and_stale_fingerprint(self):
+        self.assertIsNone(self.cache.get(self.key, [2, 2]))
+        self.cache.put(self.key, [2, 2], self.df)
+
+        cached = self.cache.get(self.key, [2, 2])
+        pd.testing.assert_frame_equal(cached, self.df)
+
+        self.assertIsNone(self.cache.get(self.key, [3, 3]))
+        self.assertEqual(self.cache.stats["hits"], 1)
+        self.assertEqual(self.cache.stats["stale"], 1)
+        self.assertEqual(self.cache.stats["misses"], 2)
+
+    def test_lru_eviction(self):
+        self.cache.max_bytes = 1
+        self.cache.put(self.key, [2, 2], self.df)
+        self.cache.put(("cc050", "2020-05-12", None, "SPAN"), [2, 2], self.df)
+
+        self.assertEqual(self.cache.stats["evictions"], 2)
+        self.assertIsNone(self.cache.get(self.key, [2, 2]))
+
+    def test_shared_directory(self):
+        other = ReportCache(self.directory.name, max_mb=1)
+        keys = [("ci050", "2020-05-11", f"{hour:02d}:00:00", "SPAN") for hour in range(8)]
+        
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda key: ReportCache(self.directory.name, max_mb=1).put(key, [2, 2], self.df), keys))
+        
+        for key in keys:
+            pd.testing.assert_frame_equal(other.get(key, [2, 2]), self.df)
+        self.assertFalse([name for name in os.listdir(self.directory.name) if name.endswith(".tmp")])
+
+    def test_unreadable_entry_is_a_miss(self):
+        self.cache.put(self.key, [2, 2], self.df)
+        entry_id = ReportCache.entry_id(self.key)
+        for name in os.listdir(self.directory.name):
+            if name.startswith(entry_id) and not name.endswith(".json"):
+                os.remove(os.path.join(self.directory.name, name))
+
+        self.assertIsNone(self.cache.get(self.key, [2, 2]))
+        self.assertEqual(self.cache.stats["misses"], 1)
+
+class TestCompactReports(unittest.TestCase):
+
+    def test_compact_reports_shares_categories(self):
+        columns = ["clearing_member", "account", "margin_type", "margin"]
+        df1 = pd.DataFrame([["Bank 1", "A1", "SPAN", "1.0"], ["Bank 2", "A1", "SPAN", "2.0"]], columns=columns)
+        df1.name = "cc050_eod_report_SPAN"
+        df2 = pd.DataFrame([["Bank 1", "A1", "SPAN", "1.0"], ["Bank 3", "A2", "SPAN", "2.0"]], columns=columns)
+        df2.name = "ci050_last_report_SPAN"
+
+        usage = compact_reports({"SPAN": {"cc050_eod_report": df1, "ci050_last_report": df2}})
+
+        self.assertIn("before", usage)
+        self.assertEqual(df1["clearing_member"].dtype, df2["clearing_member"].dtype)
+        self.assertEqual(list(df1["clearing_member"].cat.categories), ["Bank 1", "Bank 2", "Bank 3"])
+        self.assertEqual(df1["margin"].dtype, "float64")
+
+        matching, non_matching = process_reports(df1, df2, columns, "merge")
+        self.assertEqual(len(matching), 1)
+        self.assertEqual(len(non_matching), 2)
+
+class TestProcessReportsTolerance(unittest.TestCase):
+
+    def test_process_reports_tolerance(self):
+        columns = ["clearing_member", "account", "margin_type", "margin"]
+        df1 = pd.DataFrame([
+            ["Bank 1", "A1", "SPAN", 3212.2],
+            ["Bank 1", "A1", "IMSM", 837.1],
+            ["Bank 2", "A1", "SPAN", 821.4],
+            ["Bank 3", "A1", "SPAN", 5.0],
+        ], columns=columns)
+        df1.name = "cc050_eod_report_SPAN"
+        df2 = pd.DataFrame([
+            ["Bank 1", "A1", "SPAN", 3212.2],
+            ["Bank 1", "A1", "IMSM", 837.11],
+            ["Bank 2", "A1", "SPAN", 900.0],
+        ], columns=columns)
+        df2.name = "ci050_last_report_SPAN"
+
+        matching, non_matching = process_reports_tolerance(df1, df2, columns, abs_tolerance=0.01)
+
+        status = matching.set_index("margin_type")["status"]
+        self.assertEqual(status["SPAN"], "matched")
+        self.assertEqual(status["IMSM"], "within_tolerance")
+        self.assertEqual(sorted(non_matching["clearing_member"]), ["Bank 2", "Bank 3"])
+        self.assertEqual(non_matching.set_index("clearing_member").loc["Bank 3", "source"],
+                         "found in cc050_eod_report_SPAN")
+
+    def test_unequal_multiplicity(self):
+        columns = ["clearing_member", "account", "margin_type", "margin"]
+        df1 = pd.DataFrame([
+            ["Bank 2", "A1", "SPAN", 821.4],
+            ["Bank 2", "A1", "SPAN", 8766.4],
+            ["Bank 1", "A1", "SPAN", 1.0],
+            ["Bank 1", "A1", "SPAN", 1.009],
+        ], columns=columns)
+        df1.name = "cc050_eod_report_SPAN"
+        df2 = pd.DataFrame([
+            ["Bank 2", "A1", "SPAN", 8766.4],
+            ["Bank 1", "A1", "SPAN", 1.008],
+            ["Bank 1", "A1", "SPAN", 1.0005],
+        ], columns=columns)
+        df2.name = "ci050_last_report_SPAN"
+
+        matching, non_matching = process_reports_tolerance(df1, df2, columns, abs_tolerance=0.01)
+
+        pairs = sorted(zip(matching["left_margin"], matching["right_margin"], matching["status"]))
+        self.assertEqual(pairs, [(1.0, 1.0005, "within_tolerance"), (1.009, 1.008, "within_tolerance"),
+                                 (8766.4, 8766.4, "matched")])
+        self.assertEqual(non_matching["left_margin"].tolist(), [821.4])
+        self.assertEqual(non_matching["source"].tolist(), ["found in cc050_eod_report_SPAN"])
+
+    def test_largest_matching_and_sorted_leftovers(self):
+        columns = ["clearing_member", "account", "margin_type", "margin"]
+        df1 = pd.DataFrame([["Bank 1", "A1", "SPAN", margin] for margin in (100.0, 100.02)]
+                           + [["Bank 2", "A1", "SPAN", margin] for margin in (300.0, 100.0)], columns=columns)
+        df1.name = "cc050_eod_report_SPAN"
+        df2 = pd.DataFrame([["Bank 1", "A1", "SPAN", margin] for margin in (100.03, 100.01)]
+                           + [["Bank 2", "A1", "SPAN", margin] for margin in (110.0, 310.0)], columns=columns)
+        df2.name = "ci050_last_report_SPAN"
+
+        matching, non_matching = process_reports_tolerance(df1, df2, columns, abs_tolerance=0.01)
+
+        self.assertEqual(sorted(zip(matching["left_margin"], matching["right_margin"])),
+                         [(100.0, 100.01), (100.02, 100.03)])
+        self.assertEqual(sorted(zip(non_matching["left_margin"], non_matching["right_margin"])),
+                         [(100.0, 110.0), (300.0, 310.0)])
+
+class TestBackfill(unittest.TestCase):
+
+    def test_day_range(self):
+        days = day_range("2020-05-30", "2020-06-02")
+        self.assertEqual([day.strftime("%m-%d") for day in days], ["05-30", "05-31", "06-01", "06-02"])
+
+    @patch("app.backfill.fetch_reports")
+    def test_reconcile_day(self, mock_fetch_reports):
+        columns = ["clearing_member", "account", "margin_type", "margin"]
+
+        def fake_fetch_reports(report_config, fetch_mode=None):
+            self.assertEqual(report_config["reports"][0]["date"], "2020-06-01")
+            reports = {}
+            for name in ["cc050_eod_report", "ci050_first_report", "ci050_last_report"]:
+                df = pd.DataFrame([["Bank 1", "A1", "SPAN", 1.0]], columns=columns)
+                df.name = f"{name}_SPAN"
+                reports[name] = df
+            return {"SPAN": reports}
+
+        mock_fetch_reports.side_effect = fake_fetch_reports
+
+        rows = reconcile_day(datetime(2020, 6, 2), {"matching": "counted"})
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual([row["breaks"] for row in rows], [0, 0])
+        self.assertEqual([row["matched"] for row in rows], [1, 1])
+
+    @patch("app.backfill.fetch_reports")
+    def test_reconcile_day_writes_breaks(self, mock_fetch_reports):
+        columns = ["clearing_member", "account", "margin_type", "margin"]
+        reports = {}
+        for name, margin in [("cc050_eod_report", 1.0), ("ci050_first_report", 2.0), ("ci050_last_report", 1.0)]:
+            df = pd.DataFrame([["Bank 1", "A1", "SPAN", margin]], columns=columns)
+            df.name = f"{name}_SPAN"
+            reports[name] = df
+        mock_fetch_reports.return_value = {"SPAN": reports}
+
+        with tempfile.TemporaryDirectory() as directory:
+            sink = BreakSink(target="csv", directory=directory)
+            rows = reconcile_day(datetime(2020, 6, 2), {"matching": "counted"}, sink=sink)
+            summary = sink.close()
+
+        self.assertEqual([row["breaks"] for row in rows], [2, 0])
+        self.assertEqual(summary["pairs"], 2)
+        self.assertEqual(summary["written"], 2)
+        self.assertEqual(summary["margins"], {"SPAN": 2})
+
+class TestGenerator(unittest.TestCase):
+
+    def test_generate_feed_is_reproducible(self):
+        cc050, ci050 = generate_feed(seed=7, members=5, accounts=2, snapshots=3, duplicate_rate=0.0)
+        cc050_again, ci050_again = generate_feed(seed=7, members=5, accounts=2, snapshots=3, duplicate_rate=0.0)
+
+        self.assertEqual(len(cc050), 5 * 2 * 9)
+        self.assertEqual(ci050["time_of_day"].nunique(), 3)
+        pd.testing.assert_frame_equal(ci050, ci050_again)
+
+    def test_generate_feed_without_breaks_matches(self):
+        cc050, ci050 = generate_feed(seed=7, members=5, accounts=2, snapshots=1, break_rate=0.0)
+        cc050.name = "cc050"
+        ci050.name = "ci050"
+
+        _, non_matching = process_reports_counted(cc050, ci050, ["clearing_member", "account", "margin_type", "margin"])
+
+        self.assertTrue(non_matching.empty)
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        reset_metrics()
+
+    def test_stage_records_and_exports(self):
+        with stage("query", margin="SPAN", report="cc050_eod_report") as record:
+            record["rows"] = 6
+        with stage("query", margin="SPAN", report="cc050_eod_report") as record:
+            record["rows"] = 4
+
+        totals = summary()
+        self.assertEqual(len(totals), 1)
+        self.assertEqual(totals[0]["calls"], 2)
+        self.assertEqual(totals[0]["rows"], 10)
+
+        with tempfile.TemporaryDirectory() as directory:
+            textfile = os.path.join(directory, "recon.prom")
+            json_log = os.path.join(directory, "recon.log")
+            flush_metrics(json_log=json_log, textfile=textfile)
+
+            with open(textfile) as f:
+                content = f.read()
+            with open(json_log) as f:
+                lines = f.readlines()
+
+        self.assertIn('recon_stage_rows_total{margin="SPAN",report="cc050_eod_report",stage="query"} 10', content)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(records(), [])
+
+    def test_textfile_counters_survive_flushes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            textfile = os.path.join(directory, "recon.prom")
+            for rows in (6, 4):
+                with stage("query", margin="SPAN") as record:
+                    record["rows"] = rows
+                flush_metrics(json_log="", textfile=textfile)
+
+            with open(textfile) as f:
+                content = f.read()
+
+        self.assertIn('recon_stage_calls_total{margin="SPAN",stage="query"} 2', content)
+        self.assertIn('recon_stage_rows_total{margin="SPAN",stage="query"} 10', content)
+
+    def test_frame_size_counts_strings(self):
+        df = pd.DataFrame({"clearing_member": ["Bank " + "x" * 100] * 10})
+
+        with stage("query") as record:
+            frame_size(record, df)
+
+        self.assertGreater(record["bytes"], 10 * 100)
+
+class TestQueryLog(unittest.TestCase):
+
+    def test_slow_query_is_logged_with_plan(self):
+        with tempfile.TemporaryDirectory() as directory:
+            settings = {"enabled": True, "target": "file", "path": os.path.join(directory, "query_log.jsonl"),
+                        "threshold_ms": 0, "explain": True}
+
+            with patch.dict("app.querylog.QUERY_LOG", settings), \
+                 patch("app.querylog.explain_query", return_value="Seq Scan on cc050") as mock_explain:
+                with logged_query("SELECT * FROM cc050 LIMIT %s", (2,)) as entry:
+                    entry["rows"] = 2
+
+            with open(settings["path"]) as f:
+                logged = json.loads(f.readline())
+
+        mock_explain.assert_called_once()
+        self.assertEqual(logged["rows"], 2)
+        self.assertEqual(logged["plan"], "Seq Scan on cc050")
+
+    @patch("app.utils.create_alchemy_connection")
+    @patch("pandas.read_sql_query")
+    def test_explain_is_not_query_time(self, mock_read_sql_query, mock_create_alchemy_connection):
+        mock_read_sql_query.return_value = pd.DataFrame([["Bank 1", "A1", "SPAN", "1.0"]],
+                                                        columns=["clearing_member", "account", "margin_type", "margin"])
+        
+        def explain(statement, params=None, database=None):
+            time.sleep(0.2)
+            return "Seq Scan on cc050"
+        
+        reset_metrics()
+        with tempfile.TemporaryDirectory() as directory:
+            settings = {"enabled": True, "target": "file", "path": os.path.join(directory, "query_log.jsonl"),
+                        "threshold_ms": 0, "explain": True}
+            with patch.dict("app.querylog.QUERY_LOG", settings), \
+                 patch("app.querylog.explain_query", side_effect=explain), \
+                 patch("app.utils.report_cache", return_value=None):
+                get_margins("cc050_eod_report", "cc050", "SPAN", "2020-05-11", database=DATABASE)
+        
+        seconds = {record["stage"]: record["seconds"] for record in records()}
+        self.assertLess(seconds["query"], 0.2)
+        self.assertGreaterEqual(seconds["explain"], 0.2)
+        reset_metrics()
+
+    def test_read_only(self):
+        self.assertTrue(read_only("WITH left_side AS (SELECT 1) SELECT * FROM left_side"))
+        self.assertTrue(read_only("-- reconciliation\n(SELECT created_at FROM cc050)"))
+        self.assertFalse(read_only("WITH moved AS (DELETE FROM cc050 RETURNING *) SELECT * FROM moved"))
+        self.assertFalse(read_only("SELECT * FROM cc050 FOR UPDATE"))
+        self.assertFalse(read_only("INSERT INTO cc050 SELECT * FROM ci050"))
+
+    def test_streaming_queries_are_logged(self):
+        connection = MagicMock()
+        chunks = [pd.DataFrame({"clearing_member": ["Bank 1"] * 2, "margin": ["1.0", "2.0"]})] * 3
+        report = {"table": "cc050", "date": "2020-05-11"}
+
+        with patch.dict("app.querylog.QUERY_LOG", {"enabled": True}), \
+             patch("app.querylog.log_query") as mock_log_query, \
+             patch("pandas.read_sql_query", return_value=iter(chunks)):
+            stream_key_counts(connection, report, ["clearing_member", "margin"], ["SPAN"], 0, 1, 2)
+
+        statement, params, seconds, rows, database = mock_log_query.call_args.args
+        self.assertIn("FROM cc050", statement.text)
+        self.assertEqual(rows, 6)
+
+    @patch("app.querylog.log_query")
+    def test_disabled_by_default(self, mock_log_query):
+        with logged_query("SELECT 1") as entry:
+            entry["rows"] = 1
+
+        mock_log_query.assert_not_called()
+
+class TestPrepareQuery(unittest.TestCase):
+    
+    def setUp(self):
+        self.connection = MagicMock()
+        self.connection.dialect.name = "postgresql"
+        self.connection.info = {}
+    
+    def test_query_generator_binds_values(self):
+        query = query_generator("cc050", "SPAN", "2023-01-02", "EOD")
+        self.assertNotIn("SPAN", query.text)
+        self.assertEqual(query.compile().params,
+                         {"margin": "SPAN", "date": "2023-01-02", "time_of_day": "EOD"})
+    
+    def test_prepares_once_per_connection(self):
+        first = prepare_query(self.connection, query_generator("cc050", "SPAN", "2023-01-02"))
+        second = prepare_query(self.connection, query_generator("cc050", "FX", "2023-01-03"))
+        
+        self.connection.exec_driver_sql.assert_called_once()
+        prepared = self.connection.exec_driver_sql.call_args[0][0]
+        self.assertIn("margin_type = $1 AND date = $2", prepared)
+        self.assertTrue(first.text.startswith("EXECUTE stmt_"))
+        self.assertEqual(first.text, second.text)
+        self.assertEqual(second.compile().params, {"margin": "FX", "date": "2023-01-03"})
+    
+    def test_plain_sql_passes_through(self):
+        self.assertEqual(prepare_query(self.connection, "SELECT 1"), "SELECT 1")
+        self.connection.dialect.name = "sqlite"
+        query = query_generator("cc050", "SPAN", "2023-01-02")
+        self.assertIs(prepare_query(self.connection, query), query)
+        self.connection.exec_driver_sql.assert_not_called()
+
+class TestPartitions(unittest.TestCase):
+    
+    def test_partition_ranges(self):
+        days = partition_ranges(date(2023, 1, 30), date(2023, 2, 1), "day")
+        self.assertEqual(len(days), 3)
+        self.assertEqual(days[-1], (date(2023, 2, 1), date(2023, 2, 2)))
+        
+        months = partition_ranges(date(2023, 1, 15), date(2023, 3, 1), "month")
+        self.assertEqual([lower for lower, _ in months], [date(2023, 1, 1), date(2023, 2, 1), date(2023, 3, 1)])
+        self.assertEqual(months[0][1], date(2023, 2, 1))
+    
+    def test_partition_names_round_trip(self):
+        name = partition_name("ci050", date(2023, 1, 2), "day")
+        self.assertEqual(name, "ci050_p20230102")
+        self.assertEqual(parse_partition_name("ci050", name, "day"), date(2023, 1, 2))
+        self.assertIsNone(parse_partition_name("ci050", "ci050_default", "day"))
+    
+    def test_expired_partitions(self):
+        partitions = ["cc050_default", "cc050_p202210", "cc050_p202211", "cc050_p202212"]
+        expired = expired_partitions("cc050", partitions, keep_days=30, today=date(2023, 1, 1), interval="month")
+        self.assertEqual(expired, ["cc050_p202210", "cc050_p202211"])
+    
+    def test_add_partition_moves_default_rows(self):
+        cur = MagicMock()
+        cur.fetchone.side_effect = [("r",), (3,)]
+        
+        moved = add_partition(cur, "ci050", date(2023, 1, 2), date(2023, 1, 3), "day")
+        
+        statements = [call.args[0].split()[0:2] for call in cur.execute.call_args_list]
+        self.assertEqual(moved, 3)
+        self.assertEqual(statements[2:], [["CREATE", "TEMPORARY"], ["DELETE", "FROM"], ["CREATE", "TABLE"],
+                                          ["INSERT", "INTO"]])
+    
+    @patch("app.db.partition_tables", return_value=True)
+    @patch("app.db.create_connection")
+    def test_create_tables_converts_plain_tables(self, mock_create_connection, mock_partition_tables):
+        cur = mock_create_connection.return_value.cursor.return_value
+        cur.fetchone.return_value = ("r",)
+        
+        self.assertTrue(create_tables(DATABASE, version=2, partitioned=True))
+        
+        executed = " ".join(call.args[0] for call in cur.execute.call_args_list)
+        self.assertNotIn("PARTITION OF", executed)
+        self.assertIn("snapshot_catalog", executed)
+        mock_partition_tables.assert_called_once()
+    
+    @patch("app.db.create_partitions", return_value=["cc050_p20230101"])
+    @patch("app.db.create_connection")
+    def test_maintain_partitions(self, mock_create_connection, mock_create_partitions):
+        cur = mock_create_connection.return_value.cursor.return_value
+        
+        with patch.dict("app.db.PARTITIONING", {"enabled": False}):
+            self.assertEqual(maintain_partitions(DATABASE), [])
+        mock_create_connection.assert_not_called()
+        
+        with patch.dict("app.db.PARTITIONING", {"enabled": True}):
+            cur.fetchone.return_value = ("r",)
+            self.assertEqual(maintain_partitions(DATABASE), [])
+            mock_create_partitions.assert_not_called()
+            
+            cur.fetchone.return_value = ("p",)
+            self.assertEqual(maintain_partitions(DATABASE), ["cc050_p20230101"])
+            mock_create_partitions.assert_called_once_with(database=DATABASE)
+    
+    @patch("app.loader.ingest_feed", return_value={"rows": 1})
+    @patch("app.loader.maintain_partitions")
+    def test_load_feed_rolls_partitions_forward(self, mock_maintain_partitions, mock_ingest_feed):
+        self.assertEqual(load_feed("ci050", "ci050.ndjson"), {"rows": 1})
+        mock_maintain_partitions.assert_called_once()
+    
+    @patch("app.db.create_connection")
+    def test_retention_clears_catalog(self, mock_create_connection):
+        cur = mock_create_connection.return_value.cursor.return_value
+        cur.fetchone.side_effect = [("r",), ("p",), ("r",)]
+        cur.fetchall.return_value = [("cc050_default",), ("cc050_p20221101",), ("cc050_p20221231",)]
+        
+        with patch.dict("app.db.PARTITIONING", {"interval": "day"}):
+            removed = apply_retention(keep_days=30, mode="drop", today=date(2023, 1, 1))
+        
+        self.assertEqual(removed, ["cc050_p20221101"])
+        cur.execute.assert_any_call(
+            "DELETE FROM snapshot_catalog WHERE snapshot_table = %s AND date >= %s AND date < %s",
+            ("cc050", "2022-11-01", "2022-11-02"))
+
+class TestResolveReports(unittest.TestCase):
+    
+    def setUp(self):
+        self.report_config = {"reports": [
+            {"name": "cc050_eod_report", "table": "cc050", "date": "2020-05-11"},
+            {"name": "ci050_last_report", "table": "ci050", "date": "2020-05-11", "time_of_day": "last"},
+            {"name": "ci050_recent", "table": "ci050", "date": "2020-05-12", "time_of_day": "latest:2"},
+        ]}
+    
+    def test_plain_config_is_unchanged(self):
+        report_config = {"reports": [self.report_config["reports"][0]]}
+        self.assertIs(resolve_reports(report_config), report_config)
+    
+    @patch("app.catalog.lookup_snapshots")
+    def test_symbols_are_resolved(self, mock_lookup_snapshots):
+        mock_lookup_snapshots.side_effect = [["19:00:00"], ["12:00:00", "11:00:00"]]
+        
+        reports = resolve_reports(self.report_config)["reports"]
+        
+        self.assertEqual([report["name"] for report in reports],
+                         ["cc050_eod_report", "ci050_last_report", "ci050_recent_1", "ci050_recent_2"])
+        self.assertEqual([report.get("time_of_day") for report in reports],
+                         [None, "19:00:00", "12:00:00", "11:00:00"])
+        mock_lookup_snapshots.assert_any_call("ci050", "2020-05-12", "latest", 2, DATABASE)
+    
+    @patch("app.catalog.lookup_snapshots", return_value=[])
+    def test_missing_snapshot_raises(self, mock_lookup_snapshots):
+        with self.assertRaises(Exception):
+            resolve_reports(self.report_config)
+    
+    @patch("app.catalog.catalog_lists")
+    @patch("app.catalog.lookup_snapshots", return_value=[])
+    def test_fallback_until_catalog_is_filled(self, mock_lookup_snapshots, mock_catalog_lists):
+        report = {"name": "ci050_last_report", "table": "ci050", "date": "2020-05-11",
+                  "time_of_day": "last", "fallback_time_of_day": "19:00:00"}
+        
+        mock_catalog_lists.return_value = False
+        self.assertEqual(resolve_reports({"reports": [report]})["reports"][0]["time_of_day"], "19:00:00")
+        
+        mock_catalog_lists.return_value = True
+        with self.assertRaises(Exception):
+            resolve_reports({"reports": [report]})
+        
+        mock_lookup_snapshots.side_effect = psycopg2.OperationalError("connection refused")
+        mock_catalog_lists.return_value = False
+        with self.assertRaises(Exception):
+            resolve_reports({"reports": [report]})
+    
+    def test_create_tables_backfills_empty_catalog(self):
+        database = {"backend": "sqlite", "path": ":memory:"}
+        dispose_engines()
+        try:
+            create_tables(database)
+            bulk_upload_helper("ci050", load_fixtures("ci050.json"), TABLE_COLUMNS["ci050"], database=database)
+            connection = create_connection(database)
+            connection.cursor().execute("DELETE FROM snapshot_catalog")
+            connection.commit()
+            connection.close()
+            
+            create_tables(database)
+            
+            times = lookup_snapshots("ci050", "2020-05-12", "first", database=database)
+        finally:
+            dispose_engines()
+        
+        self.assertEqual(times, ["08:00:00"])
+
+class TestDaemon(unittest.TestCase):
+    
+    @staticmethod
+    def resolve(report_config):
+        times = {"first": "08:00:00", "last": "19:00:00"}
+        return {**report_config, "reports": [
+            {**report, "time_of_day": times.get(report.get("time_of_day"), report.get("time_of_day"))}
+            for report in report_config["reports"]]}
+    
+    def test_collect_event(self):
+        pending = {}
+        collect_event(pending, '{"table": "ci050", "date": "2020-05-12", "time_of_day": "08:00:00", "margin_types": ["SPAN"]}')
+        collect_event(pending, '{"table": "ci050", "date": "2020-05-12", "time_of_day": "08:00:00", "margin_types": ["IMSM"]}')
+        self.assertIsNone(collect_event(pending, "not json"))
+        self.assertEqual(pending, {("ci050", "2020-05-12", "08:00:00"): {"SPAN", "IMSM"}})
+    
+    def test_wait_time(self):
+        self.assertEqual(wait_time(0.0, 1.0, 2.0, debounce=2.0, max_delay=30.0), 1.0)
+        self.assertEqual(wait_time(0.0, 29.5, 29.5, debounce=2.0, max_delay=30.0), 0.5)
+        self.assertEqual(wait_time(0.0, 1.0, 5.0, debounce=2.0, max_delay=30.0), 0.0)
+    
+    @patch("app.daemon.resolve_reports")
+    def test_plan_runs_only_affected(self, mock_resolve_reports):
+        mock_resolve_reports.side_effect = self.resolve
+        pending = {("ci050", "2020-05-12", "08:00:00"): {"SPAN", "AMPO"}}
+        
+        plans = plan_runs(pending)
+        
+        # the snapshot is the first of 2020-05-12, but not the last one used by 2020-05-13
+        self.assertEqual(len(plans), 1)
+        day, margins, pairs = plans[0]
+        self.assertEqual(day, datetime(2020, 5, 12))
+        self.assertEqual(margins, ["SPAN", "AMPO"])
+        self.assertEqual(pairs, [("cc050_eod_report", "ci050_first_report")])
+    
+    @patch("app.daemon.maintain_partitions")
+    @patch("app.daemon.reconcile_day")
+    @patch("app.daemon.plan_runs")
+    def test_run_pending_flushes_metrics(self, mock_plan_runs, mock_reconcile_day, mock_maintain_partitions):
+        sinks = []
+        
+        def reconcile(day, overrides, pairs, sink):
+            sinks.append(sink)
+            with stage("query"):
+                pass
+            return [dict(day="2020-05-12", margin="SPAN", left="cc050_eod_report", right="ci050_first_report",
+                         matched=1, breaks=0, error=None)]
+        mock_plan_runs.return_value = [(datetime(2020, 5, 12), ["SPAN"], [("cc050_eod_report", "ci050_first_report")])] * 2
+        mock_reconcile_day.side_effect = reconcile
+        flush_metrics()
+        
+        rows = run_pending({})
+        
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(records(), [])
+        self.assertIs(sinks[0], sinks[1])
+        mock_maintain_partitions.assert_called_once()
+
+    @patch("app.daemon.listen")
+    def test_serve_refuses_sqlite(self, mock_listen):
+        self.assertFalse(serve(database={"backend": "sqlite", "path": ":memory:"}))
+        mock_listen.assert_not_called()
+
+class TestIngest(unittest.TestCase):
+    
+    def setUp(self):
+        self.columns = ["date", "time_of_day", "clearing_member", "account", "margin_type", "margin"]
+        self.data = load_fixtures("ci050.json")
+    
+    def test_nested_json_across_chunks(self):
+        text = json.dumps(self.data, indent=2)
+        expected = list(iter_fixture_rows(json.loads(text, parse_float=Decimal)))
+        
+        for chunk_size in (1, 5, 1 << 20):
+            self.assertEqual(list(read_nested_json(io.StringIO(text), chunk_size)), expected)
+    
+    def test_ndjson_and_csv(self):
+        ndjson = io.StringIO('["2020-05-12", "08:00:00", "Bank 1", "A1", "SPAN", 1.5]\n\n'
+                             '{"margin": 2, "date": "2020-05-12", "time_of_day": "08:00:00", '
+                             '"clearing_member": "Bank 1", "account": "A2", "margin_type": "IMSM"}\n')
+        rows = list(read_ndjson(ndjson, self.columns))
+        self.assertEqual(rows[1], ["2020-05-12", "08:00:00", "Bank 1", "A2", "IMSM", 2])
+        
+        feed = io.StringIO("margin,account,clearing_member,date,time_of_day,margin_type\n"
+                           "1.5,A1,Bank 1,2020-05-12,08:00:00,SPAN\n")
+        self.assertEqual(list(read_csv(feed, self.columns)),
+                         [["2020-05-12", "08:00:00", "Bank 1", "A1", "SPAN", "1.5"]])
+    
+    def test_type_row(self):
+        self.assertEqual(type_row(self.columns, ["2020-05-12", "08:00", " Bank 1", "A1", "SPAN", "1.5"]),
+                         ("2020-05-12", "08:00:00", "Bank 1", "A1", "SPAN", Decimal("1.5")))
+        self.assertEqual(str(type_row(self.columns, ["2020-05-12", "08:00", "Bank 1", "A1", "SPAN",
+                                                     "12345678901234567.89"])[-1]), "12345678901234567.89")
+        for row in (["2020-13-12", "08:00", "Bank 1", "A1", "SPAN", 1],
+                    ["2020-05-12", "08:00", "Bank 1", "A1", "SPAN"],
+                    ["2020-05-12", "08:00", "Bank 1", "A1", "X" * 17, 1],
+                    ["2020-05-12", "08:00", "Bank 1", "A1", "SPAN", "nan"],
+                    ["2020-05-12", "08:00", "Bank 1", "A1", "SPAN", "inf"],
+                    ["2020-05-12", "08:00", "Bank 1", "A1", "SPAN", True],
+                    ["2020-05-12", "08:00", "Bank 1", "A1", "SPAN", "1,5"]):
+            with self.assertRaises(ValueError):
+                type_row(self.columns, row)
+    
+    def test_nested_json_rejects_records_and_checks_commas(self):
+        text = '{"a": [["2020-05-12", 1], ["2020-05-12" 2], ["2020-05-12", 3]], "b": [["2020-05-13", 4]]}'
+        
+        for chunk_size in (1, 7, 1 << 20):
+            rows = list(read_nested_json(io.StringIO(text), chunk_size))
+            self.assertEqual([row for row in rows if not isinstance(row, ValueError)],
+                             [["2020-05-12", 1], ["2020-05-12", 3], ["2020-05-13", 4]])
+            self.assertIsInstance(rows[1], ValueError)
+        
+        for text in ('{"a": [[1] [2]]}', '{"a": [[1],, [2]]}', '{"a": [[1],]}', '{"a": [[1]] "b": []}'):
+            with self.assertRaises(ValueError):
+                list(read_nested_json(io.StringIO(text)))
+    
+    def test_nested_json_rejects_without_reading_ahead(self):
+        row = '["2020-05-12", "08:00:00", "Bank 1", "A1", "SPAN", 1.5]'
+        text = '{"a": [' + row + ', ["2020-05-12" "08:00:00"], ' + ", ".join([row] * 1000) + ']}'
+        stream = io.StringIO(text)
+        reads = {"chunks": 0}
+        read = stream.read
+        
+        def counted(size):
+            reads["chunks"] += 1
+            return read(size)
+        
+        stream.read = counted
+        rows = read_nested_json(stream, 64)
+        next(rows)
+        
+        self.assertIsInstance(next(rows), ValueError)
+        self.assertLess(reads["chunks"], 5)
+        self.assertEqual(len(list(rows)), 1000)
+    
+    def test_ingest_feed_rejects_malformed_lines(self):
+        database = {"backend": "sqlite", "path": ":memory:"}
+        line = '["2020-05-12", "08:00:00", "Bank 1", "A{}", "SPAN", 1.5]\n'
+        dispose_engines()
+        try:
+            create_tables(database)
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "ci050.ndjson")
+                with open(path, "w") as f:
+                    f.write(line.format(1) + line.format(2) + '["2020-05-12", "08:00:00",\n' + line.format(3))
+                
+                stats = ingest_feed("ci050", self.columns, path, commit_size=2, database=database)
+            
+            catalog = execute_query("SELECT row_count FROM snapshot_catalog", database)
+        finally:
+            dispose_engines()
+        
+        self.assertEqual((stats["rows"], stats["rejected"]), (3, 1))
+        self.assertEqual(catalog, [(3,)])
+    
+    @patch("app.ingest.bulk_insert_rows")
+    def test_ingest_feed_rejects_invalid_rows(self, mock_bulk_insert_rows):
+        written = []
+        mock_bulk_insert_rows.side_effect = lambda table, columns, rows, **kwargs: (
+            written.extend(rows) or {"table": table, "rows": len(written), "seconds": 0.1, "rows_per_sec": 10})
+        
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "ci050.csv")
+            with open(path, "w") as f:
+                f.write("2020-05-12,08:00:00,Bank 1,A1,SPAN,1.5\n2020-05-12,08:00:00,Bank 1,A1,SPAN,n/a\n")
+            
+            stats = ingest_feed("ci050", self.columns, path)
+        
+        self.assertEqual(stats["rows"], 1)
+        self.assertEqual(stats["rejected"], 1)
+        self.assertEqual(stats["format"], "csv")
+
+class TestEmbeddedBackend(unittest.TestCase):
+    
+    def setUp(self):
+        self.database = {"backend": "sqlite", "path": ":memory:"}
+        dispose_engines()
+        create_tables(self.database)
+        for table in ("cc050", "ci050"):
+            bulk_upload_helper(table, load_fixtures(f"{table}.json"), TABLE_COLUMNS[table], database=self.database)
+        self.report_config = {
+            "margin_classes": ["SPAN", "IMSM"],
+            "reports": [
+                {"name": "cc050_eod_report", "table": "cc050", "date": "2020-05-11"},
+                {"name": "ci050_last_report", "table": "ci050", "date": "2020-05-11", "time_of_day": "last"},
+                {"name": "ci050_first_report", "table": "ci050", "date": "2020-05-12", "time_of_day": "first"},
+            ],
+        }
+    
+    def tearDown(self):
+        dispose_engines()
+    
+    def test_get_margins(self):
+        df = get_margins("ci050_first_report", "ci050", "SPAN", "2020-05-12", "08:00:00", self.database)
+        
+        self.assertEqual(len(df), 3)
+        self.assertEqual(df["margin"].dtype, "float64")
+        self.assertEqual(df.name, "ci050_first_report_SPAN")
+    
+    def test_fetch_reports_modes_agree(self):
+        batched = fetch_reports(self.report_config, "batched", self.database)
+        per_margin = fetch_reports(self.report_config, "per_margin", self.database)
+        
+        for margin in self.report_config["margin_classes"]:
+            for name, df in batched[margin].items():
+                pd.testing.assert_frame_equal(df.reset_index(drop=True), per_margin[margin][name].reset_index(drop=True))
+        self.assertEqual(len(batched["SPAN"]["cc050_eod_report"]), 4)
+        self.assertEqual(str(batched["IMSM"]["ci050_last_report"]["time_of_day"].iloc[0]), "0 days 19:00:00")
+    
+    def test_server_side_engines_need_postgres(self):
+        with patch("app.utils.backend", return_value="sqlite"):
+            is_valid, message = validate_input({
+                "cols_to_check": [], "margin_classes": [], "reports": [], "engine": "sql"})
+        self.assertFalse(is_valid)
+
+class TestBreakSink(unittest.TestCase):
+    
+    def setUp(self):
+        self.non_matching = pd.DataFrame({
+            "clearing_member": ["Bank 1", "Bank 1", "Bank 2"],
+            "account": ["A1", "A1", "A1"],
+            "margin_type": ["SPAN", "SPAN", "SPAN"],
+            "margin": [10.0, 10.0, 5.0],
+            "source": ["found in left", "found in left", "found in right"],
+        })
+    
+    def test_categorize_breaks(self):
+        breaks = categorize_breaks(self.non_matching, "left", "right")
+        self.assertEqual(list(breaks["category"]), ["duplicated", "duplicated", "right_only"])
+        self.assertEqual(list(breaks["multiplicity"]), [1, 1, 1])
+        
+        tolerance = pd.DataFrame({"clearing_member": ["Bank 1"], "account": ["A1"], "margin_type": ["SPAN"],
+                                  "left_margin": [1.0], "right_margin": [2.0], "difference": [1.0],
+                                  "status": ["break"], "source": ["found in both, difference above tolerance"]})
+        breaks = categorize_breaks(tolerance, "left", "right")
+        self.assertEqual(breaks.loc[0, "category"], "difference")
+        self.assertEqual(breaks.loc[0, "margin"], 1.0)
+    
+    def test_file_targets(self):
+        targets = ["csv", "parquet"] if PARQUET_AVAILABLE else ["csv"]
+        for target in targets:
+            with tempfile.TemporaryDirectory() as directory:
+                sink = BreakSink(target, directory, batch_rows=2, run_id="run")
+                self.assertFalse(sink.add("left", "right", self.non_matching, "SPAN"))
+                self.assertTrue(sink.add("left", "right", self.non_matching.iloc[0:0], "SPAN"))
+                self.assertFalse(sink.add("left", "right", self.non_matching.iloc[2:], "IMSM"))
+                summary = sink.close()
+                
+                read = pd.read_csv if target == "csv" else pd.read_parquet
+                written = read(summary["path"])
+            
+            self.assertEqual(len(written), 4)
+            self.assertEqual(summary["categories"], {"duplicated": 2, "right_only": 2})
+            self.assertEqual(summary["margins"], {"SPAN": 3, "IMSM": 1})
+            self.assertEqual((summary["pairs"], summary["clean"], summary["written"]), (3, 1, 4))
+    
+    def test_table_target(self):
+        database = {"backend": "sqlite", "path": ":memory:"}
+        dispose_engines()
+        try:
+            create_tables(database)
+            sink = BreakSink("table", run_id="run", database=database)
+            sink.add("left", "right", self.non_matching, "SPAN")
+            sink.close()
+            
+            rows = execute_query("SELECT category, multiplicity, difference FROM recon_breaks", database)
+        finally:
+            dispose_engines()
+        
+        self.assertEqual(sorted(rows), [("duplicated", 1, None), ("duplicated", 1, None), ("right_only", 1, None)])
+
+class TestCli(unittest.TestCase):
+    
+    def test_import_is_light(self):
+        code = "import sys, app.cli; print(sorted({'pandas', 'numpy', 'sqlalchemy', 'config.settings'} & set(sys.modules)))"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        
+        self.assertEqual(result.stdout.strip(), "[]")
+    
+    def test_parse_args(self):
+        args = cli.parse_args(["run", "--feed", "ci050", "ci050.csv", "--skip", "reconcile", "--no-parallel"])
+        
+        self.assertEqual(args.feeds, [["ci050", "ci050.csv"]])
+        self.assertEqual(args.skip, ["reconcile"])
+        self.assertIs(args.parallel, False)
+        self.assertEqual(cli.parse_args(["bench", "--backend", "sqlite"]).bench_args, ["--backend", "sqlite"])
+        with self.assertRaises(SystemExit):
+            cli.parse_args(["load", "ci050", "ci050.csv", "--backend", "sqlite"])
+    
+    def test_run_stops_at_first_failure(self):
+        calls = []
+        stages = {name: (lambda name: lambda args: calls.append(name) or name != "load")(name) for name in cli.STAGES}
+        
+        with patch.dict(cli.COMMANDS, stages):
+            self.assertFalse(cli.run(cli.parse_args(["run"])))
+            self.assertTrue(cli.run(cli.parse_args(["run", "--skip", "load"])))
+        
+        self.assertEqual(calls, ["init-schema", "load", "init-schema", "check-integrity", "reconcile"])
+    
+    @patch("app.main.main")
+    def test_reconcile_fails_on_errors(self, mock_main):
+        args = cli.parse_args(["reconcile", "--date", "2020-05-12"])
+        
+        mock_main.return_value = {"errors": []}
+        self.assertTrue(cli.reconcile(args))
+        mock_main.return_value = {"errors": ["Error fetching ci050_first_report"]}
+        self.assertFalse(cli.reconcile(args))
+        mock_main.return_value = None
+        self.assertFalse(cli.reconcile(args))
+    
+    def test_check_integrity(self):
+        database = {"backend": "sqlite", "path": ":memory:"}
+        dispose_engines()
+        try:
+            self.assertIsNone(check_integrity(database))
+            create_tables(database)
+            empty = check_integrity(database)
+            bulk_upload_helper("cc050", load_fixtures("cc050.json"), TABLE_COLUMNS["cc050"], database=database)
+            loaded = check_integrity(database)
+        finally:
+            dispose_engines()
+        
+        self.assertEqual(empty, {"cc050": 0, "ci050": 0})
+        self.assertEqual(loaded, {"cc050": 6, "ci050": 0})
+
+class TestBulkInsertRows(unittest.TestCase):
+    
+    def setUp(self):
+        self.columns = ["date", "clearing_member", "account", "margin_type", "margin"]
+        self.data = load_fixtures("cc050.json")
+
+    def test_batch_rows(self):
+        batches = list(batch_rows(range(5), 2))
+        self.assertEqual(batches, [[0, 1], [2, 3], [4]])
+
+    @patch("psycopg2.extras.execute_values")
+    @patch("app.db_utils.create_connection")
+    def test_bulk_insert_rows_commits_per_batch(self, mock_create_connection, mock_execute_values):
+        mock_connection = MagicMock()
+        mock_create_connection.return_value = mock_connection
+
+        stats = bulk_insert_rows("cc050", self.columns, iter_fixture_rows(self.data), commit_size=4)
+
+        self.assertEqual(stats["rows"], 6)
+        mock_create_connection.assert_called_once()
+        self.assertEqual(mock_connection.cursor.return_value.copy_expert.call_count, 2)
+        self.assertEqual(mock_connection.commit.call_count, 2)
+        mock_connection.close.assert_called_once()
+        # the snapshot catalog is updated in the transaction of every batch
+        self.assertEqual(mock_execute_values.call_count, 2)
+        catalog_rows = [row for call in mock_execute_values.call_args_list for row in call[0][2]]
+        self.assertEqual(sum(row[3] for row in catalog_rows), 6)
+        self.assertTrue(all(row[0] == "cc050" and row[2] == "" for row in catalog_rows))
+
+class TestGetEngine(unittest.TestCase):
+    
+    def tearDown(self):
+        dispose_engines()
+
+    @patch("app.db_utils.event")
+    @patch("app.db_utils.create_engine")
+    def test_get_engine_is_reused(self, mock_create_engine, mock_event):
+        engine = get_engine(DATABASE)
+
+        self.assertIs(get_engine(DATABASE), engine)
+        mock_create_engine.assert_called_once()
+        self.assertTrue(mock_create_engine.call_args.kwargs["pool_pre_ping"])
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file